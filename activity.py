@@ -0,0 +1,150 @@
+from collections import Counter
+from datetime import date
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect, select, func, text, delete, and_, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models import db, TaskState, Author, Task, Comment, task_owners, author_activity
+
+# author_activity rollups, one row per (author, day) with
+#   comments        comments the author wrote that day
+#   tasks_created   tasks the author owns that were created that day
+#   tasks_<state>   the same tasks split by their current state
+#
+# the session events below work out which tasks and comments a flush touches, read what those rows
+# contributed to the rollups before the flush and after it, and add the difference in the same
+# transaction. that covers every kind of write (new/deleted rows, state changes, owners added or
+# removed from either side) without special casing any of them.
+#
+# writes that bypass the orm have to go through contributions()/apply() themselves (the batch task
+# update in main.py) or call rebuild() in their transaction (seed.py)
+
+STATE_COLUMNS = {state: f"tasks_{state.value}" for state in TaskState}
+COLUMNS = ["comments", "tasks_created", *STATE_COLUMNS.values()]
+
+IDS_PER_QUERY = 500
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), IDS_PER_QUERY):
+        yield ids[start:start + IDS_PER_QUERY]
+
+def contributions(conn, task_ids=(), comment_ids=()):
+    """What the given tasks and comments currently add to the rollups, a Counter of (author_id, day, column)."""
+    counts = Counter()
+    for chunk in _chunks(task_ids):
+        rows = conn.execute(
+            select(task_owners.c.author_id, func.date(Task.creation_date), Task.state, func.count()).
+            join(Task, Task.id == task_owners.c.task_id).
+            where(task_owners.c.task_id.in_(chunk), Task.creation_date.isnot(None)).
+            group_by(task_owners.c.author_id, func.date(Task.creation_date), Task.state)
+        )
+        for author_id, day, state, n in rows:
+            counts[(author_id, day, "tasks_created")] += n
+            counts[(author_id, day, STATE_COLUMNS[state])] += n
+    for chunk in _chunks(comment_ids):
+        rows = conn.execute(
+            select(Comment.author_id, func.date(Comment.creation_date), func.count()).
+            where(Comment.id.in_(chunk), Comment.creation_date.isnot(None)).
+            group_by(Comment.author_id, func.date(Comment.creation_date))
+        )
+        for author_id, day, n in rows:
+            counts[(author_id, day, "comments")] += n
+    return counts
+
+def apply(conn, before, after):
+    """Adds after - before to the rollups, rows that drop to all zeros are removed."""
+    deltas = {}
+    for key in before.keys() | after.keys():
+        change = after[key] - before[key]
+        if change:
+            author_id, day, column = key
+            deltas.setdefault((author_id, day), dict.fromkeys(COLUMNS, 0))[column] = change
+    if not deltas:
+        return
+
+    rows = [{"author_id": author_id, "day": date.fromisoformat(day), **values} for (author_id, day), values in deltas.items()]
+    stmt = insert(author_activity)
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["author_id", "day"],
+            set_={column: author_activity.c[column] + stmt.excluded[column] for column in COLUMNS}
+        ),
+        rows
+    )
+    empty = and_(*(author_activity.c[column] == 0 for column in COLUMNS))
+    for chunk in _chunks((row["author_id"], row["day"]) for row in rows):
+        conn.execute(delete(author_activity).where(tuple_(author_activity.c.author_id, author_activity.c.day).in_(chunk), empty))
+
+def rebuild(conn):
+    """Recomputes author_activity from task, task_owners and comment, returns the number of rows written."""
+    states = ", ".join(f"task.state = '{state.name}' AS {column}" for state, column in STATE_COLUMNS.items())
+    zeros = ", ".join("0" for _ in STATE_COLUMNS)
+    sums = ", ".join(f"sum({column})" for column in COLUMNS)
+    conn.execute(text("DELETE FROM author_activity"))
+    return conn.execute(text(f"""
+        INSERT INTO author_activity (author_id, day, {", ".join(COLUMNS)})
+        SELECT author_id, day, {sums} FROM (
+            SELECT task_owners.author_id, date(task.creation_date) AS day, 0 AS comments, 1 AS tasks_created, {states}
+            FROM task JOIN task_owners ON task_owners.task_id = task.id
+            WHERE task.creation_date IS NOT NULL
+            UNION ALL
+            SELECT author_id, date(creation_date), 1, 0, {zeros}
+            FROM comment
+            WHERE creation_date IS NOT NULL
+        ) AS activity
+        GROUP BY author_id, day
+    """)).rowcount
+
+
+def _touched(session):
+    """Ids of the persistent tasks and comments the pending flush writes."""
+    tasks, comments = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Task):
+            tasks.add(obj.id)
+        elif isinstance(obj, Comment):
+            comments.add(obj.id)
+        elif isinstance(obj, Author) and obj not in session.new:
+            # owners added or removed through author.tasks
+            hist = inspect(obj).attrs.tasks.history
+            tasks.update(task.id for task in list(hist.added) + list(hist.deleted))
+    tasks.discard(None)
+    comments.discard(None)
+    return tasks, comments
+
+@event.listens_for(Session, "before_flush")
+def _activity_before_flush(session, flush_context, instances):
+    tasks, comments = _touched(session)
+    conn = session.connection()
+    # a deleted author takes their task_owners rows along
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Author)]
+    if deleted:
+        tasks.update(conn.execute(select(task_owners.c.task_id).where(task_owners.c.author_id.in_(deleted))).scalars())
+    if tasks or comments:
+        session.info["activity_before"] = (tasks, comments, contributions(conn, tasks, comments))
+
+@event.listens_for(Session, "after_flush")
+def _activity_after_flush(session, flush_context):
+    tasks, comments = _touched(session) # the new rows have their ids by now
+    old_tasks, old_comments, before = session.info.pop("activity_before", (set(), set(), Counter()))
+    tasks |= old_tasks
+    comments |= old_comments
+    if tasks or comments:
+        conn = session.connection()
+        apply(conn, before, contributions(conn, tasks, comments))
+
+@event.listens_for(Session, "after_rollback")
+def _activity_after_rollback(session):
+    session.info.pop("activity_before", None)
+
+
+@click.command("activity-rebuild")
+@with_appcontext
+def rebuild_command():
+    """Rebuilds the author_activity rollups from tasks and comments."""
+    with db.engine.begin() as conn:
+        rows = rebuild(conn)
+    click.echo(f"author_activity rebuilt, {rows} rows")
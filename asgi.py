@@ -0,0 +1,289 @@
+import asyncio
+from urllib.parse import parse_qsl
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.http import parse_etags
+from main import create_app, TASKS_STREAM_BATCH
+from models import db, apply_sqlite_pragmas
+from etag import versions_statement, etag_for
+import queries
+import changes
+import migrations
+from metrics import metrics
+from serialize import parse_fields, fields_error, negotiate, compress, compressible
+
+# asynchronous serving mode, run it with serve.py (or any asgi server: uvicorn asgi:app)
+#
+# the task listings are the routes dashboards hammer and they spend their time waiting on the database,
+# so they are answered here on the event loop with an async engine (aiosqlite for sqlite) and a bounded
+# connection pool, a slow query holds a pooled connection but no thread.
+# every other route goes to the flask app through a fixed size thread pool (WSGI_THREADS).
+# the statements and the json shapes come from queries.py and the etags from etag.py, so both modes answer
+# the same. sqltap only sees the routes that go through flask.
+# the /changes/stream event stream is served here too, an idle subscriber costs a coroutine instead of a thread.
+
+
+class AsyncTasksApp:
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        # the fake latency of the legacy viewtasks is awaited here instead of sleeping in a pool thread
+        self.delay = config['ARTIFICIAL_DELAY']
+        config['ARTIFICIAL_DELAY'] = 0
+        self.config = config
+        self.etags = config['ETAGS']
+        self.engine = _async_engine(flask_app)
+        self.wsgi = WSGIMiddleware(flask_app, workers=config['WSGI_THREADS'])
+        self.dumps = flask_app.json.dumps
+        self.dumpb = flask_app.json.dumpb
+        views = flask_app.view_functions
+        self.routes = {
+            "/view/tasks": (self.tasks_page, views['views.viewtasks']),
+            "/view/tasks/account": (self.account_tasks, views['views.viewtasksaccount']),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        route = self.routes.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "GET" else None
+        args = parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == "/changes/stream":
+            return await self.change_stream(args, dict(scope["headers"]), receive, send)
+        # the legacy (task, owner) listing stays on flask
+        if route and scope["path"] == "/view/tasks" and _arg(args, 'group') != 'task':
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            route = None
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+
+        handler, view = route
+        headers = dict(scope["headers"])
+        # the same per route metrics the flask routes get
+        current = metrics.begin() if metrics.enabled else None
+        status = 500
+
+        async def send_and_note_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            async with self.engine.connect() as conn:
+                etag = None
+                if self.etags:
+                    versions = dict((await conn.execute(versions_statement(view.etag_tables))).all())
+                    etag = etag_for(view.etag_route, view.etag_tables, versions, {}, args)
+                    if parse_etags(headers.get(b"if-none-match", b"").decode("latin-1")).contains_weak(etag):
+                        return await self.respond(send_and_note_status, headers, 304, etag=etag)
+                await handler(conn, args, headers, send_and_note_status, etag)
+        finally:
+            if current is not None:
+                metrics.end(scope["path"], status, current)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.flask_app.config['WARM_UP']:
+                    await self.warm_up()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def warm_up(self):
+        # main.warm_up did the flask engine, this is the same for the async engine's pool and compiled cache
+        config = self.flask_app.config
+        conns = [await self.engine.connect() for _ in range(min(config['WARM_UP_CONNECTIONS'], config['ASYNC_POOL_SIZE']))]
+        try:
+            if await conns[0].run_sync(migrations.current_version) == migrations.HEAD:
+                versions = [versions_statement(view.etag_tables) for _, view in self.routes.values()]
+                await conns[0].run_sync(queries.warm_up, versions)
+        finally:
+            for conn in conns:
+                await conn.close()
+
+    async def respond(self, send, headers, status, body=None, etag=None, more_body=False):
+        response_headers = [(b"content-type", b"application/json")]
+        # compressed like serialize.Compressor does for the flask routes, the streamed bodies aren't
+        if status == 200 and not more_body and body and compressible("application/json", len(body), self.config):
+            response_headers.append((b"vary", b"Accept-Encoding"))
+            encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+            if encoding is not None:
+                body = compress(body, encoding, self.config)
+                response_headers.append((b"content-encoding", encoding.encode()))
+        # same as flask-cors does for the flask routes
+        if b"origin" in headers:
+            response_headers.append((b"access-control-allow-origin", b"*"))
+        # etags only go on successful answers, like etag.conditional
+        if etag and status in (200, 304):
+            response_headers.append((b"etag", f'W/"{etag}"'.encode()))
+            response_headers.append((b"cache-control", b"no-cache"))
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        await send({"type": "http.response.body", "body": body or b"", "more_body": more_body})
+
+    async def json(self, send, headers, status, data, etag=None):
+        await self.respond(send, headers, status, self.dumpb(data) + b"\n", etag)
+
+    async def tasks_page(self, conn, args, headers, send, etag):
+        # same 3 statements as main._viewtasksbytask
+        try:
+            limit = int(_arg(args, 'limit', queries.TASKS_PAGE_LIMIT))
+            after = int(_arg(args, 'after', 0))
+        except ValueError:
+            return await self.json(send, headers, 400, {"error": "limit and after must be integers"})
+        limit = max(1, min(limit, queries.TASKS_PAGE_MAX_LIMIT))
+        try:
+            fields = parse_fields(_arg(args, 'fields'), queries.TASKS_PAGE_FIELDS)
+        except ValueError:
+            return await self.json(send, headers, 400, fields_error(queries.TASKS_PAGE_FIELDS))
+
+        viewer = _arg(args, 'viewer')
+        tasks = (await conn.execute(queries.tasks_page(viewer is not None), queries.tasks_page_params(after, limit, viewer))).all()
+        owners = comments = []
+        if tasks:
+            page = queries.page_ids(tasks[:limit])
+            if "owners" in fields:
+                owners = (await conn.execute(queries.page_owners(), page)).all()
+            if "comments" in fields:
+                comments = (await conn.execute(queries.page_comments(), page)).all()
+        await self.json(send, headers, 200, queries.tasks_page_payload(tasks, owners, comments, limit, fields), etag)
+
+    async def account_tasks(self, conn, args, headers, send, etag):
+        # same statement as main.viewtasksaccount
+        username = _arg(args, 'username')
+        try:
+            start_level = int(_arg(args, 'start_level', 1))
+            end_level = int(_arg(args, 'end_level', 1))
+        except ValueError:
+            return await self.json(send, headers, 400, {"error": "start_level and end_level must be integers"})
+
+        if not username:
+            return await self.json(send, headers, 400, {"error": "no username provided"})
+        try:
+            fields = parse_fields(_arg(args, 'fields'), queries.ACCOUNT_TASK_FIELDS)
+        except ValueError:
+            return await self.json(send, headers, 400, fields_error(queries.ACCOUNT_TASK_FIELDS))
+
+        stmt = queries.account_tasks(fields)
+        params = queries.account_tasks_params(username, start_level, end_level)
+        if not _arg(args, 'stream'):
+            rows = (await conn.execute(stmt, params)).all()
+            if not rows:
+                return await self.json(send, headers, 404, {"error": "Account not found"})
+            return await self.json(send, headers, 200, [queries.account_task(row, fields) for row in rows if row.id is not None], etag)
+
+        # streamed in batches straight off a server side cursor, nothing but the current batch is held in memory
+        result = await conn.stream(stmt, params, execution_options={"yield_per": TASKS_STREAM_BATCH})
+        first = await result.fetchone()
+        if first is None:
+            return await self.json(send, headers, 404, {"error": "Account not found"})
+        await self.respond(send, headers, 200, b"[", etag, more_body=True)
+        separator = b""
+        if first.id is not None:
+            await self.respond_chunk(send, self.dumpb(queries.account_task(first, fields)))
+            separator = b","
+        async for partition in result.partitions():
+            chunk = b",".join(self.dumpb(queries.account_task(row, fields)) for row in partition if row.id is not None)
+            if chunk:
+                await self.respond_chunk(send, separator + chunk)
+                separator = b","
+        await send({"type": "http.response.body", "body": b"]", "more_body": False})
+
+    async def respond_chunk(self, send, body):
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    async def change_stream(self, args, headers, receive, send):
+        # same events as main.viewchangesstream
+        config = self.flask_app.config
+        try:
+            since = changes.parse_since(headers.get(b"last-event-id", b"").decode("latin-1") or _arg(args, 'since'))
+        except ValueError:
+            return await self.json(send, headers, 400, {"error": "since must be a non negative integer"})
+
+        async with self.engine.connect() as conn:
+            bounds = (await conn.execute(changes.bounds_statement())).one()
+        if since is None:
+            since = bounds[1] or 0
+        elif changes.is_gone(since, bounds):
+            return await self.json(send, headers, 410, changes.gone_payload(since, bounds))
+
+        response_headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+        response_headers += [(name.lower().encode(), value.encode()) for name, value in changes.SSE_HEADERS.items()]
+        if b"origin" in headers:
+            response_headers.append((b"access-control-allow-origin", b"*"))
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        await self.respond_chunk(send, changes.sse_retry(config['CHANGES_RETRY_MS']).encode())
+
+        # the client going away ends the stream right away instead of at the next failed write
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch())
+        loop = asyncio.get_running_loop()
+        deadline, quiet = loop.time() + config['CHANGES_STREAM_SECONDS'], loop.time()
+        try:
+            while not disconnected.is_set() and loop.time() < deadline:
+                # the pooled connection is only held for the one query, not while waiting
+                async with self.engine.connect() as conn:
+                    rows = (await conn.execute(changes.since_statement(), {"since": since, "limit": changes.CHANGE_LIMIT})).all()
+                if rows:
+                    body = "".join(changes.sse_event(changes.change(row), self.dumps) for row in rows)
+                    await self.respond_chunk(send, body.encode())
+                    since, quiet = rows[-1].seq, loop.time()
+                elif loop.time() - quiet >= config['CHANGES_KEEPALIVE']:
+                    await self.respond_chunk(send, changes.SSE_KEEPALIVE.encode())
+                    quiet = loop.time()
+                if len(rows) < changes.CHANGE_LIMIT:
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), config['CHANGES_POLL_INTERVAL'])
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            watcher.cancel()
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def _arg(args, name, default=None):
+    # first value wins, like request.args.get
+    for key, value in args:
+        if key == name:
+            return value
+    return default
+
+def _async_engine(flask_app):
+    config = flask_app.config
+    url = config['ASYNC_DATABASE_URI']
+    if not url:
+        # same database as flask-sqlalchemy, whose url already has the instance folder resolved
+        with flask_app.app_context():
+            url = db.engine.url
+        if url.get_backend_name() != "sqlite":
+            raise ValueError("set ASYNC_DATABASE_URI for a database other than sqlite")
+        url = url.set(drivername="sqlite+aiosqlite")
+    engine = create_async_engine(
+        url,
+        echo=config['SQLALCHEMY_ECHO'],
+        pool_size=config['ASYNC_POOL_SIZE'],
+        max_overflow=config['ASYNC_POOL_MAX_OVERFLOW'],
+        pool_timeout=config['ASYNC_POOL_TIMEOUT'],
+    )
+    # it only ever reads, writes go through the flask routes and the writer (see writer.py)
+    apply_sqlite_pragmas(engine.sync_engine, {**config['SQLITE_PRAGMAS'], 'query_only': 'ON'})
+    if metrics.enabled:
+        metrics.instrument(engine.sync_engine)
+    return engine
+
+def create_asgi_app(mode=None, **overrides):
+    return AsyncTasksApp(create_app(mode, **overrides))
+
+app = create_asgi_app()
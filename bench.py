@@ -0,0 +1,162 @@
+import os
+os.environ.setdefault("APP_MODE", "prod")
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+from main import create_app
+from models import db, org_index
+from seed import seed_bulk
+import explain
+
+# endpoint benchmark and query count regression check
+# python bench.py                          # run, print, write bench_results.json
+# python bench.py --save                   # ... and make it the new bench_baseline.json
+# python bench.py --check                  # exit 1 if a route runs more statements or got slower than the baseline
+# python bench.py --sizes small,medium,large --runs 20
+#
+# every size is seeded with seed.seed_bulk into a throwaway sqlite file, so the data (and therefore the
+# statement counts) are identical between runs, latency obviously depends on the machine
+
+SIZES = {
+    "small": {"authors": 1000, "tasks": 2000, "posts": 500, "comments": 10000, "depth": 5, "fanout": 5},
+    "medium": {"authors": 10000, "tasks": 20000, "posts": 5000, "comments": 100000, "depth": 7, "fanout": 5},
+    "large": {"authors": 50000, "tasks": 100000, "posts": 20000, "comments": 1000000, "depth": 8, "fanout": 6},
+}
+
+BASELINE = "bench_baseline.json"
+RESULTS = "bench_results.json"
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _label(url, query_string):
+    if not query_string:
+        return url
+    return url + "?" + "&".join(f"{k}={v}" for k, v in query_string.items())
+
+def _rows_fetched(statements):
+    # re-run every select the route ran and count what it returns, outside of the timed runs
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        return sum(len(cursor.execute(statement, parameters).fetchall()) for statement, parameters in statements)
+    finally:
+        raw.close()
+
+def bench_route(client, url, query_string, runs):
+    # the first request warms the org index and the page cache and is not timed
+    status, statements = explain.capture_statements(client, url, query_string)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        client.get(url, query_string=query_string)
+        timings.append((time.perf_counter() - started) * 1000)
+    return {
+        "status": status,
+        "statements": len(statements),
+        "rows": _rows_fetched(statements),
+        "p50_ms": round(_percentile(timings, 50), 3),
+        "p95_ms": round(_percentile(timings, 95), 3),
+        "p99_ms": round(_percentile(timings, 99), 3),
+    }
+
+def bench_size(name, options, runs, data_dir):
+    path = os.path.join(data_dir, f"bench_{name}.db")
+    # caching and etags off, the point is to measure what the routes themselves cost
+    app = create_app("prod", SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}", CACHE_BACKEND=None, ETAGS=False)
+    with app.app_context():
+        print(f"seeding {name} {options}")
+        seed_bulk(db.engine, **options)
+        args = explain.sample_args()
+        client = app.test_client()
+        routes = {}
+        for url, query_string in explain.route_urls(args):
+            label = _label(url, query_string)
+            # the author id in the url differs per dataset, key by the route shape instead
+            key = label.replace(f"/{args['id']}", "/<id>")
+            routes[key] = bench_route(client, url, query_string, runs)
+            r = routes[key]
+            print(f"  {key:70} {r['statements']:>7} stmts {r['rows']:>8} rows "
+                  f"p50 {r['p50_ms']:>9.2f}ms p95 {r['p95_ms']:>9.2f}ms p99 {r['p99_ms']:>9.2f}ms")
+        db.engine.dispose()
+    # the index is process wide, don't let the next dataset see this one's org chart
+    org_index.invalidate()
+    return {"options": options, "routes": routes}
+
+def check(results, baseline, latency_tolerance, latency_slack_ms):
+    """Returns a list of regressions of results against baseline."""
+    failures = []
+    for size, current in results["sizes"].items():
+        base = baseline.get("sizes", {}).get(size)
+        if base is None:
+            failures.append(f"{size}: not in the baseline, re-save it")
+            continue
+        if base["options"] != current["options"]:
+            failures.append(f"{size}: dataset options changed, re-save the baseline")
+            continue
+        for route, r in current["routes"].items():
+            b = base["routes"].get(route)
+            # a new route needs a baseline entry, otherwise it's never checked
+            if b is None:
+                failures.append(f"{size} {route}: not in the baseline, re-save it")
+                continue
+            if r["statements"] > b["statements"]:
+                failures.append(f"{size} {route}: {r['statements']} statements, baseline {b['statements']}")
+            for pct in ("p50_ms", "p95_ms"):
+                limit = b[pct] * (1 + latency_tolerance) + latency_slack_ms
+                if r[pct] > limit:
+                    failures.append(f"{size} {route}: {pct} {r[pct]:.2f}ms, baseline {b[pct]:.2f}ms (limit {limit:.2f}ms)")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark every route and compare with the saved baseline")
+    parser.add_argument("--sizes", default="small,medium", help=f"comma separated, from {', '.join(SIZES)}")
+    parser.add_argument("--runs", type=int, default=10, help="timed requests per route")
+    parser.add_argument("--save", action="store_true", help=f"write the results to {BASELINE}")
+    parser.add_argument("--check", action="store_true", help=f"fail on regressions against {BASELINE}")
+    parser.add_argument("--latency-tolerance", type=float, default=0.5, help="allowed relative slowdown")
+    parser.add_argument("--latency-slack-ms", type=float, default=2.0, help="allowed absolute slowdown")
+    parser.add_argument("--data-dir", default=None, help="where the datasets are seeded (default: a temp dir)")
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error(f"unknown size(s): {', '.join(unknown)}")
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="tasks-bench-")
+    try:
+        results = {"sizes": {size: bench_size(size, SIZES[size], args.runs, data_dir) for size in sizes}}
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(RESULTS, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.check:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+        failures = check(results, baseline, args.latency_tolerance, args.latency_slack_ms)
+        if failures:
+            print(f"\n{len(failures)} regression(s):")
+            for failure in failures:
+                print("  " + failure)
+            sys.exit(1)
+        print("\nno regressions against the baseline")
+
+    if args.save:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"saved {BASELINE}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, g, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import Account, Author, Comment, Post, Task
+from etag import current_versions
+
+# read-through response cache for the read heavy routes
+#
+# a cached view declares which rows its response was built from by calling cache_tags("author:3", ...)
+# while it runs. when a commit touches those rows the session events below evict exactly the entries
+# carrying a matching tag, everything else stays cached. tags in use:
+#   author:<id>          the author row (name, boss_id, ...) and the set of its direct reports
+#   author-name:<name>   which authors currently have this name
+#   account:<id>         the account row
+#   post:<id>            the post row
+#   post-author:<id>     which posts belong to the author
+#   task:<id>            the task row
+#   owner:<id>           which tasks the author owns
+#   comments-by:<id>     which comments the author wrote
+#
+# writes that bypass the orm (core inserts in seed.py) have to call response_cache.clear() themselves
+#
+# the events only see this process's commits. that's enough for one process, and redis shares the
+# evictions between processes. an in-process cache (lru, or shared without CACHE_REDIS_URL) under several
+# workers (CACHE_WORKERS) never hears about another worker's write, so there every entry is also keyed on
+# the table_version rows read for the request (the same read the etag comes from, see etag.py). a write
+# bumps those versions, the next request looks up a different key and the stale entry just ages out
+
+
+class LRUBackend:
+    """In-process LRU with a per entry TTL and a max entry count."""
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, value, tags)
+        self._tags = {}               # tag -> set of keys
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def size(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SharedBackend:
+    """Cache shared between processes, stored through a redis style client.
+
+    Entries are pickled under "cache:<key>" with an expiry, each tag is a set of keys under "tag:<tag>".
+    Anything with get/set(ex=)/delete/sadd/smembers/keys works, redis.Redis or LocalSharedClient.
+    """
+
+    def __init__(self, client, ttl=300, prefix="tasks:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0 # expiry is done by the server, it doesn't tell us
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + "cache:" + key)
+        return None if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, tags):
+        self.client.set(self.prefix + "cache:" + key, pickle.dumps(value), ex=self.ttl)
+        for tag in tags:
+            self.client.sadd(self.prefix + "tag:" + tag, key)
+
+    def invalidate(self, tags):
+        keys = set()
+        for tag in tags:
+            members = self.client.smembers(self.prefix + "tag:" + tag)
+            keys |= {m.decode() if isinstance(m, bytes) else m for m in members}
+        if keys:
+            self.client.delete(*[self.prefix + "cache:" + key for key in keys])
+        if tags:
+            self.client.delete(*[self.prefix + "tag:" + tag for tag in tags])
+        return len(keys)
+
+    def clear(self):
+        keys = self.client.keys(self.prefix + "*")
+        if keys:
+            self.client.delete(*keys)
+
+    def size(self):
+        return len(self.client.keys(self.prefix + "cache:*"))
+
+
+class LocalSharedClient:
+    """Stand-in for a redis server when there is none, implements just what SharedBackend uses.
+
+    Values round-trip through bytes like they would over the wire, so code tested against it
+    behaves the same on a real redis.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data[key] if self._alive(key) else None
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = bytes(value)
+            if ex is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.monotonic() + ex
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._data.setdefault(key, set()).update(m.encode() for m in members)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._data.get(key, ()))
+
+    def keys(self, pattern):
+        prefix = pattern.rstrip("*")
+        with self._lock:
+            return [key for key in list(self._data) if key.startswith(prefix) and self._alive(key)]
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped on every invalidation, a response computed across one is not stored
+        self._epoch = 0
+        # keys include the table versions, see the top of the file
+        self.versioned = False
+
+    def configure(self, config):
+        kind = config.get('CACHE_BACKEND')
+        ttl = config.get('CACHE_TTL', 300)
+        in_process = kind == 'lru' or (kind == 'shared' and not config.get('CACHE_REDIS_URL'))
+        self.versioned = in_process and config.get('CACHE_WORKERS', 1) > 1
+        if not kind:
+            self.backend = None
+        elif kind == 'lru':
+            self.backend = LRUBackend(config.get('CACHE_MAX_ENTRIES', 10000), ttl)
+        elif kind == 'shared':
+            url = config.get('CACHE_REDIS_URL')
+            if url:
+                import redis # optional, only needed for a real shared cache
+                client = redis.Redis.from_url(url)
+            else:
+                client = LocalSharedClient()
+            self.backend = SharedBackend(client, ttl)
+        else:
+            raise ValueError(f"unknown CACHE_BACKEND {kind!r}")
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def invalidate(self, tags):
+        self._epoch += 1
+        if self.backend is not None and tags:
+            self.invalidations += self.backend.invalidate(tags)
+
+    def clear(self):
+        self._epoch += 1
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "entries": self.backend.size() if self.backend else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend else 0,
+            "invalidations": self.invalidations,
+        }
+
+    def cached(self, route, args=None):
+        """Caches the view's response keyed by route, url kwargs and the listed query args.
+
+        args maps each query arg the view reads to its default, so ?start_level=1 and
+        no start_level share an entry and unrelated args don't split the cache.
+        """
+        args = args or {}
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*view_args, **kwargs):
+                if self.backend is None:
+                    return view(*view_args, **kwargs)
+                parts = [f"{k}={kwargs[k]}" for k in sorted(kwargs)] + \
+                    [f"{k}={request.args.get(k, default)}" for k, default in sorted(args.items())]
+                if self.versioned:
+                    # read by @conditional above, when etags are off every table's version is read here
+                    versions = g.get('table_versions')
+                    if versions is None:
+                        versions = current_versions()
+                    parts += [f"{t}@{v}" for t, v in sorted(versions.items())]
+                key = route + "|" + "&".join(parts)
+                hit = self.backend.get(key)
+                if hit is not None:
+                    self.hits += 1
+                    body, status, mimetype = hit
+                    return Response(body, status=status, mimetype=mimetype)
+
+                self.misses += 1
+                epoch = self._epoch
+                g.cache_tags = set()
+                response = current_app.make_response(view(*view_args, **kwargs))
+                tags = g.pop('cache_tags')
+                # only plain answers (including not found) are cached, and never one that raced a commit
+                if response.status_code in (200, 404) and tags and epoch == self._epoch and not response.is_streamed:
+                    self.backend.set(key, (response.get_data(), response.status_code, response.mimetype), tags)
+                return response
+            return wrapper
+        return decorator
+
+
+response_cache = ResponseCache()
+
+def cache_tags(*tags):
+    """Records the rows the current cached response depends on, a no-op outside a cached view."""
+    current = g.get('cache_tags')
+    if current is not None:
+        current.update(tags)
+
+
+def _history(obj, attr):
+    """Current and previous values of a column attribute, previous ones only if it changed in this flush."""
+    state = inspect(obj)
+    hist = state.attrs[attr].history
+    values = set(hist.added) | set(hist.deleted) | set(hist.unchanged)
+    if not hist.has_changes():
+        values.add(getattr(obj, attr))
+    values.discard(None)
+    return values
+
+def _collection_history(obj, attr):
+    hist = inspect(obj).attrs[attr].history
+    return list(hist.added) + list(hist.deleted)
+
+def _tags_for(obj, deleted=False):
+    tags = set()
+    if isinstance(obj, Author):
+        tags.add(f"author:{obj.id}")
+        tags.update(f"author-name:{name}" for name in _history(obj, 'name'))
+        # the old and the new boss both get a different set of direct reports
+        tags.update(f"author:{boss}" for boss in _history(obj, 'boss_id'))
+        tags.update(f"account:{account}" for account in _history(obj, 'account_id'))
+        tags.add(f"owner:{obj.id}")
+        tags.update(f"task:{task.id}" for task in _collection_history(obj, 'tasks'))
+    elif isinstance(obj, Account):
+        tags.add(f"account:{obj.id}")
+    elif isinstance(obj, Post):
+        tags.add(f"post:{obj.id}")
+        tags.update(f"post-author:{author}" for author in _history(obj, 'author_id'))
+    elif isinstance(obj, Task):
+        tags.add(f"task:{obj.id}")
+        if not deleted:
+            tags.update(f"owner:{author.id}" for author in _collection_history(obj, 'owners'))
+    elif isinstance(obj, Comment):
+        tags.update(f"comments-by:{author}" for author in _history(obj, 'author_id'))
+    return tags
+
+# a deleted task takes its task_owners rows with it, read who owned it while the rows still exist
+@event.listens_for(Session, "before_flush")
+def _cache_before_flush(session, flush_context, instances):
+    if not response_cache.enabled:
+        return
+    tags = session.info.setdefault("cache_tags", set())
+    with session.no_autoflush:
+        for obj in session.deleted:
+            if isinstance(obj, Task) and obj.id is not None:
+                tags.update(f"owner:{author.id}" for author in obj.owners)
+
+@event.listens_for(Session, "after_flush")
+def _cache_after_flush(session, flush_context):
+    if not response_cache.enabled:
+        return
+    tags = session.info.setdefault("cache_tags", set())
+    for obj in session.new:
+        tags |= _tags_for(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tags |= _tags_for(obj)
+    for obj in session.deleted:
+        tags |= _tags_for(obj, deleted=True)
+
+@event.listens_for(Session, "after_commit")
+def _cache_after_commit(session):
+    tags = session.info.pop("cache_tags", None)
+    if tags:
+        response_cache.invalidate(tags)
+
+@event.listens_for(Session, "after_rollback")
+def _cache_after_rollback(session):
+    session.info.pop("cache_tags", None)
@@ -0,0 +1,152 @@
+import json
+from datetime import datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, delete, func, text, bindparam
+from models import db, TaskState, change_log
+from queries import prebuilt
+
+# change feed of task, comment and task_owners writes
+#
+# sqlite triggers append one change_log row per inserted, updated or deleted row, in the same transaction
+# as the write, so a change shows up exactly when it commits and a rollback takes it away again. that
+# covers core writes (the batch task update) as well as the orm. sqlite only has one writer at a time,
+# so seq order is commit order and "everything after seq N" never skips a change that commits late.
+#
+# each change carries what a client needs to patch its copy of the tasks page without refetching:
+#   task          the task's columns, state as the api spells it
+#   comment       the comment with its author's name
+#   task_owners   task_id, author_id and the author's name
+# deletes only carry the keys.
+#
+# clients take the head seq (GET /changes), load the snapshot, then follow /changes?since=head or the
+# /changes/stream event stream. applying a change twice is harmless, they are all upserts and deletes by key.
+
+CHANGE_LIMIT = 500
+
+def _iso(value):
+    # sqlite keeps '2025-04-04 08:57:00.000000', the snapshot and the api say datetime.isoformat(),
+    # '2025-04-04T08:57:00' (the fraction only when it isn't zero). NULL stays NULL
+    return f"CASE WHEN substr({value}, 20) = '.000000' THEN substr(replace({value}, ' ', 'T'), 1, 19) " \
+           f"ELSE replace({value}, ' ', 'T') END"
+
+_ROWS = {
+    "task": "json_object('id', {r}.id, 'headline', {r}.headline, 'content', {r}.content, 'state', {r}.state, "
+            "'date', " + _iso("{r}.date") + ", 'priority', {r}.priority, 'version', {r}.version)",
+    "comment": "json_object('id', {r}.id, 'task_id', {r}.task_id, 'post_id', {r}.post_id, 'content', {r}.content, "
+               "'author', (SELECT name FROM author WHERE id = {r}.author_id))",
+    "task_owners": "json_object('task_id', {r}.task_id, 'author_id', {r}.author_id, "
+                   "'name', (SELECT name FROM author WHERE id = {r}.author_id))",
+}
+_KEYS = {
+    "task": "json_object('id', old.id)",
+    "comment": "json_object('id', old.id, 'task_id', old.task_id, 'post_id', old.post_id)",
+    "task_owners": "json_object('task_id', old.task_id, 'author_id', old.author_id)",
+}
+
+def _trigger(table, op, data):
+    when = {"insert": "INSERT", "update": "UPDATE", "delete": "DELETE"}[op]
+    return f"""CREATE TRIGGER IF NOT EXISTS {table}_change_{op} AFTER {when} ON {table} BEGIN
+            INSERT INTO change_log (table_name, op, data) VALUES ('{table}', '{op}', {data});
+        END"""
+
+TRIGGERS = {}
+for _table in _ROWS:
+    TRIGGERS[f"{_table}_change_insert"] = _trigger(_table, "insert", _ROWS[_table].format(r="new"))
+    # task_owners rows are only ever added or removed
+    if _table != "task_owners":
+        TRIGGERS[f"{_table}_change_update"] = _trigger(_table, "update", _ROWS[_table].format(r="new"))
+    TRIGGERS[f"{_table}_change_delete"] = _trigger(_table, "delete", _KEYS[_table])
+
+def drop_triggers(conn):
+    """For bulk loads, the rows of a reseed aren't changes anyone can follow. Put them back with create_triggers()."""
+    for name in TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+def create_triggers(conn):
+    for sql in TRIGGERS.values():
+        conn.execute(text(sql))
+
+def iso_dates(conn):
+    """Rewrites the task dates already in the feed the way the triggers write them now (migration 12)."""
+    date = "json_extract(data, '$.date')"
+    conn.execute(text(
+        f"UPDATE change_log SET data = json_set(data, '$.date', {_iso(date)}) "
+        f"WHERE table_name = 'task' AND {date} IS NOT NULL"
+    ))
+
+
+@prebuilt()
+def bounds_statement():
+    # two subqueries, sqlite only answers a lone min() or max() straight from the primary key
+    return select(
+        select(func.min(change_log.c.seq)).scalar_subquery(),
+        select(func.max(change_log.c.seq)).scalar_subquery()
+    )
+
+@prebuilt(limit=0)
+def since_statement():
+    # the changes after :since, at most :limit of them
+    return select(change_log.c.seq, change_log.c.table_name, change_log.c.op, change_log.c.data).\
+        where(change_log.c.seq > bindparam("since")).\
+        order_by(change_log.c.seq).\
+        limit(bindparam("limit"))
+
+def is_gone(since, bounds):
+    """True when the changes right after since have been pruned, or since comes from a different (re-seeded) log."""
+    oldest, head = bounds
+    if head is None:
+        return since != 0
+    return since < oldest - 1 or since > head
+
+def parse_since(value):
+    """The seq to resume after from ?since= or a Last-Event-ID header, None when neither was sent."""
+    if value is None or value == "":
+        return None
+    since = int(value)
+    if since < 0:
+        raise ValueError("since can't be negative")
+    return since
+
+def change(row):
+    data = json.loads(row.data)
+    if row.table_name == "task" and "state" in data:
+        data["state"] = TaskState[data["state"]].value
+    return {"seq": row.seq, "table": row.table_name, "op": row.op, "data": data}
+
+def gone_payload(since, bounds):
+    return {"error": f"changes after {since} are no longer available, reload the tasks and resume from head", "head": bounds[1] or 0}
+
+# server-sent events, every change is one "change" event whose id is its seq so EventSource
+# reconnects with Last-Event-ID and picks up right where it stopped
+def sse_retry(milliseconds):
+    return f"retry: {milliseconds}\n\n"
+
+def sse_event(item, dumps):
+    return f"id: {item['seq']}\nevent: change\ndata: {dumps(item)}\n\n"
+
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # don't let a proxy (nginx) sit on the events
+    "X-Accel-Buffering": "no",
+}
+
+
+def prune(conn, days):
+    """Deletes changes older than days, always keeping the newest so the head seq survives. Returns the number deleted."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    newest = select(func.max(change_log.c.seq)).scalar_subquery()
+    return conn.execute(delete(change_log).where(change_log.c.created < cutoff, change_log.c.seq < newest)).rowcount
+
+@click.command("changes-prune")
+@click.option("--days", type=float, default=None, help="keep this many days of changes (CHANGES_RETENTION_DAYS by default)")
+@with_appcontext
+def prune_command(days):
+    """Deletes old entries from the change feed."""
+    days = current_app.config['CHANGES_RETENTION_DAYS'] if days is None else days
+    with db.engine.begin() as conn:
+        deleted = prune(conn, days)
+    click.echo(f"change_log pruned, {deleted} changes deleted")
@@ -0,0 +1,101 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+from models import db, Author
+
+# author_closure maintenance
+#
+# the table holds one row per (ancestor, descendant) pair, so it has to change whenever an author is
+# created, deleted or gets a new boss. the after_flush hook below applies those changes with a handful
+# of set based statements in the same transaction as the author write, a rollback undoes both.
+# routes keep declaring the "author" table for their etags, the closure only ever changes with it.
+#
+# writes that bypass the orm (core inserts in seed.py) have to call rebuild() in their transaction
+
+# every path from every author down through boss_id, the depth guard stops a cycle from recursing forever
+_REBUILD = """
+INSERT INTO author_closure (ancestor_id, descendant_id, depth)
+WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM author
+    UNION ALL
+    SELECT paths.ancestor_id, author.id, paths.depth + 1
+    FROM paths JOIN author ON author.boss_id = paths.descendant_id
+    WHERE paths.depth < (SELECT count(*) FROM author)
+)
+SELECT ancestor_id, descendant_id, depth FROM paths
+"""
+
+# cut the subtree of :node loose from everything above it, the paths inside the subtree stay
+_DETACH = """
+DELETE FROM author_closure
+WHERE descendant_id IN (SELECT descendant_id FROM author_closure WHERE ancestor_id = :node)
+  AND ancestor_id NOT IN (SELECT descendant_id FROM author_closure WHERE ancestor_id = :node)
+"""
+
+# hang the (detached) subtree of :node under :boss, every ancestor of the boss gets a path to every member
+_ATTACH = """
+INSERT INTO author_closure (ancestor_id, descendant_id, depth)
+SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+FROM author_closure AS above, author_closure AS below
+WHERE above.descendant_id = :boss AND below.ancestor_id = :node
+"""
+
+_INSERT_SELF = "INSERT INTO author_closure (ancestor_id, descendant_id, depth) VALUES (:node, :node, 0)"
+
+_DELETE_NODE = "DELETE FROM author_closure WHERE ancestor_id = :node OR descendant_id = :node"
+
+_IS_BELOW = "SELECT 1 FROM author_closure WHERE ancestor_id = :node AND descendant_id = :boss"
+
+
+def rebuild(conn):
+    """Recomputes author_closure from author.boss_id, returns the number of rows written."""
+    conn.execute(text("DELETE FROM author_closure"))
+    return conn.execute(text(_REBUILD)).rowcount
+
+def _parents_first(authors):
+    # a new author can only be attached once its (also new) boss has its own rows
+    pending = {author.id: author for author in authors}
+    ordered = []
+    while pending:
+        ready = [a for a in pending.values() if a.boss_id not in pending]
+        if not ready:
+            raise ValueError("new authors form a reporting cycle")
+        for author in ready:
+            ordered.append(author)
+            del pending[author.id]
+    return ordered
+
+@event.listens_for(Session, "after_flush")
+def _closure_after_flush(session, flush_context):
+    deleted = [obj for obj in session.deleted if isinstance(obj, Author)]
+    moved = [obj for obj in session.dirty if isinstance(obj, Author) and inspect(obj).attrs.boss_id.history.has_changes()]
+    created = [obj for obj in session.new if isinstance(obj, Author)]
+    if not (deleted or moved or created):
+        return
+
+    conn = session.connection()
+    # whoever reported to a deleted author is left as the root of their own subtree until they get a new boss
+    for author in deleted:
+        conn.execute(text(_DETACH), {"node": author.id})
+        conn.execute(text(_DELETE_NODE), {"node": author.id})
+    # new authors go in before the moves, a moved boss then takes its new reports along
+    for author in _parents_first(created):
+        conn.execute(text(_INSERT_SELF), {"node": author.id})
+        if author.boss_id is not None:
+            conn.execute(text(_ATTACH), {"node": author.id, "boss": author.boss_id})
+    for author in moved:
+        if author.boss_id is not None and conn.execute(text(_IS_BELOW), {"node": author.id, "boss": author.boss_id}).first():
+            raise ValueError(f"author {author.id} can't report to someone in their own subtree")
+        conn.execute(text(_DETACH), {"node": author.id})
+        if author.boss_id is not None:
+            conn.execute(text(_ATTACH), {"node": author.id, "boss": author.boss_id})
+
+
+@click.command("closure-rebuild")
+@with_appcontext
+def rebuild_command():
+    """Rebuilds author_closure from the author table."""
+    with db.engine.begin() as conn:
+        rows = rebuild(conn)
+    click.echo(f"author_closure rebuilt, {rows} rows")
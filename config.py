@@ -0,0 +1,141 @@
+import os
+
+# pick one with APP_MODE=dev|profile|prod (defaults to dev)
+#   dev:     everything on, echo every statement, sqltap dashboard, debug logging, the fake latency in viewtasks
+#   profile: prod settings but sqltap captures the queries of sampled requests or ones sent with the X-SQLTap header
+#   prod:    nothing extra in the request path
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
+    SQLALCHEMY_ECHO = False
+    DEBUG = False
+    LOG_LEVEL = 'WARNING'
+
+    # sqltap middleware: False, 'always' or 'sampled'
+    SQLTAP = False
+    SQLTAP_SAMPLE_RATE = 0.0
+    SQLTAP_HEADER = 'X-SQLTap'
+
+    # run on every new sqlite connection, WAL lets readers work while a write is in progress
+    # and synchronous=NORMAL is safe with WAL (only the last commits can be lost on power failure)
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,       # negative means KiB, so ~64MB of page cache per connection
+        'mmap_size': 268435456,     # 256MB of the db file memory mapped
+        'temp_store': 'MEMORY',
+    }
+    # every write of a request goes through one writer thread and connection per process, which commits
+    # whatever is waiting (up to WRITER_BATCH writes) in one transaction, see writer.py. a write that can't get
+    # into the queue of WRITER_QUEUE_SIZE within WRITER_QUEUE_TIMEOUT seconds is answered with a 503
+    WRITER_QUEUE_SIZE = 256
+    WRITER_BATCH = 64
+    WRITER_QUEUE_TIMEOUT = 1.0
+    # apply pending migrations from create_app
+    AUTO_MIGRATE = False
+    # create_app compiles every prebuilt statement (see queries.py), opens WARM_UP_CONNECTIONS pooled
+    # connections and loads the org index, so the first requests of a new worker don't pay for any of it
+    WARM_UP = True
+    WARM_UP_CONNECTIONS = 5
+
+    # response cache for the read heavy routes, None, 'lru' (in process) or 'shared'
+    # 'shared' uses redis at CACHE_REDIS_URL, or an in process stand-in when that is not set
+    CACHE_BACKEND = 'lru'
+    CACHE_TTL = 300
+    CACHE_MAX_ENTRIES = 10000
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    # worker processes serving the same database. serve.py exports its worker count as WEB_CONCURRENCY
+    # (uvicorn --workers reads the same variable), without it there is one. an in-process cache can't see
+    # the other workers' writes, so with more than one its entries are also keyed on table versions
+    CACHE_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+    # ETag/If-None-Match on the json routes, see etag.py
+    ETAGS = True
+
+    # per route latency/statement/row metrics and the slowest statements at /metrics, see metrics.py
+    # METRICS_N_PLUS_ONE runs of the same statement in one request flag the route as a likely n+1
+    METRICS = True
+    METRICS_STATEMENTS = 500     # distinct normalized statements kept
+    METRICS_TOP_STATEMENTS = 25  # of those, how many /metrics lists
+    METRICS_N_PLUS_ONE = 10
+
+    # brotli or gzip for json and text bodies of at least COMPRESS_MIN_SIZE bytes, see serialize.py
+    COMPRESS = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4  # 0-11, past 5 it gets much slower for a few percent
+
+    # seconds of simulated latency added to viewtasks
+    ARTIFICIAL_DELAY = 0
+
+    # async serving mode (asgi.py, started by serve.py), per worker process:
+    #   the async engine's pool bounds how many queries run at once, a request waiting for a connection gives up after the timeout
+    #   the routes that stay on flask run in a pool of WSGI_THREADS threads
+    # the number of worker processes is WEB_CONCURRENCY, so the database sees up to
+    # WEB_CONCURRENCY * (ASYNC_POOL_SIZE + ASYNC_POOL_MAX_OVERFLOW + WSGI_THREADS) connections
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL') # None means SQLALCHEMY_DATABASE_URI through aiosqlite
+    ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', 10))
+    ASYNC_POOL_MAX_OVERFLOW = int(os.environ.get('ASYNC_POOL_MAX_OVERFLOW', 10))
+    ASYNC_POOL_TIMEOUT = 10
+    WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+    # change feed (see changes.py)
+    #   a /changes/stream connection checks change_log every CHANGES_POLL_INTERVAL seconds, sends a keepalive
+    #   comment after CHANGES_KEEPALIVE quiet seconds and ends after CHANGES_STREAM_SECONDS (the browser
+    #   reconnects on its own after CHANGES_RETRY_MS), so a flask thread is never held forever
+    #   flask --app main changes-prune drops changes older than CHANGES_RETENTION_DAYS
+    CHANGES_POLL_INTERVAL = 0.5
+    CHANGES_KEEPALIVE = 15
+    CHANGES_STREAM_SECONDS = 300
+    CHANGES_RETRY_MS = 1000
+    CHANGES_RETENTION_DAYS = 7
+
+    # background reports (see jobs.py), run by flask --app main jobs-worker
+    #   JOBS_DIR holds the result files (instance/jobs when not set), POST /jobs answers 503 once JOBS_MAX_QUEUED are waiting
+    #   flask --app main jobs-prune drops finished jobs and their files after JOBS_RETENTION_DAYS
+    JOBS_DIR = os.environ.get('JOBS_DIR')
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+    JOBS_POLL_INTERVAL = 1
+    JOBS_MAX_QUEUED = 100
+    JOBS_RETENTION_DAYS = 7
+
+    # collaboration graph (see graph.py), kept in memory by every worker and caught up from the change feed
+    #   the changes applied since the last build are folded into its arrays once GRAPH_FOLD_SIZE pile up,
+    #   more than GRAPH_REBUILD_CHANGES pending changes rebuild it from scratch instead
+    GRAPH_FOLD_SIZE = 50000
+    GRAPH_REBUILD_CHANGES = 100000
+
+    # org chart history (see history.py), an as-of query replays at most ORG_SNAPSHOT_CHANGES changes
+    # on top of the nearest snapshot, the last ORG_HISTORY_CACHE moments asked for are kept replayed
+    ORG_SNAPSHOT_CHANGES = 1000
+    ORG_HISTORY_CACHE = 16
+
+class DevConfig(Config):
+    AUTO_MIGRATE = True
+    SQLALCHEMY_ECHO = True
+    DEBUG = True
+    LOG_LEVEL = 'DEBUG'
+    SQLTAP = 'always'
+    CACHE_BACKEND = None # see every query while developing
+    WARM_UP = False # the reloader restarts on every save
+    ARTIFICIAL_DELAY = 0.5
+
+class ProfileConfig(Config):
+    LOG_LEVEL = 'INFO'
+    SQLTAP = 'sampled'
+    SQLTAP_SAMPLE_RATE = float(os.environ.get('SQLTAP_SAMPLE_RATE', 0.01))
+
+class ProdConfig(Config):
+    pass
+
+CONFIGS = {
+    'dev': DevConfig,
+    'profile': ProfileConfig,
+    'prod': ProdConfig,
+}
+
+def get_config(mode=None):
+    mode = mode or os.environ.get('APP_MODE', 'dev')
+    if mode not in CONFIGS:
+        raise ValueError(f"unknown APP_MODE {mode!r}, expected one of {', '.join(CONFIGS)}")
+    return CONFIGS[mode]
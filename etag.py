@@ -0,0 +1,103 @@
+import hashlib
+from functools import lru_cache, wraps
+from flask import current_app, g, request
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from models import db, table_version
+
+# conditional GET for the json routes
+#
+# every orm flush bumps table_version for the tables it wrote, in the same transaction, so the
+# versions can never run ahead of or behind the data (and every worker process sees the same ones).
+# a route declares the tables it reads, its etag is a hash of those versions plus its arguments,
+# and a matching If-None-Match gets a 304 before the route runs a single query of its own.
+#
+# writes that bypass the orm have to call bump_versions() in their transaction
+
+
+def bump_versions(conn, tables):
+    if tables:
+        conn.execute(
+            update(table_version).
+            where(table_version.c.name.in_(sorted(tables))).
+            values(version=table_version.c.version + 1)
+        )
+
+def _written_tables(obj):
+    mapper = inspect(obj).mapper
+    tables = {mapper.local_table.name}
+    # many to many collections live in their own table (task_owners)
+    for rel in mapper.relationships:
+        if rel.secondary is not None and inspect(obj).attrs[rel.key].history.has_changes():
+            tables.add(rel.secondary.name)
+    return tables
+
+@event.listens_for(Session, "after_flush")
+def _versions_after_flush(session, flush_context):
+    tables = set()
+    for obj in session.new:
+        tables |= _written_tables(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tables |= _written_tables(obj)
+    for obj in session.deleted:
+        tables |= _written_tables(obj)
+        # deleting a task or an author also deletes its task_owners rows
+        tables |= {rel.secondary.name for rel in inspect(obj).mapper.relationships if rel.secondary is not None}
+    tables.discard(table_version.name)
+    bump_versions(session.connection(), tables)
+
+# one per route, built once like the statements in queries.py
+@lru_cache(maxsize=None)
+def versions_statement(tables):
+    return select(table_version.c.name, table_version.c.version).\
+        where(table_version.c.name.in_(sorted(tables) + ["_generation"]))
+
+_all_versions = select(table_version.c.name, table_version.c.version)
+
+def current_versions(tables=None):
+    """The versions of tables and _generation, of every table when tables is None."""
+    statement = _all_versions if tables is None else versions_statement(tables)
+    return dict(db.session.execute(statement).all())
+
+def etag_for(route, tables, versions, view_args, query_args):
+    """The etag of a route from table versions, url kwargs and (key, value) query pairs, shared with asgi.py."""
+    parts = [route, *(f"{t}={versions.get(t)}" for t in sorted(tables)), f"_generation={versions.get('_generation')}"]
+    parts += [f"{k}={view_args[k]}" for k in sorted(view_args)]
+    parts += [f"{k}={v}" for k, v in sorted(query_args)]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+
+def compute_etag(route, tables, view_args):
+    versions = current_versions(tables)
+    # the response cache keys its entries on the same read, see cache.py
+    g.table_versions = versions
+    return etag_for(route, tables, versions, view_args, request.args.items(multi=True))
+
+def conditional(route, *tables):
+    """Adds an ETag built from the versions of tables to the view's response and answers a matching If-None-Match with 304."""
+    tables = frozenset(tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('ETAGS', True):
+                # an app context held open around several requests (bench.py) would hand on the last read
+                g.pop('table_versions', None)
+                return view(*args, **kwargs)
+            etag = compute_etag(route, tables, kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # weak, the same etag stands for the identity, gzip and brotli bodies (see serialize.py)
+            response.set_etag(etag, weak=True)
+            # let the browser keep the body but always come back and ask
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        # asgi.py serves some of these routes itself and needs the same etag
+        wrapper.etag_route = route
+        wrapper.etag_tables = tables
+        return wrapper
+    return decorator
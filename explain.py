@@ -0,0 +1,132 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from models import db, Account, Author, org_index
+
+# EXPLAIN QUERY PLAN for every statement every route runs
+# flask --app main explain-routes
+# a plan line like "SCAN comment" (no index) is a full table scan, the command exits 1 if a route
+# outside FULL_SCAN_OK does one
+
+# these routes return every row of a table on purpose
+FULL_SCAN_OK = {"/", "/view/tasks"}
+
+def sample_args():
+    # the deepest author gives every hierarchy route something to walk, the lowest id on the last level
+    tree = org_index.get()
+    if len(tree.levels) < 2:
+        return None
+    node = min(tree.levels[-1], key=lambda n: tree.ids[n])
+    chain = tree.ancestors(node)
+    root = chain[-1] if chain else node
+    root_name = tree.names[root]
+    username = db.session.query(Account.username).join(Author).filter(Author.id == tree.ids[root]).scalar()
+    other = tree.names[tree.children[root][-1]] if tree.children[root] else root_name
+    return {
+        "name": tree.names[node], "id": tree.ids[node], "root": root_name, "other": other,
+        "username": username,
+    }
+
+def route_urls(args):
+    return [
+        ("/", {}),
+        ("/view/tasks", {}),
+        ("/view/tasks", {"group": "task", "limit": 50}),
+        ("/view/tasks", {"group": "task", "limit": 50, "viewer": args["username"]}),
+        ("/view/tasks/account", {"username": args["username"], "start_level": 1, "end_level": 2}),
+        ("/view/tasks/urgent", {}),
+        ("/view/tasks/urgent", {"viewer": args["username"], "limit": 50}),
+        ("/view/subordinates", {"name": args["root"], "start_level": 1, "end_level": 2}),
+        ("/view/subordinates/efficient", {"name": args["root"], "start_level": 1, "end_level": 2}),
+        ("/view/subordinates/count", {"name": args["root"]}),
+        ("/view/reportingstruct", {"name": args["name"]}),
+        ("/view/reportingstruct/cte", {"name": args["name"]}),
+        ("/view/closestshared/lead", {"name1": args["name"], "name2": args["other"]}),
+        ("/view/org/asof", {"at": "2025-06-01"}),
+        ("/view/org/asof/subordinates", {"name": args["root"], "at": "2025-06-01", "end_level": 2}),
+        ("/view/org/diff", {"from": "2025-01-01", "to": "2025-06-30"}),
+        ("/view/post", {"name": args["root"]}),
+        ("/view/author/name", {"name": args["name"]}),
+        (f"/view/author/{args['id']}", {}),
+        (f"/view/author/{args['id']}/tasks", {}),
+        (f"/view/author/{args['id']}/comments", {}),
+        (f"/view/author/{args['id']}/activity", {"start": "2025-01-01", "end": "2025-12-31"}),
+        (f"/view/author/{args['id']}/activity", {"start": "2025-01-01", "end": "2025-12-31", "subtree": 1}),
+        ("/view/leaderboard/impact", {}),
+        ("/view/leaderboard/impact", {"root": args["id"], "start": "2025-01-01", "end": "2025-12-31"}),
+        ("/search", {"q": "task"}),
+        ("/search", {"q": "ta*", "type": "task,comment"}),
+        ("/changes", {"since": 0}),
+        (f"/graph/author/{args['id']}/neighbors", {}),
+        (f"/graph/author/{args['id']}/collaborators", {"limit": 5}),
+        ("/graph/components", {"author": args["id"]}),
+        ("/graph/subgraph", {"author": args["id"], "depth": 2}),
+        ("/graph/subgraph", {}),
+    ]
+
+def capture_statements(client, url, query_string):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url, query_string=query_string)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return response.status_code, statements
+
+def query_plan(statement, parameters):
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    finally:
+        raw.close()
+
+def is_table_scan(detail):
+    # "SCAN <cte>" walks the rows of a recursive CTE, only scans of real tables count
+    # sqlalchemy aliases tables as <table>_1, <table>_2, ...
+    parts = detail.split()
+    if len(parts) < 2 or parts[0] != "SCAN" or "INDEX" in detail:
+        return False
+    name = parts[1]
+    return name in db.metadata.tables or name.rsplit("_", 1)[0] in db.metadata.tables
+
+
+@click.command("explain-routes")
+@with_appcontext
+def explain_command():
+    """Prints the query plan of every statement each route runs."""
+    args = sample_args()
+    if args is None:
+        raise click.ClickException("need at least one author with a boss, seed the database first")
+
+    client = current_app.test_client()
+    offenders = []
+    for url, query_string in route_urls(args):
+        status, statements = capture_statements(client, url, query_string)
+        label = url + ("?" + "&".join(f"{k}={v}" for k, v in query_string.items()) if query_string else "")
+        click.echo(f"== {label} [{status}] {len(statements)} statement(s)")
+        # N+1 routes run the same statement over and over, plan each distinct one once
+        distinct = {}
+        for statement, parameters in statements:
+            distinct.setdefault(statement, [parameters, 0])[1] += 1
+        for statement, (parameters, count) in distinct.items():
+            click.echo(f"  {'(x%d) ' % count if count > 1 else ''}" + " ".join(statement.split())[:160])
+            for detail in query_plan(statement, parameters):
+                scan = is_table_scan(detail)
+                click.echo(f"    {'!! ' if scan else '   '}{detail}")
+                if scan and url not in FULL_SCAN_OK:
+                    offenders.append((label, detail))
+
+    if offenders:
+        click.echo(f"\n{len(offenders)} full table scan(s):")
+        for label, detail in offenders:
+            click.echo(f"  {label}: {detail}")
+        raise SystemExit(1)
+    click.echo("\nevery route query uses an index")
@@ -1,6 +1,6 @@
 import { useState, useEffect } from 'react'
-import { fetchTasks } from '../services/taskService'
-import { groupTasksByHeadline } from '../utils/taskUtils'
+import { fetchTasks, fetchChangeHead, subscribeToChanges } from '../services/taskService'
+import { applyChange } from '../utils/taskUtils'
 
 export const useTasks = () => {
   const [tasks, setTasks] = useState([])
@@ -8,24 +8,39 @@ export const useTasks = () => {
   const [error, setError] = useState(null)
 
   useEffect(() => {
+    let cancelled = false
+    let unsubscribe = () => {}
+
     const loadTasks = async () => {
       try {
         setLoading(true)
+        // take the head of the change feed first, whatever is written while the pages load
+        // then comes through the feed as well (applying a change twice is harmless)
+        const head = await fetchChangeHead()
         const data = await fetchTasks()
         console.log("fetched data")
         console.log("--------------------------------------------------")
         console.log(data)
         // tasks to author is a many to many relationship
-        // a task can have many owners/authors
-        // what is returned by the API is by author, we want to render by task/headline
-        // thus data must be transformed so that one task have multiple authors
-        // storing data this way has issues with scalability as paginating the API will result in inconsistent owners for tasks
-        const grouped = groupTasksByHeadline(data)
-        console.log("transformed data")
-        console.log("--------------------------------------------------")
-        console.log(grouped)
+        // the API already returns one entry per task with all of its owners, so pagination never splits owners
+        // the cards only need the owner names
+        const grouped = data.map(task => ({
+          ...task,
+          authors: task.owners.map(owner => owner.name)
+        }))
+        if (cancelled) return
         setTasks(grouped)
         setError(null)
+        // from here on only the changes come over the wire instead of the whole list
+        unsubscribe = subscribeToChanges(
+          head,
+          change => setTasks(current => applyChange(current, change)),
+          () => {
+            // the server lost track of where we are, start over from a fresh copy
+            unsubscribe()
+            loadTasks()
+          }
+        )
       } catch (err) {
         console.error('Error fetching tasks:', err)
         setError(err.message)
@@ -35,6 +50,10 @@ export const useTasks = () => {
     }
 
     loadTasks()
+    return () => {
+      cancelled = true
+      unsubscribe()
+    }
   }, [])
 
   return { tasks, loading, error }
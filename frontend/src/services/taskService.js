@@ -1,7 +1,42 @@
 export const fetchTasks = async () => {
-    const response = await fetch('/view/tasks')
+    // the server returns one entry per task (owners and comments included) a page at a time
+    // keep following the cursor until there are no more pages
+    const tasks = []
+    let after = 0
+    while (after !== null) {
+      const params = new URLSearchParams({ group: 'task', after: after.toString() })
+      const response = await fetch(`/view/tasks?${params.toString()}`)
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`)
+      }
+      const page = await response.json()
+      tasks.push(...page.tasks)
+      after = page.next_after
+    }
+    return tasks
+  }
+
+// the seq of the newest change, taken before loading the tasks so nothing written in between is missed
+export const fetchChangeHead = async () => {
+    const response = await fetch('/changes')
     if (!response.ok) {
       throw new Error(`HTTP error! status: ${response.status}`)
     }
-    return response.json()
-  }
\ No newline at end of file
+    const data = await response.json()
+    return data.head
+  }
+
+// server-sent events of every task, comment and owner change after since
+// the browser reconnects on its own (resuming from the last event it got), onGone is called when
+// the server no longer has the changes we need (pruned or re-seeded) and the tasks have to be reloaded
+export const subscribeToChanges = (since, onChange, onGone) => {
+    const source = new EventSource(`/changes/stream?since=${since}`)
+    source.addEventListener('change', (event) => onChange(JSON.parse(event.data)))
+    source.onerror = () => {
+      // a 410 (or any other non-stream answer) closes the EventSource for good instead of retrying
+      if (source.readyState === EventSource.CLOSED) {
+        onGone()
+      }
+    }
+    return () => source.close()
+  }
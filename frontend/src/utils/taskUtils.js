@@ -26,4 +26,49 @@ export const groupTasksByHeadline = (data) => {
   }, {})
   
   return Object.values(grouped)
-}
\ No newline at end of file
+}
+
+// applies one change from /changes to the task list the hook keeps, returns a new list
+export const applyChange = (tasks, change) => {
+  const { table, op, data } = change
+  const withAuthors = (task) => ({ ...task, authors: task.owners.map(owner => owner.name) })
+
+  if (table === 'task') {
+    if (op === 'delete') {
+      return tasks.filter(task => task.id !== data.id)
+    }
+    const existing = tasks.find(task => task.id === data.id)
+    if (!existing) {
+      return [...tasks, withAuthors({ ...data, owners: [], comments: [] })]
+    }
+    return tasks.map(task => task.id === data.id ? { ...task, ...data } : task)
+  }
+
+  if (table === 'task_owners') {
+    return tasks.map(task => {
+      if (task.id !== data.task_id) return task
+      const owners = task.owners.filter(owner => owner.id !== data.author_id)
+      if (op === 'insert') {
+        owners.push({ id: data.author_id, name: data.name })
+      }
+      return withAuthors({ ...task, owners })
+    })
+  }
+
+  if (table === 'comment') {
+    // post comments don't show up on the tasks page
+    const comment = { id: data.id, content: data.content, author: data.author }
+    return tasks.map(task => {
+      const had = task.comments.some(c => c.id === data.id)
+      const belongs = op !== 'delete' && task.id === data.task_id
+      if (!had && !belongs) return task
+      if (had && belongs) {
+        return { ...task, comments: task.comments.map(c => c.id === data.id ? comment : c) }
+      }
+      const comments = task.comments.filter(c => c.id !== data.id)
+      return { ...task, comments: belongs ? [...comments, comment] : comments }
+    })
+  }
+
+  return tasks
+}
@@ -7,6 +7,7 @@ export default defineConfig({
   server: {
     proxy: {
       '/view': 'http://127.0.0.1:5000',
+      '/changes': 'http://127.0.0.1:5000',
     },
   },
 })
@@ -0,0 +1,353 @@
+import json
+import threading
+from itertools import chain
+from sqlalchemy import select, func, or_
+from models import task_owners, Author, Post, Comment
+import changes
+from etag import versions_statement
+
+# who works with whom, for the force directed team graph
+#
+# two authors are tied by every task they own together (SHARED_TASK each) and every comment one of them left
+# on a task or post the other owns (COMMENT each). the graph is built from three bulk queries (authors,
+# ownerships, comments grouped by item and commenter) into numpy arrays, no orm object is ever loaded:
+#   ids                      the author ids, sorted, an author's position in it is its node
+#   indptr/indices/weights   the weighted adjacency in CSR form, node i's neighbours are indices[indptr[i]:indptr[i+1]]
+# an "item" is a task (task_id * 2) or a post (post_id * 2 + 1), its owners are the task's owners or the post's author.
+#
+# it follows the change feed (changes.py) instead of being rebuilt: every request first reads the task_owners
+# and comment changes after the last seq it applied, works out which items they touched, and
+# re-reads just those items. an item's ties are a function of its owners and commenters, so the old ties are
+# subtracted and the new ones added to a small delta on top of the CSR arrays. replaying a change twice is
+# harmless, which is what makes the catch-up safe without locking anything (comments never move from one item to
+# another, the feed only has a changed comment's new item). once the delta or the number of
+# re-read items grows past GRAPH_FOLD_SIZE both are folded back into the arrays.
+# it is rebuilt from scratch after GRAPH_REBUILD_CHANGES pending changes, when the feed was pruned past it,
+# when the posts change (they aren't in the feed) and when a change involves an author it hasn't seen.
+# every worker process keeps its own copy, all of them follow the same feed.
+#
+#   pip install numpy   the /graph routes answer 501 without it
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SHARED_TASK = 2
+COMMENT = 1
+LOAD_BATCH = 100000
+ITEM_CHUNK = 500 # item ids per IN list, well under sqlite's bound variable limit
+
+
+def _owner_rows(tasks=None, posts=None):
+    # (item, author_id) ordered by item, every item when tasks and posts are None
+    owned = select((task_owners.c.task_id * 2).label("item"), task_owners.c.author_id)
+    posted = select((Post.id * 2 + 1).label("item"), Post.author_id)
+    if tasks is not None:
+        owned = owned.where(task_owners.c.task_id.in_(tasks))
+        posted = posted.where(Post.id.in_(posts))
+    union = owned.union_all(posted).subquery()
+    return select(union.c.item, union.c.author_id).order_by(union.c.item)
+
+def _comment_rows(tasks=None, posts=None):
+    # (item, commenter, comments) ordered by item
+    item = func.coalesce(Comment.task_id * 2, Comment.post_id * 2 + 1).label("item")
+    stmt = select(item, Comment.author_id, func.count()).group_by(item, Comment.author_id).order_by(item)
+    if tasks is not None:
+        return stmt.where(or_(Comment.task_id.in_(tasks), Comment.post_id.in_(posts)))
+    return stmt.where(or_(Comment.task_id.isnot(None), Comment.post_id.isnot(None)))
+
+def _fetch(conn, stmt, columns):
+    # flattened through fromiter, np.array on Row objects looks every one of them over for array attributes first
+    chunks = [np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, columns)
+              for rows in conn.execute(stmt).partitions(LOAD_BATCH)]
+    if not chunks:
+        return np.empty((0, columns), dtype=np.int64)
+    return np.concatenate(chunks)
+
+def _ranges(lo, hi):
+    """Every position in [lo[i], hi[i]) for all i, concatenated."""
+    counts = hi - lo
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    return offsets + np.arange(total)
+
+def _ties(own_item, own_node, com_item, com_node, com_count):
+    """(a, b, weight) of every tie the items make, both directions. own_item must be sorted."""
+    a, b, w = [], [], []
+    # owners of the same item, the rows of one item are next to each other
+    d = 1
+    while d < len(own_item):
+        same = np.flatnonzero(own_item[d:] == own_item[:-d])
+        if not len(same):
+            break
+        a.append(own_node[same])
+        b.append(own_node[same + d])
+        w.append(np.full(len(same), SHARED_TASK, dtype=np.int64))
+        d += 1
+    # every commenter with every owner of the item they commented on
+    lo = np.searchsorted(own_item, com_item, "left")
+    hi = np.searchsorted(own_item, com_item, "right")
+    rows = np.repeat(np.arange(len(com_item)), hi - lo)
+    owners = own_node[_ranges(lo, hi)]
+    commenters = com_node[rows]
+    keep = commenters != owners
+    a.append(commenters[keep])
+    b.append(owners[keep])
+    w.append(com_count[rows][keep] * COMMENT)
+    a, b, w = np.concatenate(a), np.concatenate(b), np.concatenate(w)
+    return np.concatenate([a, b]), np.concatenate([b, a]), np.concatenate([w, w])
+
+def _csr(n, a, b, w):
+    """indptr, indices and weights of the summed (a, b, w) triples, ties that sum to 0 dropped."""
+    keys, inverse = np.unique(a * n + b, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=w, minlength=len(keys)).astype(np.int64)
+    keep = sums != 0
+    keys, sums = keys[keep], sums[keep]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // n, minlength=n), out=indptr[1:])
+    return indptr, (keys % n).astype(np.int64), sums
+
+
+class Graph:
+    """One built collaboration graph plus the changes applied since, use it under CollaborationGraph's lock."""
+
+    def __init__(self, conn, fold_size):
+        self.fold_size = fold_size
+        # the feed position and the versions first, whatever commits while loading gets replayed (harmlessly)
+        self.seq = conn.execute(changes.bounds_statement()).one()[1] or 0
+        self.versions = dict(conn.execute(versions_statement(frozenset({"post"}))).all())
+        self.ids = _fetch(conn, select(Author.id).order_by(Author.id), 1)[:, 0]
+        owners = _fetch(conn, _owner_rows(), 2)
+        comments = _fetch(conn, _comment_rows(), 3)
+        self.own_item, self.own_node = owners[:, 0], self._nodes(owners[:, 1])
+        self.com_item, self.com_node, self.com_count = comments[:, 0], self._nodes(comments[:, 1]), comments[:, 2]
+        self.indptr, self.indices, self.weights = _csr(len(self.ids), *_ties(
+            self.own_item, self.own_node, self.com_item, self.com_node, self.com_count))
+        self.items = {}  # item -> (owner nodes, commenter nodes, comments) re-read since the last fold
+        self.delta = {}  # node -> {node: weight} added on top of the arrays
+        self._components = None # (min_weight, labels) until the next change
+
+    def _nodes(self, author_ids):
+        nodes = np.searchsorted(self.ids, author_ids)
+        nodes[nodes == len(self.ids)] = 0
+        if len(author_ids) and not np.array_equal(self.ids[nodes], author_ids):
+            raise KeyError("unknown author")
+        return nodes
+
+    def node(self, author_id):
+        i = int(np.searchsorted(self.ids, author_id))
+        return i if i < len(self.ids) and self.ids[i] == author_id else None
+
+    def stale(self, versions):
+        return versions != self.versions
+
+    def apply(self, conn, rows):
+        """Applies change_log rows, raises KeyError when they involve an author the graph doesn't know."""
+        touched = set()
+        for row in rows:
+            self.seq = row.seq
+            # a task's own columns don't tie anyone, deleting it deletes its task_owners rows which are in the feed
+            if row.table_name == "task":
+                continue
+            data = json.loads(row.data)
+            # task_owners rows and comments (deleted ones too) carry their task_id or post_id
+            if data.get("task_id") is not None:
+                touched.add(data["task_id"] * 2)
+            elif data.get("post_id") is not None:
+                touched.add(data["post_id"] * 2 + 1)
+        if not touched:
+            return
+        touched = np.array(sorted(touched), dtype=np.int64)
+        old = self._item_state(touched)
+        new = self._read_items(conn, touched)
+        a_old, b_old, w_old = _ties(*old)
+        a_new, b_new, w_new = _ties(*new)
+        for a, b, w in zip(np.concatenate([a_old, a_new]).tolist(), np.concatenate([b_old, b_new]).tolist(),
+                           np.concatenate([-w_old, w_new]).tolist()):
+            ties = self.delta.setdefault(a, {})
+            ties[b] = ties.get(b, 0) + w
+        own_item, own_node, com_item, com_node, com_count = new
+        for item in touched.tolist():
+            lo, hi = np.searchsorted(own_item, [item, item + 1])
+            clo, chi = np.searchsorted(com_item, [item, item + 1])
+            self.items[item] = (own_node[lo:hi], com_node[clo:chi], com_count[clo:chi])
+        self._components = None
+        if len(self.items) > self.fold_size or sum(map(len, self.delta.values())) > self.fold_size:
+            self.fold()
+
+    def _read_items(self, conn, items):
+        owners, comments = [], []
+        for start in range(0, len(items), ITEM_CHUNK):
+            chunk = items[start:start + ITEM_CHUNK]
+            tasks, posts = (chunk[chunk % 2 == 0] // 2).tolist(), (chunk[chunk % 2 == 1] // 2).tolist()
+            owners.append(_fetch(conn, _owner_rows(tasks, posts), 2))
+            comments.append(_fetch(conn, _comment_rows(tasks, posts), 3))
+        owners, comments = np.concatenate(owners), np.concatenate(comments)
+        # the chunks are in item order already, so are the rows
+        return owners[:, 0], self._nodes(owners[:, 1]), comments[:, 0], self._nodes(comments[:, 1]), comments[:, 2]
+
+    def _item_state(self, items):
+        """The owners and commenters the graph currently has for items, as the arrays _ties takes."""
+        base = np.array([item for item in items.tolist() if item not in self.items], dtype=np.int64)
+        own = _ranges(np.searchsorted(self.own_item, base, "left"), np.searchsorted(self.own_item, base, "right"))
+        com = _ranges(np.searchsorted(self.com_item, base, "left"), np.searchsorted(self.com_item, base, "right"))
+        parts = [(self.own_item[own], self.own_node[own], self.com_item[com], self.com_node[com], self.com_count[com])]
+        for item in items.tolist():
+            if item in self.items:
+                owners, commenters, counts = self.items[item]
+                parts.append((np.full(len(owners), item), owners, np.full(len(commenters), item), commenters, counts))
+        own_item, own_node, com_item, com_node, com_count = (np.concatenate(column) for column in zip(*parts))
+        order = np.argsort(own_item, kind="stable")
+        return own_item[order], own_node[order], com_item, com_node, com_count
+
+    def fold(self):
+        """Merges the re-read items and the delta back into the arrays."""
+        if self.items:
+            items = np.array(sorted(self.items), dtype=np.int64)
+            keep_own = ~np.isin(self.own_item, items)
+            keep_com = ~np.isin(self.com_item, items)
+            own_item, own_node, com_item, com_node, com_count = self._item_state(items)
+            own_item = np.concatenate([self.own_item[keep_own], own_item])
+            order = np.argsort(own_item, kind="stable")
+            self.own_item, self.own_node = own_item[order], np.concatenate([self.own_node[keep_own], own_node])[order]
+            com_item = np.concatenate([self.com_item[keep_com], com_item])
+            order = np.argsort(com_item, kind="stable")
+            self.com_item = com_item[order]
+            self.com_node = np.concatenate([self.com_node[keep_com], com_node])[order]
+            self.com_count = np.concatenate([self.com_count[keep_com], com_count])[order]
+            self.items = {}
+        if self.delta:
+            n = len(self.ids)
+            a = np.repeat(np.arange(n), np.diff(self.indptr))
+            da = np.array([x for x, row in self.delta.items() for _ in row], dtype=np.int64)
+            db_ = np.array([y for row in self.delta.values() for y in row], dtype=np.int64)
+            dw = np.array([w for row in self.delta.values() for w in row.values()], dtype=np.int64)
+            self.indptr, self.indices, self.weights = _csr(n, np.concatenate([a, da]), np.concatenate([self.indices, db_]),
+                                                           np.concatenate([self.weights, dw]))
+            self.delta = {}
+
+    def neighbors(self, node, min_weight=1):
+        """(nodes, weights) of everyone tied to node by at least min_weight, in node order."""
+        lo, hi = self.indptr[node], self.indptr[node + 1]
+        nodes, weights = self.indices[lo:hi], self.weights[lo:hi]
+        extra = self.delta.get(node)
+        if extra:
+            keys, inverse = np.unique(np.concatenate([nodes, list(extra)]), return_inverse=True)
+            weights = np.bincount(inverse, weights=np.concatenate([weights, list(extra.values())])).astype(np.int64)
+            nodes = keys
+        keep = weights >= min_weight
+        return nodes[keep], weights[keep]
+
+    def top(self, node, limit, min_weight=1):
+        """The limit strongest ties of node, strongest first (ties by node)."""
+        nodes, weights = self.neighbors(node, min_weight)
+        order = np.lexsort((nodes, -weights))[:limit]
+        return nodes[order], weights[order]
+
+    def components(self, min_weight=1):
+        """A component label per node (the smallest node in it) over the ties of at least min_weight."""
+        if self._components is not None and self._components[0] == min_weight:
+            return self._components[1]
+        self.fold()
+        n = len(self.ids)
+        keep = self.weights >= min_weight
+        a = np.repeat(np.arange(n), np.diff(self.indptr))[keep]
+        b = self.indices[keep]
+        labels = np.arange(n)
+        # min label propagation with pointer jumping, a handful of vectorized passes even for long chains
+        while True:
+            lowest = labels.copy()
+            np.minimum.at(lowest, a, labels[b])
+            lowest = lowest[lowest]
+            if np.array_equal(lowest, labels):
+                break
+            labels = lowest
+        self._components = (min_weight, labels)
+        return labels
+
+    def component_sizes(self, min_weight=1):
+        """The size of every component, largest first."""
+        return np.sort(np.unique(self.components(min_weight), return_counts=True)[1])[::-1]
+
+    def members(self, node, min_weight=1):
+        """The nodes in node's component, in node order."""
+        labels = self.components(min_weight)
+        return np.flatnonzero(labels == labels[node])
+
+    def subgraph(self, roots, depth, max_degree, max_nodes, min_weight=1):
+        """Nodes and links for rendering: breadth first from roots through each node's max_degree strongest ties."""
+        seen = {int(root): 0 for root in roots[:max_nodes]}
+        links = {}
+        frontier = list(seen)
+        for level in range(depth + 1):
+            following = []
+            for node in frontier:
+                nodes, weights = self.top(node, max_degree, min_weight)
+                for other, weight in zip(nodes.tolist(), weights.tolist()):
+                    if other not in seen:
+                        if level == depth or len(seen) >= max_nodes:
+                            continue
+                        seen[other] = level + 1
+                        following.append(other)
+                    links[(min(node, other), max(node, other))] = weight
+            frontier = following
+        return seen, links
+
+    def strongest(self, limit):
+        """The limit nodes with the most total tie weight."""
+        n = len(self.ids)
+        strength = np.bincount(np.repeat(np.arange(n), np.diff(self.indptr)), weights=self.weights, minlength=n)
+        for node, row in self.delta.items():
+            strength[node] += sum(row.values())
+        return np.argsort(-strength, kind="stable")[:limit]
+
+
+class CollaborationGraph:
+    """Holds the current Graph, builds it on first use and brings it up to date before every read."""
+
+    def __init__(self):
+        self.fold_size = 50000
+        self.rebuild_changes = 100000
+        self._graph = None
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        self.fold_size = config['GRAPH_FOLD_SIZE']
+        self.rebuild_changes = config['GRAPH_REBUILD_CHANGES']
+
+    @property
+    def available(self):
+        return np is not None
+
+    def current(self, conn):
+        """The graph with every committed change applied, call it and use the graph while holding self.lock."""
+        graph = self._graph
+        if graph is not None:
+            bounds = conn.execute(changes.bounds_statement()).one()
+            head = bounds[1] or 0
+            if changes.is_gone(graph.seq, bounds) or head - graph.seq > self.rebuild_changes or \
+                    graph.stale(dict(conn.execute(versions_statement(frozenset({"post"}))).all())):
+                graph = None
+            else:
+                try:
+                    while graph.seq < head:
+                        rows = conn.execute(changes.since_statement(), {"since": graph.seq, "limit": changes.CHANGE_LIMIT}).all()
+                        if not rows:
+                            break
+                        graph.apply(conn, rows)
+                except KeyError:
+                    # an author added since the build
+                    graph = None
+        if graph is None:
+            graph = self._graph = Graph(conn, self.fold_size)
+        return graph
+
+    def invalidate(self):
+        with self.lock:
+            self._graph = None
+
+
+collab_graph = CollaborationGraph()
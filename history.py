@@ -0,0 +1,299 @@
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, func, text, bindparam, union_all, literal_column, null, DateTime, event, inspect
+from sqlalchemy.orm import Session
+from models import db, Author, reporting_line, org_snapshot
+from orgtree import OrgTree
+from queries import prebuilt
+
+# org chart history, for the "time travel" org chart
+#
+# author.boss_id only knows the present, so sqlite triggers on author keep reporting_line: every insert opens a
+# line (author_id, boss_id, valid_from), every boss change ends the open line and opens the next one at the same
+# instant, a delete ends the open line. a line is valid from valid_from up to (not including) valid_to.
+# core writes are covered too, and a rolled back write takes its lines with it.
+#
+# the org as of a moment is the latest org_snapshot taken at or before it plus the lines that started or ended
+# between the two, replayed in order. both ends are an index range, so the cost is bounded by how many changes
+# sit between snapshots, never by the length of the history. a new snapshot is taken in the same transaction
+# as the boss change that brings the changes since the last one to ORG_SNAPSHOT_CHANGES, and
+# `flask --app main org-snapshot` takes one by hand (--rebuild takes them all again from the lines).
+#
+# a snapshot holds every change up to the moment it was taken and maybe some at exactly that moment (another
+# transaction in the same millisecond), so the replay starts at the snapshot's moment inclusive. replaying a change
+# twice is harmless, each one just sets or removes one author's boss.
+# the replayed state is keyed by its snapshot and last change, dragging the slider between two changes is a
+# lookup in the ORG_HISTORY_CACHE most recent ones. names are today's, a deleted author's name is gone with them.
+
+# the text sqlalchemy stores datetimes as (microseconds included), so the triggers' times compare like its own
+NOW = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+# the lines backfilled for authors that existed before the history did start here
+BEGINNING = datetime(1, 1, 1)
+
+TRIGGERS = {
+    "author_history_insert": f"""CREATE TRIGGER IF NOT EXISTS author_history_insert AFTER INSERT ON author BEGIN
+            INSERT INTO reporting_line (author_id, boss_id, valid_from) VALUES (new.id, new.boss_id, {NOW});
+        END""",
+    "author_history_update": f"""CREATE TRIGGER IF NOT EXISTS author_history_update AFTER UPDATE OF boss_id ON author
+        WHEN old.boss_id IS NOT new.boss_id BEGIN
+            UPDATE reporting_line SET valid_to = {NOW} WHERE author_id = old.id AND valid_to IS NULL;
+            INSERT INTO reporting_line (author_id, boss_id, valid_from) VALUES (new.id, new.boss_id, {NOW});
+        END""",
+    "author_history_delete": f"""CREATE TRIGGER IF NOT EXISTS author_history_delete AFTER DELETE ON author BEGIN
+            UPDATE reporting_line SET valid_to = {NOW} WHERE author_id = old.id AND valid_to IS NULL;
+        END""",
+}
+
+def drop_triggers(conn):
+    """For bulk loads that write their own history. Put them back with create_triggers()."""
+    for name in TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+def create_triggers(conn):
+    for sql in TRIGGERS.values():
+        conn.execute(text(sql))
+
+
+@prebuilt()
+def changes_statement():
+    # every line that started (closed 0) or ended (closed 1) from :since to :until, in the order it happened
+    # a boss change ends the old line and starts the new one at the same instant, the new one has the higher id
+    since, until = bindparam("since", type_=DateTime), bindparam("until", type_=DateTime)
+    started = select(
+        reporting_line.c.valid_from.label("at"), reporting_line.c.id, literal_column("0").label("closed"),
+        reporting_line.c.author_id, reporting_line.c.boss_id
+    ).where(reporting_line.c.valid_from.between(since, until))
+    ended = select(
+        reporting_line.c.valid_to, reporting_line.c.id, literal_column("1"), reporting_line.c.author_id, null()
+    ).where(reporting_line.c.valid_to.between(since, until))
+    changes = union_all(started, ended).subquery()
+    return select(changes).order_by(changes.c.at, changes.c.id, changes.c.closed)
+
+@prebuilt()
+def latest_snapshot_statement():
+    # the newest snapshot taken at or before :at
+    return select(org_snapshot.c.id, org_snapshot.c.taken).\
+        where(org_snapshot.c.taken <= bindparam("at", type_=DateTime)).\
+        order_by(org_snapshot.c.taken.desc(), org_snapshot.c.id.desc()).limit(1)
+
+@prebuilt()
+def changes_since_statement():
+    # how many changes the newest snapshot is behind
+    taken = select(func.max(org_snapshot.c.taken)).scalar_subquery()
+    return select(
+        select(func.count()).where(reporting_line.c.valid_from >= func.coalesce(taken, BEGINNING)).scalar_subquery(),
+        select(func.count()).where(reporting_line.c.valid_to >= func.coalesce(taken, BEGINNING)).scalar_subquery()
+    )
+
+# one statement, so the lines it reads are the ones committed when it writes
+_SNAPSHOT = f"""
+INSERT INTO org_snapshot (taken, authors, data)
+SELECT {NOW}, count(*), json_group_array(json_array(author_id, boss_id))
+FROM reporting_line WHERE valid_to IS NULL
+"""
+
+def snapshot(conn):
+    """Stores the current org chart as a snapshot."""
+    conn.execute(text(_SNAPSHOT))
+
+def rebuild_snapshots(conn, every):
+    """Replaces the snapshots with one every `every` changes through the whole history, returns how many."""
+    conn.execute(org_snapshot.delete())
+    bosses = {}
+    snapshots = []
+    pending = 0
+    rows = conn.execute(changes_statement(), {"since": BEGINNING, "until": datetime.max}).all()
+    # a change still to come can land in the current millisecond, a snapshot never claims to be past it
+    now = datetime.fromisoformat(conn.execute(text(f"SELECT {NOW}")).scalar())
+    for i, row in enumerate(rows):
+        if row.closed:
+            bosses.pop(row.author_id, None)
+        else:
+            bosses[row.author_id] = row.boss_id
+        pending += 1
+        # only once every change of that instant is in, just after it so the replay doesn't repeat them
+        last = i + 1 == len(rows)
+        if (pending >= every or last) and (last or rows[i + 1].at != row.at):
+            snapshots.append({"taken": min(row.at + timedelta(microseconds=1), now), "authors": len(bosses),
+                              "data": json.dumps(sorted(bosses.items()))})
+            pending = 0
+    if snapshots:
+        conn.execute(org_snapshot.insert(), snapshots)
+    return len(snapshots)
+
+def backfill(conn):
+    """Starts the history with everyone's current boss, as if it had always been so, returns how many lines."""
+    conn.execute(reporting_line.delete())
+    count = conn.execute(text(
+        "INSERT INTO reporting_line (author_id, boss_id, valid_from) SELECT id, boss_id, :beginning FROM author"
+    ).bindparams(bindparam("beginning", BEGINNING, type_=DateTime))).rowcount
+    rebuild_snapshots(conn, count or 1)
+    return count
+
+
+def _chart(bosses, names):
+    # depth first with reports in id order, without building a whole OrgTree, the full chart is what the slider asks for
+    reports = {}
+    for author_id in sorted(bosses):
+        boss = bosses[author_id]
+        reports.setdefault(boss if boss in bosses else None, []).append(author_id)
+    chart = []
+    stack = [(author_id, 0) for author_id in reversed(reports.get(None, ()))]
+    while stack:
+        author_id, depth = stack.pop()
+        node = names.node(author_id)
+        boss = bosses[author_id]
+        chart.append({"id": author_id, "name": names.names[node] if node is not None else None,
+                      "boss_id": boss if boss in bosses else None, "depth": depth})
+        stack.extend((report, depth + 1) for report in reversed(reports.get(author_id, ())))
+    return chart
+
+
+class _State:
+    __slots__ = ("bosses", "names", "tree", "chart")
+
+    def __init__(self, bosses):
+        self.bosses = bosses
+        self.names = None
+        self.tree = None
+        self.chart = None
+
+    def named(self, names):
+        # what's built from the bosses carries the names of one org index, a rename rebuilds it
+        if self.names is not names:
+            self.names = names
+            self.tree = None
+            self.chart = None
+
+
+class OrgHistory:
+    """Answers "who reported to whom at" from the snapshots, keeps the recently asked for moments in memory."""
+
+    def __init__(self):
+        self.snapshot_changes = 1000
+        self.cache_size = 16
+        # keyed by the time as well as the id, --rebuild hands the ids out again
+        self._snapshots = OrderedDict() # (snapshot id, taken) -> {author_id: boss_id}
+        self._states = OrderedDict()    # (snapshot, last change, changes) -> _State
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.snapshot_changes = config['ORG_SNAPSHOT_CHANGES']
+        self.cache_size = config['ORG_HISTORY_CACHE']
+
+    def _cache(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def _snapshot(self, executor, snapshot):
+        key = tuple(snapshot)
+        bosses = self._snapshots.get(key)
+        if bosses is None:
+            data = executor.execute(select(org_snapshot.c.data).where(org_snapshot.c.id == snapshot.id)).scalar_one()
+            bosses = self._cache(self._snapshots, key, dict(map(tuple, json.loads(data))))
+        return bosses
+
+    def _state(self, executor, at):
+        snapshot = executor.execute(latest_snapshot_statement(), {"at": at}).first()
+        since = snapshot.taken if snapshot is not None else BEGINNING
+        rows = executor.execute(changes_statement(), {"since": since, "until": at}).all()
+        key = (tuple(snapshot) if snapshot is not None else None, tuple(rows[-1][:3]) if rows else None, len(rows))
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                return state
+            bosses = dict(self._snapshot(executor, snapshot)) if snapshot is not None else {}
+            for row in rows:
+                if row.closed:
+                    bosses.pop(row.author_id, None)
+                else:
+                    bosses[row.author_id] = row.boss_id
+            return self._cache(self._states, key, _State(bosses))
+
+    def bosses_at(self, executor, at):
+        """{author_id: boss_id} of everyone who was there at the moment at."""
+        return self._state(executor, at).bosses
+
+    def tree_at(self, executor, at, names):
+        """An OrgTree of the org at the moment at, with the names of the names tree (today's org index)."""
+        state = self._state(executor, at)
+        with self._lock:
+            state.named(names)
+            if state.tree is None:
+                state.tree = OrgTree([(author_id, names.names[node] if node is not None else None, boss_id)
+                                      for author_id, boss_id, node in ((a, b, names.node(a)) for a, b in state.bosses.items())])
+            return state.tree
+
+    def chart_at(self, executor, at, names):
+        """Everyone there at the moment at as {"id", "name", "boss_id", "depth"}, in the order of an OrgTree."""
+        state = self._state(executor, at)
+        with self._lock:
+            state.named(names)
+            if state.chart is None:
+                state.chart = _chart(state.bosses, names)
+            return state.chart
+
+    def diff(self, executor, start, end):
+        """Who joined, left and changed boss between the moments start and end."""
+        before, after = self.bosses_at(executor, start), self.bosses_at(executor, end)
+        joined, left, moved = [], [], []
+        for author_id in sorted(before.keys() | after.keys()):
+            if author_id not in before:
+                joined.append((author_id, after[author_id]))
+            elif author_id not in after:
+                left.append((author_id, before[author_id]))
+            elif before[author_id] != after[author_id]:
+                moved.append((author_id, before[author_id], after[author_id]))
+        return joined, left, moved
+
+    def snapshot_if_due(self, conn):
+        """Takes a snapshot when ORG_SNAPSHOT_CHANGES changes have piled up since the newest one."""
+        started, ended = conn.execute(changes_since_statement()).one()
+        if started + ended >= self.snapshot_changes:
+            snapshot(conn)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._states.clear()
+
+
+org_history = OrgHistory()
+
+
+# runs in the transaction of the author write, after the triggers added its lines
+@event.listens_for(Session, "after_flush")
+def _history_after_flush(session, flush_context):
+    for obj in (*session.new, *session.deleted):
+        if isinstance(obj, Author):
+            break
+    else:
+        for obj in session.dirty:
+            if isinstance(obj, Author) and inspect(obj).attrs.boss_id.history.has_changes():
+                break
+        else:
+            return
+    org_history.snapshot_if_due(session.connection())
+
+
+@click.command("org-snapshot")
+@click.option("--rebuild", is_flag=True, help="replace every snapshot, one per ORG_SNAPSHOT_CHANGES changes of the whole history")
+@with_appcontext
+def snapshot_command(rebuild):
+    """Takes a snapshot of the org chart for the as-of queries."""
+    with db.engine.begin() as conn:
+        if rebuild:
+            count = rebuild_snapshots(conn, org_history.snapshot_changes)
+            click.echo(f"org snapshots rebuilt, {count} snapshots")
+        else:
+            snapshot(conn)
+            click.echo("org snapshot taken")
+    org_history.invalidate()
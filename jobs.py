@@ -0,0 +1,253 @@
+import csv
+import enum
+import io
+import json
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, select, insert, update, delete, func
+from models import db, Task, TaskState, job, apply_sqlite_pragmas
+import queries
+from serialize import dumpb, parse_fields
+
+# background reports
+#
+# POST /jobs queues a report as a row in the job table and returns right away, `flask --app main jobs-worker`
+# claims queued jobs one at a time and runs each in a pool of JOBS_WORKERS processes, so a report that
+# reads the whole company never holds a web worker (or the gil of one). a job streams its rows off a
+# server side cursor straight into JOBS_DIR/<id>.ndjson or .csv, nothing but the current batch is in memory,
+# and GET /jobs/<id>/result serves the finished file with range support so big downloads can resume.
+#
+#   queued -> running -> done | failed
+#
+# claiming is one UPDATE ... RETURNING, sqlite runs one writer at a time so two dispatchers can never claim
+# the same job. a worker that dies mid job leaves it running, the next jobs-worker start puts those back in
+# the queue (one jobs-worker per database).
+# a report is a function of the job's params returning (columns, statement, bind parameters, to_item), it raises ValueError
+# for bad params, which POST /jobs checks before queueing anything.
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+BATCH = 1000
+
+
+def _ints(params, **defaults):
+    try:
+        return [int(params.get(name, default)) for name, default in defaults.items()]
+    except (TypeError, ValueError):
+        raise ValueError(f"{', '.join(defaults)} must be integers")
+
+def _account_tasks(params):
+    # same rows as /view/tasks/account, the whole subtree by default
+    username = params.get("username")
+    if not isinstance(username, str) or not username:
+        raise ValueError("username is required")
+    start_level, end_level = _ints(params, start_level=1, end_level=1000)
+    fields = parse_fields(params.get("fields"), queries.ACCOUNT_TASK_FIELDS)
+    params = queries.account_tasks_params(username, start_level, end_level)
+    return fields, queries.account_tasks(fields), params, lambda row: queries.account_task(row, fields) if row.id is not None else None
+
+TASK_EXPORT_COLUMNS = {"id": Task.id, "headline": Task.headline, "content": Task.content, "state": Task.state,
+                       "date": Task.date, "creation_date": Task.creation_date, "version": Task.version}
+
+def _tasks(params):
+    # every task, optionally only those in one state
+    fields = parse_fields(params.get("fields"), tuple(TASK_EXPORT_COLUMNS))
+    stmt = select(*[TASK_EXPORT_COLUMNS[f] for f in fields]).order_by(Task.id)
+    if params.get("state") is not None:
+        try:
+            stmt = stmt.where(Task.state == TaskState(params["state"]))
+        except ValueError:
+            raise ValueError(f"unknown state {params['state']!r}")
+    return fields, stmt, {}, lambda row: dict(zip(fields, row))
+
+REPORTS = {
+    "account_tasks": _account_tasks,
+    "tasks": _tasks,
+}
+
+
+def validate(report, params, fmt):
+    if report not in REPORTS:
+        raise ValueError(f"report must be one of {', '.join(REPORTS)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    # like ?fields=, a comma separated string, or a list of names which is stored as one
+    fields = params.get("fields")
+    if isinstance(fields, list) and all(isinstance(name, str) for name in fields):
+        params["fields"] = ",".join(fields)
+    elif fields is not None and not isinstance(fields, str):
+        raise ValueError("fields must be a list of names or a comma separated string")
+    REPORTS[report](params)
+
+def enqueue(conn, report, params, fmt):
+    return conn.execute(insert(job).values(report=report, params=json.dumps(params), format=fmt).returning(job.c.id)).scalar_one()
+
+def queued_count(conn):
+    return conn.execute(select(func.count()).select_from(job).where(job.c.status == "queued")).scalar_one()
+
+def claim(conn):
+    """Marks the oldest queued job running and returns its id, None when the queue is empty."""
+    oldest = select(job.c.id).where(job.c.status == "queued").order_by(job.c.id).limit(1).scalar_subquery()
+    return conn.execute(
+        update(job).where(job.c.id == oldest, job.c.status == "queued").
+        values(status="running", started=func.current_timestamp()).
+        returning(job.c.id)
+    ).scalar()
+
+def requeue_running(conn):
+    return conn.execute(update(job).where(job.c.status == "running").values(status="queued", started=None)).rowcount
+
+def get(conn, job_id):
+    return conn.execute(select(job).where(job.c.id == job_id)).first()
+
+def status_payload(row):
+    payload = {
+        "id": row.id,
+        "report": row.report,
+        "params": json.loads(row.params),
+        "format": row.format,
+        "status": row.status,
+        "created": row.created,
+        "started": row.started,
+        "finished": row.finished,
+    }
+    if row.status == "done":
+        payload.update(rows=row.row_count, size=row.size, result=f"/jobs/{row.id}/result")
+    elif row.status == "failed":
+        payload["error"] = row.error
+    return payload
+
+def directory(app):
+    return app.config['JOBS_DIR'] or os.path.join(app.instance_path, "jobs")
+
+def result_path(directory, job_id, fmt):
+    return os.path.join(directory, f"{job_id}.{fmt}")
+
+
+def _cell(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def write(out, fmt, columns, rows, to_item):
+    """Writes the items of rows to the binary file out, returns how many were written."""
+    count = 0
+    if fmt == "csv":
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        for row in rows:
+            item = to_item(row)
+            if item is not None:
+                writer.writerow([_cell(item[name]) for name in columns])
+                count += 1
+        text.flush()
+        text.detach()
+        return count
+    for row in rows:
+        item = to_item(row)
+        if item is not None:
+            out.write(dumpb(item) + b"\n")
+            count += 1
+    return count
+
+
+# everything below runs in the pool processes, one engine per process
+_engines = {}
+
+def _init_worker():
+    # ctrl-c is for the dispatcher, it lets the running jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _engine(url, pragmas):
+    engine = _engines.get(url)
+    if engine is None:
+        engine = _engines[url] = create_engine(url)
+        apply_sqlite_pragmas(engine, pragmas)
+    return engine
+
+def run(url, pragmas, folder, job_id):
+    """Runs one claimed job, writes its result file and marks it done or failed."""
+    engine = _engine(url, pragmas)
+    with engine.connect() as conn:
+        row = get(conn, job_id)
+    path = result_path(folder, job_id, row.format)
+    try:
+        columns, stmt, params, to_item = REPORTS[row.report](json.loads(row.params))
+        # written next to the result and renamed at the end, a half written file is never served
+        with engine.connect() as conn, open(path + ".part", "wb") as out:
+            count = write(out, row.format, columns, conn.execute(stmt, params, execution_options={"yield_per": BATCH}), to_item)
+        os.replace(path + ".part", path)
+        values = {"status": "done", "row_count": count, "size": os.path.getsize(path)}
+    except Exception as e:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        values = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+    with engine.begin() as conn:
+        conn.execute(update(job).where(job.c.id == job_id).values(finished=func.current_timestamp(), **values))
+    return values["status"]
+
+
+@click.command("jobs-worker")
+@click.option("--workers", type=int, default=None, help="worker processes (JOBS_WORKERS by default)")
+@with_appcontext
+def worker_command(workers):
+    """Runs queued report jobs in a pool of worker processes until interrupted."""
+    config = current_app.config
+    workers = workers or config['JOBS_WORKERS']
+    folder = directory(current_app)
+    os.makedirs(folder, exist_ok=True)
+    # the workers open their own connections from the resolved url, a relative sqlite path means the instance folder here
+    url = db.engine.url.render_as_string(hide_password=False)
+    with db.engine.begin() as conn:
+        requeued = requeue_running(conn)
+    click.echo(f"jobs worker with {workers} processes, results in {folder}" + (f", {requeued} interrupted jobs requeued" if requeued else ""))
+
+    running = {}
+    # spawned so the pool processes start clean, with no open connections inherited from this one
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker) as pool:
+        try:
+            while True:
+                for future in [f for f in running if f.done()]:
+                    job_id = running.pop(future)
+                    error = future.exception()
+                    click.echo(f"job {job_id} {'crashed: ' + str(error) if error else future.result()}")
+                job_id = None
+                if len(running) < workers:
+                    with db.engine.begin() as conn:
+                        job_id = claim(conn)
+                if job_id is None:
+                    time.sleep(config['JOBS_POLL_INTERVAL'])
+                    continue
+                running[pool.submit(run, url, config['SQLITE_PRAGMAS'], folder, job_id)] = job_id
+        except KeyboardInterrupt:
+            # killed before they finish, they go back to the queue on the next start
+            click.echo(f"stopping once the {len(running)} running jobs finish")
+
+@click.command("jobs-prune")
+@click.option("--days", type=float, default=None, help="keep finished jobs this many days (JOBS_RETENTION_DAYS by default)")
+@with_appcontext
+def prune_command(days):
+    """Deletes finished jobs older than the retention and their result files."""
+    days = current_app.config['JOBS_RETENTION_DAYS'] if days is None else days
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    folder = directory(current_app)
+    with db.engine.begin() as conn:
+        old = conn.execute(
+            delete(job).where(job.c.status.in_(["done", "failed"]), job.c.finished < cutoff).returning(job.c.id, job.c.format)
+        ).all()
+    for job_id, fmt in old:
+        path = result_path(folder, job_id, fmt)
+        if os.path.exists(path):
+            os.remove(path)
+    click.echo(f"jobs pruned, {len(old)} jobs deleted")
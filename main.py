@@ -1,156 +1,53 @@
-from flask import Flask, render_template, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Blueprint, Response, current_app, render_template, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-from datetime import datetime, timezone
-import enum
-import sqltap.wsgi
-from sqlalchemy import func
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain
 import time
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-app.config['SQLALCHEMY_ECHO'] = True
-app.wsgi_app = sqltap.wsgi.SQLTapMiddleware(app.wsgi_app)
-db = SQLAlchemy(app)
-CORS(app) # Enable CORS for all routes
-
-class TaskState(enum.Enum):
-    NEW = "new"
-    IN_PROGRESS = "inprogress"
-    FINISHED = "finished"
-    DELAYED = "delayed"
-    CANCELED = "canceled"
-
-# Association table for the Many-to-Many relationship
-task_owners = db.Table('task_owners',
-    db.Column('author_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
-    db.Column('task_id', db.Integer, db.ForeignKey('task.id'), primary_key=True)
-)
-
-#all usernames are unique
-class Account(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(30), nullable=False, unique=True)
-    author = db.relationship("Author", back_populates="account") #creates an account field in author
-
-#author names are not unique
-class Author(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(30), nullable=False)
-    account = db.relationship("Account", back_populates='author', lazy=True) # allows me to get the Username Author.username.username, creates a author field in account
-    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False, unique=True) #this is the actual constraint, all users have a unique account
-    age = db.Column(db.Integer,nullable=False)
-    height = db.Column(db.Float,nullable=False)
-
-    # Self-referential relationship
-    boss_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=True) # when you create a subordinate it is associated to the boss and populates the subordinates list
-    subordinates = db.relationship('Author', backref=db.backref('boss', remote_side=[id])) #this is magically a list because of how sql alchemy works
-
-    # relationship to Task table, secondary the asociation table for many to many relationship, backref is a reverse relationship, 
-    tasks = db.relationship('Task', secondary=task_owners, backref=db.backref('owners', lazy='dynamic'), lazy=True)
-    posts = db.relationship('Post', backref='author', lazy=True)
-
-    @property
-    def peers(self):
-        """Returns a list of other Authors who share the same boss."""
-        if self.boss:
-            return [x for x in self.boss.subordinates if x.id != self.id]
-        return []
-    
-class Post(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    headline = db.Column(db.String(200), nullable=False)
-    content = db.Column(db.String(1000), nullable=False)
-    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False)
-
-class Task(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    headline = db.Column(db.String(200), nullable=False)
-    content = db.Column(db.String(1000), nullable=False)
-    date    = db.Column(db.DateTime,default=None,nullable=True)
-    creation_date = db.Column(db.DateTime,default=lambda: datetime.now(timezone.utc))
-    state = db.Column(db.Enum(TaskState), default=TaskState.NEW, nullable=False)
-
-    def __repr__(self):
-        return f'<Task {self.id}>'
-    
-class Comment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    content = db.Column(db.String(1000), nullable=False)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=True)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=True)
-    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False)
-
-    # Relationships for easier data traversal
-    #relationships create dynamic sql queries under the hood which is convenient.
-    author = db.relationship('Author', backref=db.backref('comments', lazy=True))
-    task = db.relationship('Task', backref=db.backref('comments', lazy=True)) # comment.task and task.comment, these are both the actual objects
-    post = db.relationship('Post', backref=db.backref('comments', lazy=True))
-
-with app.app_context():
-    # db.drop_all()
-    # db.create_all()
-    blockbuster = Account(username="blockbuster")
-    jones = Author(name="Jonny Jones", age=25, height=1.8, account=blockbuster)              # level 0
-
-    hermione = Account(username="hermione")
-    emily = Author(name="Emily Hynes", age=30, height=1.0, boss=jones, account=hermione)  # level 1
-
-    shaddowheart = Account(username="Shaddowheart")
-    acadia = Author(name="Acadia Philips", age=30, height=1.0, boss=jones, account=shaddowheart)  # level 1
-
-    ron = Account(username="ron")
-    steven = Author(name="Steven Butt", age=22, height=1.7, boss=emily,account=ron) # level 2
-
-    dumbeldore = Account(username="dumbledore")
-    evan = Author(name="Evan Butt", age=22, height=1.7, boss=emily, account=dumbeldore) # level 2
-
-    sauron = Account(username="sauron")
-    greg = Author(name="Gregory Butt", age=22, height=1.7, boss=acadia, account=sauron)  # level 2
-
-    paul = Account(username="Paul")
-    Kazawitch = Author(name="Kazawitch Haderach", age=22, height=1.7, boss=greg, account=paul)  # level 3
-
-    tanner = Account(username="Tanner")
-    jimbo = Author(name="Jimmy Jimbo", age=22, height=1.7, account=tanner)
-
-    due_date = datetime(2026, 1, 7, 9, 0)
-    meeting_prep_mon = Task(headline="monday meeting prep", content="lorem ipsum how the buisness makes money on monday", date=due_date, owners=[emily])
-
-    due_date3 = datetime(2026, 1, 9, 9, 0)
-    meeting_prep_wed = Task(headline="wednesday meeting prep", content="lorem ipsum how the buisness makes money on wednesday", date=due_date3, owners=[emily])
-
-    due_date2 = datetime(2026, 1, 14, 9, 0)
-    project_1   = Task(headline="project about stuff", content="stuff stuff stuff", date=due_date2,owners=[steven,evan])
-
-    due_date3 = datetime(2026, 1, 14, 9, 0)
-    project_2   = Task(headline="another project about stuff", content="another stuff stuff stuff", date=due_date3,owners=[acadia])
-
-    first_post = Post(headline="this is the first post", content="lorem ipsum how to make money",author=jones)
-
-    first_comment = Comment(content="example comment",task=meeting_prep_wed,author=jones)
-    second_comment = Comment(content="example comment",task=meeting_prep_wed,author=emily)
-
-    second_post = Post(headline="this is the second post", content="lorem ipsum how to make money",author=emily)
-
-    # db.session.add_all([blockbuster,hermione,shaddowheart,ron,dumbeldore,sauron,paul,tanner])
-    # db.session.add_all([jones, emily, steven, meeting_prep_mon, meeting_prep_wed, project_1, first_post, first_comment, second_comment, jimbo, second_post])
-    # db.session.commit()
-
-@app.route('/')
+from sqlalchemy import func, select
+from config import get_config
+from models import db, TaskState, TASK_PRIORITIES, task_owners, author_closure, author_activity, Account, Author, Post, Task, Comment, org_index, apply_sqlite_pragmas
+from cache import response_cache, cache_tags
+from etag import conditional, bump_versions, versions_statement
+import migrations
+import explain
+import closure
+import activity
+import queries
+import search
+import changes
+import jobs
+from graph import collab_graph
+import history
+from history import org_history
+from metrics import metrics
+from serialize import FastJSONProvider, compressor, fields_arg, fields_error
+from writer import writer, Rollback, WriterBusy
+
+bp = Blueprint('views', __name__)
+
+@bp.route('/')
 def index():
     tasks = Task.query.all()
     return render_template('index.html', tasks=tasks)
 
 # http://127.0.0.1:5000/view/tasks
 # SELECT task.id AS task_id, task.headline AS task_headline, task.content AS task_content, task.date AS task_date, task.creation_date AS task_creation_date, task.state AS task_state, author.id AS author_id, author.name AS author_name, author.account_id AS author_account_id, author.age AS author_age, author.height AS author_height, author.boss_id AS author_boss_id FROM task JOIN task_owners AS task_owners_1 ON task.id = task_owners_1.task_id JOIN author ON author.id = task_owners_1.author_id
-@app.route("/view/tasks")
+# http://127.0.0.1:5000/view/tasks?group=task&limit=50
+# http://127.0.0.1:5000/view/tasks?group=task&limit=50&after=50
+# http://127.0.0.1:5000/view/tasks?group=task&viewer=hermione   only the tasks of hermione and the people under them
+# http://127.0.0.1:5000/view/tasks?group=task&fields=id,headline,state   no owners or comments, so one statement instead of 3
+@bp.route("/view/tasks")
+@conditional("viewtasks", "task", "author", "task_owners", "comment", "account")
 def viewtasks():
+    if request.args.get('group') == 'task':
+        return _viewtasksbytask()
+
     #you may be wondering Author and Task already have a relationship so why do i need to join them.
     #the reason is to make one efficient query instead of N+1 queries
-    time.sleep(0.5)
+    if current_app.config['ARTIFICIAL_DELAY']:
+        time.sleep(current_app.config['ARTIFICIAL_DELAY'])
     tasks = db.session.query(Task, Author).join(Task.owners).all()
-    print(tasks)
+    current_app.logger.debug("tasks: %s", tasks)
     json = []
     for task in tasks:
         json.append({
@@ -164,67 +61,242 @@ def viewtasks():
     
     return jsonify(json)
 
+def _viewtasksbytask():
+    # one entry per task instead of one per (task, owner), comments are only serialized once
+    # always 3 queries no matter how many tasks, owners or comments are on the page:
+    #   1. the page of tasks, keyset paginated on task.id so a task and its owners never get split across pages
+    #   2. every owner of every task on the page
+    #   3. every comment (and its author name) on every task on the page
+    # the statements live in queries.py, asgi.py serves this same page without going through flask
+    try:
+        limit = int(request.args.get('limit', queries.TASKS_PAGE_LIMIT))
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"error": "limit and after must be integers"}), 400
+    limit = max(1, min(limit, queries.TASKS_PAGE_MAX_LIMIT))
+    try:
+        fields = fields_arg(queries.TASKS_PAGE_FIELDS)
+    except ValueError:
+        return jsonify(fields_error(queries.TASKS_PAGE_FIELDS)), 400
+
+    viewer = request.args.get('viewer')
+    tasks = db.session.execute(queries.tasks_page(viewer is not None), queries.tasks_page_params(after, limit, viewer)).all()
+    owners = comments = []
+    if tasks:
+        page = queries.page_ids(tasks[:limit])
+        if "owners" in fields:
+            owners = db.session.execute(queries.page_owners(), page).all()
+        if "comments" in fields:
+            comments = db.session.execute(queries.page_comments(), page).all()
+    return jsonify(queries.tasks_page_payload(tasks, owners, comments, limit, fields))
+
+TASKS_STREAM_BATCH = 1000
+
 # http://127.0.0.1:5000/view/tasks/account?username=hermione&start_level=1&end_level=2
-@app.route("/view/tasks/account")
+# http://127.0.0.1:5000/view/tasks/account?username=blockbuster&start_level=1&end_level=5&stream=1
+# http://127.0.0.1:5000/view/tasks/account?username=blockbuster&start_level=1&end_level=5&fields=headline,state
+@bp.route("/view/tasks/account")
+@conditional("viewtasksaccount", "author", "account", "task_owners", "task")
 def viewtasksaccount():
     username = request.args.get('username')
-    start_level = int(request.args.get('start_level',1))
-    end_level = int(request.args.get('end_level',1))
-
-    #first you need to get all subbordinates
-    #unpack the tuple :galaxy-brain:
-    author, = db.session.query(Author.name).join(Account).filter(Account.username == username).first()
-    print("--------------------------------------------------------------")
-    print(author)
-    subs = _viewsubordinates(author,start_level,end_level)
-
-    names = [sub["name"] for sub in subs]+[author]
-    print("--------------------------------------------------------------")
-    print(names)
-
-    #then you need to get all tasks for yourself and your subbordinates
-    #this uses author name which is not unique
-    results = db.session.query(Task, Author, Account).\
-        join(Task.owners).\
-        join(Account).\
-        filter(Author.name.in_(names)).all()
-
-    tasks = []
-
-    for row in results:
-        tasks.append({
-            "headline": row.Task.headline,
-            "content": row.Task.content,
-            "date": row.Task.date,
-            "state": row.Task.state.value,
-            "author": row.Author.name,
-            "account": row.Account.username
-        })
-    return jsonify(tasks)
+    try:
+        start_level = int(request.args.get('start_level',1))
+        end_level = int(request.args.get('end_level',1))
+    except ValueError:
+        return jsonify({"error": "start_level and end_level must be integers"}), 400
+
+    if not username:
+        return jsonify({"error": "no username provided"}), 400
+    try:
+        fields = fields_arg(queries.ACCOUNT_TASK_FIELDS)
+    except ValueError:
+        return jsonify(fields_error(queries.ACCOUNT_TASK_FIELDS)), 400
+
+    results = db.session.execute(
+        queries.account_tasks(fields),
+        queries.account_tasks_params(username, start_level, end_level),
+        execution_options={"yield_per": TASKS_STREAM_BATCH}
+    )
 
-@app.route("/view/tasks/update")
+    rows = iter(results)
+    first = next(rows, None)
+    if first is None:
+        return jsonify({"error": "Account not found"}), 404
+
+    tasks = (queries.account_task(row, fields) for row in chain([first], rows) if row.id is not None)
+
+    # big subtrees can be streamed out as they are read instead of building the whole list in memory
+    if request.args.get('stream'):
+        return Response(stream_with_context(queries.json_list_chunks(tasks, current_app.json.dumps)), mimetype='application/json')
+    return jsonify(list(tasks))
+
+# http://127.0.0.1:5000/view/tasks/urgent   the 20 most urgent open tasks in the company
+# http://127.0.0.1:5000/view/tasks/urgent?viewer=hermione&limit=50   only the tasks of hermione and the people under them
+# http://127.0.0.1:5000/view/tasks/urgent?after=<next of the previous page>
+@bp.route("/view/tasks/urgent")
+@conditional("viewtasksurgent", "task", "author", "task_owners", "account")
+def viewtasksurgent():
+    # new, in progress or delayed, highest priority first, then the soonest due date (undated last)
+    # read straight off ix_task_urgency a (state, priority) range at a time, see queries.urgent_tasks, nothing sorts the table
+    try:
+        limit = int(request.args.get('limit', queries.URGENT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, queries.URGENT_MAX_LIMIT))
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = queries.decode_urgent_cursor(after)
+        except ValueError:
+            return jsonify({"error": "after must be the next cursor of a previous page"}), 400
+    rows = queries.urgent_rows(db.session, limit, after, request.args.get('viewer'))
+    return jsonify(queries.urgent_payload(rows, limit))
+
+@bp.route("/view/tasks/update")
 def viewtasksupdate():
     name = request.args.get('name')
     state = request.args.get('state')
     content = request.args.get('content')
+    priority = request.args.get('priority')
 
     if not name:
         return jsonify({"error": "no name provided"}), 400
-
-    task = Task.query.filter_by(headline=name).first()
-    if not task:
+    if priority is not None:
+        try:
+            priority = int(priority)
+        except ValueError:
+            priority = None
+        if priority not in TASK_PRIORITIES:
+            return jsonify({"error": f"priority must be an integer from {TASK_PRIORITIES[0]} to {TASK_PRIORITIES[-1]}"}), 400
+
+    def update(session):
+        task = session.execute(select(Task).filter_by(headline=name).limit(1)).scalar()
+        if not task:
+            return False
+        if priority is not None:
+            task.priority = priority
+        if state is not None or priority is None:
+            newState = TaskState(state)
+            task.state = newState #this is the actual staged change
+        return True
+
+    try:
+        found = writer.run(update)
+    except WriterBusy:
+        return jsonify({"error": "too many writes waiting, try again"}), 503
+    if not found:
         return jsonify({"error": "task not found"}), 404
-    
-    newState = TaskState(state)
-    task.state = newState #this is the actual staged change
-    db.session.commit()
     return jsonify({"success": "succefully updated task"}),200
 
+TASKS_BATCH_MAX = 5000
+TASKS_BATCH_CHUNK = 500 # items per UPDATE, keeps every statement well under sqlite's bound variable limit
+
+# curl -X POST http://127.0.0.1:5000/view/tasks/update/batch -H "Content-Type: application/json" \
+#   -d '{"items": [{"task_id": 1, "expected_version": 1, "new_state": "finished"}, {"task_id": 2, "expected_version": 3, "content": "done"}]}'
+# {"items": [...], "atomic": true} applies nothing unless every item applies
+@bp.route("/view/tasks/update/batch", methods=["POST"])
+def viewtasksupdatebatch():
+    body = request.get_json(silent=True)
+    items = body.get("items") if isinstance(body, dict) else body
+    atomic = bool(body.get("atomic")) if isinstance(body, dict) else False
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "expected a non empty list of items"}), 400
+    if len(items) > TASKS_BATCH_MAX:
+        return jsonify({"error": f"at most {TASKS_BATCH_MAX} items per batch"}), 400
+
+    results = [None] * len(items)
+    pending = [] # (index, item) of every item that made it past validation
+    seen = set()
+    for i, raw in enumerate(items):
+        item, error = _batchitem(raw)
+        if error is None and item["id"] in seen:
+            error = "task_id appears more than once in the batch"
+        if error is not None:
+            results[i] = {"task_id": raw.get("task_id") if isinstance(raw, dict) else None, "status": "invalid", "error": error}
+            continue
+        seen.add(item["id"])
+        pending.append((i, item))
+
+    # optimistic concurrency: no locks and no version checks up front, a row is only written if its version is still the expected one
+    # all chunks run in the one write and are committed (in the writer's group commit) together, see writer.py
+    def update(session):
+        updated = {}
+        conn = session.connection()
+        # what the tasks add to the activity rollups before any state changes, see activity.py
+        restated = [item["id"] for _, item in pending if item["state"] is not None]
+        before = activity.contributions(conn, restated)
+        for start in range(0, len(pending), TASKS_BATCH_CHUNK):
+            chunk = [item for _, item in pending[start:start + TASKS_BATCH_CHUNK]]
+            updated.update(session.execute(queries.update_tasks(chunk)).all())
+
+        # one more query tells the stale items apart from the missing ones
+        missed = [item["id"] for _, item in pending if item["id"] not in updated]
+        current = {}
+        if missed:
+            current = dict(session.execute(select(Task.id, Task.version).where(Task.id.in_(missed))).all())
+
+        for i, item in pending:
+            if item["id"] in updated:
+                results[i] = {"task_id": item["id"], "status": "updated", "version": updated[item["id"]]}
+            elif item["id"] in current:
+                results[i] = {"task_id": item["id"], "status": "conflict", "version": current[item["id"]]}
+            else:
+                results[i] = {"task_id": item["id"], "status": "not_found"}
+
+        if atomic and len(updated) < len(items):
+            for result in results:
+                if result["status"] == "updated":
+                    result["status"] = "aborted"
+                    del result["version"]
+            raise Rollback(0)
+
+        if updated:
+            # core updates skip the orm flush events, tell etag.py, cache.py and activity.py ourselves (cache.py acts on commit)
+            bump_versions(conn, {"task"})
+            activity.apply(conn, before, activity.contributions(conn, restated))
+            session.info.setdefault("cache_tags", set()).update(f"task:{task_id}" for task_id in updated)
+        return len(updated)
+
+    try:
+        updated = writer.run(update)
+    except WriterBusy:
+        return jsonify({"error": "too many writes waiting, try again"}), 503
+    if atomic and updated < len(items):
+        return jsonify({"results": results, "updated": 0}), 409
+    return jsonify({"results": results, "updated": updated})
+
+def _batchitem(raw):
+    """Validates one batch item, returns ({id, version, state, priority, content}, None) or (None, error)."""
+    if not isinstance(raw, dict):
+        return None, "item must be an object"
+    task_id = raw.get("task_id")
+    version = raw.get("expected_version")
+    # type() and not isinstance(), json true/false are bools and bool is an int
+    if type(task_id) is not int or type(version) is not int:
+        return None, "task_id and expected_version must be integers"
+    state = raw.get("new_state")
+    priority = raw.get("new_priority")
+    content = raw.get("content")
+    if state is None and priority is None and content is None:
+        return None, "nothing to update, give new_state, new_priority and/or content"
+    if state is not None:
+        try:
+            state = TaskState(state)
+        except ValueError:
+            return None, f"unknown state {state!r}"
+    if priority is not None and (type(priority) is not int or priority not in TASK_PRIORITIES):
+        return None, f"new_priority must be an integer from {TASK_PRIORITIES[0]} to {TASK_PRIORITIES[-1]}"
+    if content is not None and (not isinstance(content, str) or len(content) > 1000):
+        return None, "content must be a string of at most 1000 characters"
+    return {"id": task_id, "version": version, "state": state, "priority": priority, "content": content}, None
+
 
 
 # http://127.0.0.1:5000/view/subordinates?name=Jonny+Jones
 # http://127.0.0.1:5000/view/subordinates?name=Jonny+Jones&start_level=1&end_level=2
-@app.route("/view/subordinates")
+@bp.route("/view/subordinates")
+@conditional("viewsubordinates", "author")
 def viewsubordinates():
     # Get the 'boss_id' from the URL query parameters (e.g., ?boss_id=1)
     name = request.args.get('name')
@@ -232,7 +304,6 @@ def viewsubordinates():
     end_level = int(request.args.get('end_level',1))
 
     if not name:
-        print("no name provided")
         return "no name provided"
     
     return _viewsubordinates(name,start_level,end_level)
@@ -241,30 +312,30 @@ def _viewsubordinates(name,start_level,end_level):
 
     subs = [] # suboardinate,suboardinate_id, boss, boss_id,depth
 
-    bfs = []
+    #this logic assumes names are unique, the first author with the name wins
+    #no sql here, the org index answers it straight from memory
+    tree = org_index.get()
+    node = tree.find(name)
+    if node is None:
+        return subs
 
-    bfs.append((name,0))
+    return _treesubordinates(tree,node,start_level,end_level)
 
-    while bfs:
-        curname,curlevel = bfs.pop(0)
-        if curlevel == end_level:
-            continue
-        #this logic assumes names are unique, this produces N+1 queries
-        subordinates = Author.query.filter_by(name=curname).all()[0].subordinates
-        for sub in subordinates:
-            if curlevel >= start_level-1:
-                subs.append({"name":sub.name,"id":sub.id,"boss":curname,"boss_id":sub.boss_id,"distance":curlevel+1})
-            bfs.append((sub.name,curlevel+1))
-
-    print(subs)
+def _treesubordinates(tree,node,start_level,end_level):
+    subs = []
+    for sub, distance in tree.subordinates(node,start_level,end_level):
+        boss = tree.parent[sub]
+        subs.append({"name":tree.names[sub],"id":tree.ids[sub],"boss":tree.names[boss],"boss_id":tree.ids[boss],"distance":distance})
     return subs
 
 
 
-# ai magic CTE
+# used to be a recursive CTE, now a lookup in author_closure (see closure.py)
 # http://127.0.0.1:5000/view/subordinates/efficient?username=hermione
 # http://127.0.0.1:5000/view/subordinates/efficient?username=hermione&start_level=1&end_level=2
-@app.route("/view/subordinates/efficient")
+@bp.route("/view/subordinates/efficient")
+@conditional("viewsubordinatesefficient", "author")
+@response_cache.cached("viewsubordinatesefficient", args={"name": None, "start_level": "1", "end_level": "1"})
 def viewsubordinatesefficient():
     # Get the 'boss_id' from the URL query parameters (e.g., ?boss_id=1)
     name = request.args.get('name')
@@ -274,159 +345,218 @@ def viewsubordinatesefficient():
     if not name:
         return jsonify({"error": "no name provided"}), 400
     
-    # Get the starting author
-    start_author = Author.query.filter_by(name=name).first()
-    if not start_author:
-        return jsonify({"error": "Author not found"}), 404
+    cache_tags(f"author-name:{name}")
 
-    # 1. Define the Anchor: Start with the specific author at level 0
-    subordinates = db.session.query(
-        Author.id,
-        Author.name,
-        Author.boss_id,
-        func.cast(0, db.Integer).label('level')
-    ).filter(Author.name == name).cte(name="subordinates", recursive=True)
-
-    # 2. Define the Recursive Step: Find subordinates of people already in the CTE
-    # Join on Author.boss_id == subordinates.c.id (find people whose boss is in the CTE)
-    subordinates = subordinates.union_all(
-        db.session.query(
-            Author.id,
-            Author.name,
-            Author.boss_id,
-            (subordinates.c.level + 1).label('level')
-        ).join(subordinates, Author.boss_id == subordinates.c.id)
-    )
+    # one indexed lookup in author_closure instead of a recursive walk, every author with the name is a starting point
+    # the levels above start_level are fetched too because the cached response depends on them
+    # (a new report under any of them changes the answer)
+    results = db.session.execute(queries.subordinates_by_name(), {"name": name, "end_level": end_level}).all()
+    if not results:
+        return jsonify({"error": "Author not found"}), 404
+    cache_tags(*[f"author:{r.id}" for r in results])
 
-    # 3. Execute the query, filter by level, and exclude the starting person (level 0)
-    results = db.session.query(
-        subordinates.c.name,
-        subordinates.c.level
-    ).filter(
-        subordinates.c.level >= start_level,
-        subordinates.c.level <= end_level
-    ).all()
-
-    # 4. Format results
-    subs = [{"name": r.name, "distance": r.level} for r in results]
+    # 4. Format results, excluding the starting person (level 0)
+    subs = [{"name": r.name, "distance": r.level} for r in results if r.level >= start_level]
     
     return jsonify(subs)
 
+# http://127.0.0.1:5000/view/subordinates/count?name=Jonny+Jones
+@bp.route("/view/subordinates/count")
+@conditional("viewsubordinatescount", "author")
+def viewsubordinatescount():
+    name = request.args.get('name')
+    if not name:
+        return jsonify({"error": "no name provided"}), 400
+
+    # the first author with the name, like the org index, and how many people sit at each level under them
+    rows = db.session.execute(queries.subordinate_levels(), {"name": name}).all()
+    if not rows:
+        return jsonify({"error": "Author not found"}), 404
+
+    levels = {depth: count for depth, count in rows if depth > 0}
+    return jsonify({
+        "direct": levels.get(1, 0),
+        "total": sum(levels.values()),
+        "by_level": levels
+    })
+
 # SELECT author.id AS author_id, author.name AS author_name, author.age AS author_age, author.height AS author_height, author.boss_id AS author_boss_id FROM author WHERE author.name = ?
 # http://127.0.0.1:5000/view/reportingstruct?name=Kazawitch+Haderach
-@app.route("/view/reportingstruct")
+@bp.route("/view/reportingstruct")
+@conditional("viewreportingstruct", "author")
 def viewreportingstruct():
     name = request.args.get('name')
     if name is None:
         return("no name provided")
 
-    auth = Author.query.filter_by(name=name).first()
-    if not auth:
+    tree = org_index.get()
+    node = tree.find(name)
+    if node is None:
         return jsonify({"error": "Author not found"}), 404
-        
-    ret = []
 
-    while auth.boss is not None:
-        auth = auth.boss # this magic does sql queries under the hood, this is a bit insane tbh, ctes are better
-        ret.append(auth.name)
+    # the org index walks the parent array instead of lazy loading auth.boss one query per hop
+    ret = [tree.names[boss] for boss in tree.ancestors(node)]
     return jsonify(ret)
 
 # http://127.0.0.1:5000/view/closestshared/lead?name1=Steven+Butt&name2=Evan+Butt -> emily hynes/hermione
 # http://127.0.0.1:5000/view/closestshared/lead?name1=Steven+Butt&name2=Jimmy+Jimbo -> invalid
-@app.route("/view/closestshared/lead")
+@bp.route("/view/closestshared/lead")
+@conditional("viewclosestsharedlead", "author", "account")
 def viewclosestsharedlead():
     name1 = request.args.get('name1')
     name2 = request.args.get('name2')
     if name1 is None or name2 is None:
         return("two names not provided")
     
-    reportingstruct = set([])
+    row = db.session.execute(queries.closest_shared_lead(), {"name1": name1, "name2": name2}).first()
+    if row is not None:
+        return jsonify({"closest lead":row.username})
 
-    auth = Author.query.filter_by(name=name1).first()
-    if not auth:
+    if db.session.execute(queries.names_found(), {"name1": name1, "name2": name2}).scalar() < len({name1, name2}):
         return jsonify({"error": "Author not found"}), 404
-    
-    reportingstruct.add(auth.account.username)
-
-    while auth.boss is not None:
-        auth = auth.boss # this magic, but it also does an sql query for every call, which is bad
-        reportingstruct.add(auth.account.username)
-
-    auth = Author.query.filter_by(name=name2).first()
-    if not auth:
-        return jsonify({"error": "Author not found"}), 404
-
-    while auth is not None and auth.account.username not in reportingstruct:
-        auth = auth.boss
-
-    if auth is not None and auth.account.username in reportingstruct:
-        return jsonify({"closest lead":auth.account.username})
-    
     return jsonify({"failed": "is this an invalid org structure?"})
 
-# magic i dont understand
-# WITH RECURSIVE ancestors(id, name, boss_id) AS (SELECT author.id AS id, author.name AS name, author.boss_id AS boss_id FROM author WHERE author.name = ? UNION ALL SELECT author.id AS author_id, author.name AS author_name, author.boss_id AS author_boss_id FROM author JOIN ancestors ON ancestors.boss_id = author.id) SELECT ancestors.name AS ancestors_name FROM ancestors
+# SELECT author.id, author.name FROM author JOIN author_closure ON author_closure.ancestor_id = author.id WHERE author_closure.descendant_id IN (SELECT author.id FROM author WHERE author.name = ?) ORDER BY author_closure.depth, author_closure.descendant_id
 # http://127.0.0.1:5000/view/reportingstruct/cte?name=Kazawitch+Haderach
-@app.route("/view/reportingstruct/cte")
+@bp.route("/view/reportingstruct/cte")
+@conditional("viewreportingstructcte", "author")
+@response_cache.cached("viewreportingstructcte", args={"name": None})
 def viewreportingstructcte():
     name = request.args.get('name')
     if not name:
         return jsonify({"error": "no name provided"}), 400
 
-    # 1. Define the Anchor: Start with the specific author
-    ancestors = db.session.query(
-        Author.id,
-        Author.name,
-        Author.boss_id
-    ).filter(Author.name == name).cte(name="ancestors", recursive=True)
-
-    # 2. Define the Recursive Step: Join the CTE with the Author table to find the boss
-    ancestors = ancestors.union_all(
-        db.session.query(
-            Author.id,
-            Author.name,
-            Author.boss_id
-        ).join(ancestors, ancestors.c.boss_id == Author.id)
-    )
+    cache_tags(f"author-name:{name}")
 
-    # 3. Execute the query and fetch results
-    results = db.session.query(ancestors.c.name).all()
+    # every ancestor of every author with the name, nearest first, one indexed lookup in author_closure
+    results = db.session.execute(queries.ancestors_by_name(), {"name": name}).all()
 
     if not results:
         return jsonify({"error": "Author not found"}), 404
+    cache_tags(*[f"author:{r.id}" for r in results])
 
     # results[0] is the author themselves, so we skip it to match your original logic
-    ret = [r[0] for r in results][1:]
+    ret = [r.name for r in results][1:]
     return jsonify(ret)
 
+def _moment(name):
+    """A moment from the query string, an ISO datetime or a date (the end of that day), now when it's missing.
+
+    Naive UTC like the stored times, ValueError when it doesn't parse."""
+    value = request.args.get(name)
+    if not value:
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+    if len(value) == 10:
+        return datetime.combine(date.fromisoformat(value), datetime.max.time())
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+# the org chart as it was, for the time travel slider, see history.py
+# http://127.0.0.1:5000/view/org/asof?at=2025-06-01   everyone there at the end of june 1st with their boss, in tree order
+# http://127.0.0.1:5000/view/org/asof?at=2025-06-01T09:30:00Z
+@bp.route("/view/org/asof")
+@conditional("vieworgasof", "author")
+def vieworgasof():
+    try:
+        at = _moment('at')
+    except ValueError:
+        return jsonify({"error": "at must be an ISO date or datetime"}), 400
+
+    # depth first, an author's reports come right after them
+    authors = org_history.chart_at(db.session, at, org_index.get())
+    return jsonify({"at": at, "authors": authors})
+
+# http://127.0.0.1:5000/view/org/asof/subordinates?name=Jonny+Jones&at=2025-06-01
+# http://127.0.0.1:5000/view/org/asof/subordinates?name=Jonny+Jones&at=2025-06-01&start_level=1&end_level=3
+@bp.route("/view/org/asof/subordinates")
+@conditional("vieworgasofsubordinates", "author")
+def vieworgasofsubordinates():
+    name = request.args.get('name')
+    if not name:
+        return jsonify({"error": "no name provided"}), 400
+    try:
+        at = _moment('at')
+        start_level = int(request.args.get('start_level', 1))
+        end_level = int(request.args.get('end_level', 1))
+    except ValueError:
+        return jsonify({"error": "at must be an ISO date or datetime, start_level and end_level integers"}), 400
+
+    # same answer as /view/subordinates, from the org as it was at that moment
+    tree = org_history.tree_at(db.session, at, org_index.get())
+    node = tree.find(name)
+    if node is None:
+        return jsonify({"error": "Author not found"}), 404
+    return jsonify(_treesubordinates(tree, node, start_level, end_level))
+
+# http://127.0.0.1:5000/view/org/diff?from=2025-01-01&to=2025-06-30   who joined, left or got a new boss in between
+# http://127.0.0.1:5000/view/org/diff?from=2025-01-01   up to now
+@bp.route("/view/org/diff")
+@conditional("vieworgdiff", "author")
+def vieworgdiff():
+    if not request.args.get('from'):
+        return jsonify({"error": "no from provided"}), 400
+    try:
+        start, end = _moment('from'), _moment('to')
+    except ValueError:
+        return jsonify({"error": "from and to must be ISO dates or datetimes"}), 400
+    if start > end:
+        return jsonify({"error": "from must not be after to"}), 400
+
+    joined, left, moved = org_history.diff(db.session, start, end)
+    tree = org_index.get()
+
+    def name(author_id):
+        node = tree.node(author_id)
+        return tree.names[node] if node is not None else None
+
+    return jsonify({
+        "from": start,
+        "to": end,
+        "joined": [{"id": a, "name": name(a), "boss_id": boss} for a, boss in joined],
+        "left": [{"id": a, "name": name(a), "boss_id": boss} for a, boss in left],
+        "moved": [{"id": a, "name": name(a), "from_boss_id": before, "to_boss_id": after} for a, before, after in moved],
+    })
+
 # http://127.0.0.1:5000/view/post?name=Jonny+Jones
-@app.route("/view/post")
+# http://127.0.0.1:5000/view/post?name=Jonny+Jones&fields=id,headline
+@bp.route("/view/post")
+@conditional("viewpost", "post", "author")
+@response_cache.cached("viewpost", args={"name": None, "fields": None})
 def viewpost():
     name = request.args.get('name')
     if name is None:
         return("no name provided")
-    
-    # SELECT post.id AS post_id, post.headline AS post_headline, post.content AS post_content, post.author_id AS post_author_id FROM post JOIN author ON author.id = post.author_id 
-    posts = db.session.query(Post).join(Author).filter(Author.name == name).all()
-    
-    # Return a list of dicts so Flask can serialize it
-    return jsonify([{
-        "id": post.id,
-        "headline": post.headline,
-        "content": post.content,
-        "author_id": post.author_id
-    } for post in posts])
+    try:
+        fields = fields_arg(queries.POST_FIELDS)
+    except ValueError:
+        return jsonify(fields_error(queries.POST_FIELDS)), 400
+
+    # SELECT author.id, post.id, post.headline, post.content FROM author LEFT OUTER JOIN post ON post.author_id = author.id WHERE author.name = ?
+    # the outer join also returns the authors without posts, the cache entry has to know about them too
+    # plain columns instead of Post entities, only the fields asked for (the post id is needed for the cache tags)
+    rows = db.session.execute(queries.author_posts(fields), {"name": name}).all()
+    posts = [row for row in rows if row[1] is not None]
+    cache_tags(f"author-name:{name}", *[f"post-author:{row[0]}" for row in rows], *[f"post:{row[1]}" for row in posts])
+
+    return jsonify([dict(zip(fields, row[2:])) for row in posts])
 
 # http://127.0.0.1:5000/view/author/name?name=Jonny+Jones
-@app.route("/view/author/name")
+@bp.route("/view/author/name")
+@conditional("viewauthorbyname", "author", "account")
+@response_cache.cached("viewauthorbyname", args={"name": None})
 def viewauthorbyname():
     name = request.args.get('name')
     if not name:
         return jsonify({"error": "no name provided"}), 400
 
-    author = Author.query.filter_by(name=name).join(Account).first()
+    cache_tags(f"author-name:{name}")
+    author = db.session.execute(queries.author(by_name=True), {"name": name}).first()
     if not author:
         return jsonify({"error": "Author not found"}), 404
+    # the boss tag covers the boss being renamed, the author's own tag covers reports coming and going
+    cache_tags(f"author:{author.id}", f"author:{author.boss_id}", f"account:{author.account_id}")
 
     return jsonify({
         "id": author.id,
@@ -434,50 +564,527 @@ def viewauthorbyname():
         "account_id": author.account_id,
         "age": author.age,
         "height": author.height,
-        "boss_name": author.boss.name if author.boss else None,
-        "subordinates_count": len(author.subordinates)
+        "boss_name": author.boss_name,
+        "subordinates_count": author.subordinates_count
     })
 
 # http://127.0.0.1:5000/view/author/1
-@app.route("/view/author/<int:id>")
+@bp.route("/view/author/<int:id>")
+@conditional("viewauthor", "author")
+@response_cache.cached("viewauthor")
 def viewauthor(id):
-    author = Author.query.get(id)
+    cache_tags(f"author:{id}")
+    author = db.session.execute(queries.author(), {"id": id}).first()
     if not author:
         return jsonify({"error": "Author not found"}), 404
+    cache_tags(f"author:{author.boss_id}")
 
     return jsonify({
         "id": author.id,
         "name": author.name,
         "age": author.age,
         "height": author.height,
-        "boss_name": author.boss.name if author.boss else None,
-        "subordinates_count": len(author.subordinates)
+        "boss_name": author.boss_name,
+        "subordinates_count": author.subordinates_count
     })
 
 # http://127.0.0.1:5000/view/author/1/tasks
-@app.route("/view/author/<int:id>/tasks")
+# http://127.0.0.1:5000/view/author/1/tasks?fields=id,headline,state
+@bp.route("/view/author/<int:id>/tasks")
+@conditional("viewauthortasks", "task", "task_owners")
+@response_cache.cached("viewauthortasks", args={"fields": None})
 def viewauthortasks(id):
-    # Get tasks where the author is one of the owners
-    tasks = db.session.query(Task).join(Task.owners).filter(Author.id == id).all()
-    
-    return jsonify([{
-        "headline": task.headline,
-        "content": task.content,
-        "state": task.state.value,
-        "date": task.date
-    } for task in tasks])
+    try:
+        fields = fields_arg(tuple(queries.AUTHOR_TASK_COLUMNS), queries.AUTHOR_TASK_FIELDS)
+    except ValueError:
+        return jsonify(fields_error(tuple(queries.AUTHOR_TASK_COLUMNS))), 400
+
+    # the task id comes last for the cache tags
+    tasks = db.session.execute(queries.author_tasks(fields), {"id": id}).all()
+    cache_tags(f"owner:{id}", *[f"task:{task[-1]}" for task in tasks])
+
+    return jsonify([dict(zip(fields, task)) for task in tasks])
 
 # http://127.0.0.1:5000/view/author/1/comments
-@app.route("/view/author/<int:id>/comments")
+@bp.route("/view/author/<int:id>/comments")
+@conditional("viewauthorcomments", "comment", "task", "post")
+@response_cache.cached("viewauthorcomments")
 def viewauthorcomments(id):
-    comments = Comment.query.filter_by(author_id=id).all()
-    
+    comments = db.session.execute(queries.author_comments(), {"id": id}).all()
+    cache_tags(f"comments-by:{id}",
+               *[f"task:{comment.task_id}" for comment in comments if comment.task_id],
+               *[f"post:{comment.post_id}" for comment in comments if comment.post_id])
+
     return jsonify([{
         "content": comment.content,
-        "on_task": comment.task.headline if comment.task else None,
-        "on_post": comment.post.headline if comment.post else None
+        "on_task": comment.on_task,
+        "on_post": comment.on_post
     } for comment in comments])
 
+ACTIVITY_DAYS = 365
+ACTIVITY_MAX_DAYS = 5 * 366
+LEADERBOARD_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
+# impact score from the readme: (tasks completed * 10) + (direct reports * 5) + (comments * 1)
+IMPACT_WEIGHTS = {"tasks_finished": 10, "reports": 5, "comments": 1}
+
+def _dayrange():
+    """start and end from the query string, the last ACTIVITY_DAYS days by default."""
+    end = request.args.get('end')
+    start = request.args.get('start')
+    end = date.fromisoformat(end) if end else datetime.now(timezone.utc).date()
+    start = date.fromisoformat(start) if start else end - timedelta(days=ACTIVITY_DAYS - 1)
+    if start > end or (end - start).days >= ACTIVITY_MAX_DAYS:
+        raise ValueError("bad range")
+    return start, end
+
+# http://127.0.0.1:5000/view/author/1/activity?start=2025-01-01&end=2025-12-31
+# http://127.0.0.1:5000/view/author/1/activity?subtree=1   the author and everyone under them added up
+@bp.route("/view/author/<int:id>/activity")
+@conditional("viewauthoractivity", "author", "task", "task_owners", "comment")
+def viewauthoractivity(id):
+    try:
+        start, end = _dayrange()
+    except ValueError:
+        return jsonify({"error": f"start and end must be YYYY-MM-DD, start <= end, at most {ACTIVITY_MAX_DAYS} days apart"}), 400
+
+    if db.session.get(Author, id) is None:
+        return jsonify({"error": "Author not found"}), 404
+
+    # straight from the (author, day) rollups, never from task/comment themselves
+    if request.args.get('subtree'):
+        columns = [func.sum(author_activity.c[column]).label(column) for column in activity.COLUMNS]
+        rows = db.session.query(author_activity.c.day, *columns).\
+            join(author_closure, author_closure.c.descendant_id == author_activity.c.author_id).\
+            filter(author_closure.c.ancestor_id == id, author_activity.c.day.between(start, end)).\
+            group_by(author_activity.c.day).order_by(author_activity.c.day).all()
+    else:
+        rows = db.session.query(author_activity.c.day, *(author_activity.c[column] for column in activity.COLUMNS)).\
+            filter(author_activity.c.author_id == id, author_activity.c.day.between(start, end)).\
+            order_by(author_activity.c.day).all()
+
+    days = [{"day": row.day.isoformat(), **{column: row._mapping[column] for column in activity.COLUMNS}} for row in rows]
+    return jsonify({
+        "author_id": id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        # only days with any activity are listed, the rest are zeros
+        "days": days,
+        "totals": {column: sum(day[column] for day in days) for column in activity.COLUMNS}
+    })
+
+# http://127.0.0.1:5000/view/leaderboard/impact
+# http://127.0.0.1:5000/view/leaderboard/impact?limit=20&start=2025-01-01&end=2025-06-30&root=1   only people under author 1
+@bp.route("/view/leaderboard/impact")
+@conditional("viewleaderboardimpact", "author", "task", "task_owners", "comment")
+def viewleaderboardimpact():
+    try:
+        limit = max(1, min(int(request.args.get('limit', LEADERBOARD_LIMIT)), LEADERBOARD_MAX_LIMIT))
+        root = request.args.get('root')
+        root = int(root) if root else None
+        # all time unless a range is asked for
+        start, end = _dayrange() if request.args.get('start') or request.args.get('end') else (None, None)
+    except ValueError:
+        return jsonify({"error": "limit and root must be integers, start and end YYYY-MM-DD"}), 400
+
+    totals = db.session.query(
+        author_activity.c.author_id,
+        func.sum(author_activity.c.tasks_finished).label('tasks_finished'),
+        func.sum(author_activity.c.comments).label('comments')
+    )
+    if start is not None:
+        totals = totals.filter(author_activity.c.day.between(start, end))
+    totals = totals.group_by(author_activity.c.author_id).subquery()
+
+    reports = db.session.query(Author.boss_id.label('author_id'), func.count().label('reports')).\
+        filter(Author.boss_id.isnot(None)).group_by(Author.boss_id).subquery()
+
+    tasks_finished = func.coalesce(totals.c.tasks_finished, 0)
+    comments = func.coalesce(totals.c.comments, 0)
+    direct_reports = func.coalesce(reports.c.reports, 0)
+    score = tasks_finished * IMPACT_WEIGHTS["tasks_finished"] + direct_reports * IMPACT_WEIGHTS["reports"] + comments * IMPACT_WEIGHTS["comments"]
 
+    query = db.session.query(Author.id, Author.name, tasks_finished, direct_reports, comments, score).\
+        outerjoin(totals, totals.c.author_id == Author.id).\
+        outerjoin(reports, reports.c.author_id == Author.id)
+    if root is not None:
+        query = query.join(author_closure, author_closure.c.descendant_id == Author.id).filter(author_closure.c.ancestor_id == root)
+    rows = query.order_by(score.desc(), Author.id).limit(limit).all()
+
+    return jsonify([{
+        "id": author_id,
+        "name": name,
+        "tasks_finished": finished,
+        "reports": n_reports,
+        "comments": n_comments,
+        "impact": impact
+    } for author_id, name, finished, n_reports, n_comments, impact in rows])
+
+
+GRAPH_LIMIT = 10
+GRAPH_MAX_LIMIT = 1000
+GRAPH_TABLES = ("task_owners", "comment", "post", "author")
+
+def _graphargs(**defaults):
+    """The integer query args with their (default, max), every one at least 1 (except depth), ValueError otherwise."""
+    args = {}
+    for name, (default, most) in defaults.items():
+        value = int(request.args.get(name, default))
+        if value < (0 if name == "depth" else 1):
+            raise ValueError(name)
+        args[name] = min(value, most)
+    return args
+
+def _graphauthors(graph, nodes, **columns):
+    tree = org_index.get()
+    authors = []
+    for i, node in enumerate(nodes.tolist() if hasattr(nodes, "tolist") else nodes):
+        author_id = int(graph.ids[node])
+        tree_node = tree.node(author_id)
+        author = {"id": author_id, "name": tree.names[tree_node] if tree_node is not None else None}
+        for name, values in columns.items():
+            author[name] = values[i]
+        authors.append(author)
+    return authors
+
+def _graphnode(graph, id):
+    """The graph node of author id, False for an author with no ties yet, None for no such author."""
+    node = graph.node(id)
+    if node is None:
+        return False if org_index.get().node(id) is not None else None
+    return node
+
+_GRAPH_UNAVAILABLE = {"error": "the collaboration graph needs numpy (pip install numpy)"}
+
+# http://127.0.0.1:5000/graph/author/1/neighbors   everyone author 1 shares a task or comments with, and how much
+# http://127.0.0.1:5000/graph/author/1/neighbors?min_weight=4
+@bp.route("/graph/author/<int:id>/neighbors")
+@conditional("graphneighbors", *GRAPH_TABLES)
+def graphneighbors(id):
+    if not collab_graph.available:
+        return jsonify(_GRAPH_UNAVAILABLE), 501
+    try:
+        args = _graphargs(min_weight=(1, 1 << 62))
+    except ValueError:
+        return jsonify({"error": "min_weight must be a positive integer"}), 400
+    with collab_graph.lock:
+        graph = collab_graph.current(db.session.connection())
+        node = _graphnode(graph, id)
+        if node is None:
+            return jsonify({"error": "Author not found"}), 404
+        nodes, weights = graph.neighbors(node, args["min_weight"]) if node is not False else ([], [])
+        neighbors = _graphauthors(graph, nodes, weight=list(map(int, weights)))
+    return jsonify({"id": id, "neighbors": neighbors})
+
+# http://127.0.0.1:5000/graph/author/1/collaborators   the 10 people author 1 works with the most
+# http://127.0.0.1:5000/graph/author/1/collaborators?limit=25
+@bp.route("/graph/author/<int:id>/collaborators")
+@conditional("graphcollaborators", *GRAPH_TABLES)
+def graphcollaborators(id):
+    if not collab_graph.available:
+        return jsonify(_GRAPH_UNAVAILABLE), 501
+    try:
+        args = _graphargs(limit=(GRAPH_LIMIT, GRAPH_MAX_LIMIT), min_weight=(1, 1 << 62))
+    except ValueError:
+        return jsonify({"error": "limit and min_weight must be positive integers"}), 400
+    with collab_graph.lock:
+        graph = collab_graph.current(db.session.connection())
+        node = _graphnode(graph, id)
+        if node is None:
+            return jsonify({"error": "Author not found"}), 404
+        nodes, weights = graph.top(node, args["limit"], args["min_weight"]) if node is not False else ([], [])
+        collaborators = _graphauthors(graph, nodes, weight=list(map(int, weights)))
+    return jsonify({"id": id, "collaborators": collaborators})
+
+# http://127.0.0.1:5000/graph/components   how many separate groups of collaborators there are and how big
+# http://127.0.0.1:5000/graph/components?author=1&min_weight=3&limit=100   plus up to 100 members of author 1's group
+@bp.route("/graph/components")
+@conditional("graphcomponents", *GRAPH_TABLES)
+def graphcomponents():
+    if not collab_graph.available:
+        return jsonify(_GRAPH_UNAVAILABLE), 501
+    try:
+        args = _graphargs(limit=(GRAPH_LIMIT, GRAPH_MAX_LIMIT), min_weight=(1, 1 << 62))
+        author = request.args.get('author')
+        author = int(author) if author else None
+    except ValueError:
+        return jsonify({"error": "limit, min_weight and author must be positive integers"}), 400
+    with collab_graph.lock:
+        graph = collab_graph.current(db.session.connection())
+        sizes = graph.component_sizes(args["min_weight"])
+        payload = {
+            "authors": int(sizes.sum()),
+            "components": len(sizes),
+            "isolated": int((sizes == 1).sum()),
+            "largest": sizes[:args["limit"]].tolist(),
+        }
+        if author is not None:
+            node = _graphnode(graph, author)
+            if node is None:
+                return jsonify({"error": "Author not found"}), 404
+            members = graph.members(node, args["min_weight"]) if node is not False else []
+            payload["component"] = {"size": max(len(members), 1), "members": _graphauthors(graph, members[:args["limit"]])}
+    return jsonify(payload)
+
+# http://127.0.0.1:5000/graph/subgraph   the 200 busiest collaborators and the ties between them, for react-force-graph
+# http://127.0.0.1:5000/graph/subgraph?author=1&depth=2&max_degree=8&max_nodes=300   around author 1
+@bp.route("/graph/subgraph")
+@conditional("graphsubgraph", *GRAPH_TABLES)
+def graphsubgraph():
+    # every node keeps only its max_degree strongest ties, so a hub doesn't pull in half the company
+    if not collab_graph.available:
+        return jsonify(_GRAPH_UNAVAILABLE), 501
+    try:
+        args = _graphargs(depth=(2, 4), max_degree=(10, 100), max_nodes=(200, 2000), min_weight=(1, 1 << 62))
+        author = request.args.get('author')
+        author = int(author) if author else None
+    except ValueError:
+        return jsonify({"error": "depth, max_degree, max_nodes, min_weight and author must be positive integers"}), 400
+    with collab_graph.lock:
+        graph = collab_graph.current(db.session.connection())
+        if author is not None:
+            node = _graphnode(graph, author)
+            if node is None:
+                return jsonify({"error": "Author not found"}), 404
+            roots, depth = [node] if node is not False else [], args["depth"]
+        else:
+            roots, depth = graph.strongest(args["max_nodes"]).tolist(), 0
+        levels, links = graph.subgraph(roots, depth, args["max_degree"], args["max_nodes"], args["min_weight"])
+        nodes = _graphauthors(graph, list(levels), level=list(levels.values()))
+        links = [{"source": int(graph.ids[a]), "target": int(graph.ids[b]), "weight": weight} for (a, b), weight in links.items()]
+    return jsonify({"nodes": nodes, "links": links})
+
+
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# http://127.0.0.1:5000/search?q=deadline
+# http://127.0.0.1:5000/search?q=stat*&type=task,comment&limit=10   prefix search over tasks and comments only
+# http://127.0.0.1:5000/search?q=deadline&cursor=<next_cursor of the previous page>
+@bp.route("/search")
+@conditional("search", "task", "post", "comment")
+def searchview():
+    q = search.fts_query(request.args.get('q'))
+    if q is None:
+        return jsonify({"error": "q is required"}), 400
+    kinds = [kind for kind in request.args.get('type', '').split(',') if kind]
+    if any(kind not in search.KINDS for kind in kinds):
+        return jsonify({"error": f"type must be a comma separated list of {', '.join(search.KINDS)}"}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_LIMIT)), SEARCH_MAX_LIMIT))
+        cursor = request.args.get('cursor')
+        after = search.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "limit must be an integer and cursor a next_cursor from an earlier page"}), 400
+
+    results, next_cursor = search.search(db.session.connection(), q, kinds, limit, after)
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+
+CHANGES_MAX_LIMIT = 5000
+
+# http://127.0.0.1:5000/changes             just the head seq, take it before loading the tasks
+# http://127.0.0.1:5000/changes?since=120   the changes after seq 120, oldest first, follow up with since=<head> while more is true
+@bp.route("/changes")
+def viewchanges():
+    try:
+        since = changes.parse_since(request.args.get('since'))
+        limit = max(1, min(int(request.args.get('limit', changes.CHANGE_LIMIT)), CHANGES_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"error": "since and limit must be non negative integers"}), 400
+
+    bounds = db.session.execute(changes.bounds_statement()).one()
+    if since is None:
+        return jsonify({"changes": [], "head": bounds[1] or 0, "more": False})
+    if changes.is_gone(since, bounds):
+        return jsonify(changes.gone_payload(since, bounds)), 410
+
+    rows = db.session.execute(changes.since_statement(), {"since": since, "limit": limit + 1}).all()
+    items = [changes.change(row) for row in rows[:limit]]
+    return jsonify({"changes": items, "head": items[-1]["seq"] if items else since, "more": len(rows) > limit})
+
+# http://127.0.0.1:5000/changes/stream             new changes as server-sent events, new EventSource('/changes/stream')
+# http://127.0.0.1:5000/changes/stream?since=120   the changes after seq 120 first (a reconnecting EventSource sends Last-Event-ID instead)
+@bp.route("/changes/stream")
+def viewchangesstream():
+    try:
+        since = changes.parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except ValueError:
+        return jsonify({"error": "since must be a non negative integer"}), 400
+
+    bounds = db.session.execute(changes.bounds_statement()).one()
+    if since is None:
+        since = bounds[1] or 0
+    elif changes.is_gone(since, bounds):
+        return jsonify(changes.gone_payload(since, bounds)), 410
+    stream = _changestream(db.engine, since, current_app.config, current_app.json.dumps)
+    return Response(stream, mimetype='text/event-stream', headers=changes.SSE_HEADERS)
+
+def _changestream(engine, since, config, dumps):
+    # runs after the request (and its session) is gone, every poll takes a pooled connection just for its one query
+    yield changes.sse_retry(config['CHANGES_RETRY_MS'])
+    now = time.monotonic()
+    deadline, quiet = now + config['CHANGES_STREAM_SECONDS'], now
+    while time.monotonic() < deadline:
+        with engine.connect() as conn:
+            rows = conn.execute(changes.since_statement(), {"since": since, "limit": changes.CHANGE_LIMIT}).all()
+        for row in rows:
+            yield changes.sse_event(changes.change(row), dumps)
+            since = row.seq
+        if rows:
+            quiet = time.monotonic()
+        elif time.monotonic() - quiet >= config['CHANGES_KEEPALIVE']:
+            # also how a closed connection gets noticed
+            yield changes.SSE_KEEPALIVE
+            quiet = time.monotonic()
+        if len(rows) < changes.CHANGE_LIMIT:
+            time.sleep(config['CHANGES_POLL_INTERVAL'])
+
+
+# curl -X POST http://127.0.0.1:5000/jobs -H "Content-Type: application/json" \
+#   -d '{"report": "account_tasks", "params": {"username": "blockbuster", "end_level": 10}, "format": "csv"}'
+# reports: account_tasks (username, start_level, end_level, fields) and tasks (state, fields), format ndjson (default) or csv
+@bp.route("/jobs", methods=["POST"])
+def createjob():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "expected an object with report, params and format"}), 400
+    report, params, fmt = body.get("report"), body.get("params", {}), body.get("format", "ndjson")
+    try:
+        jobs.validate(report, params, fmt)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    max_queued = current_app.config['JOBS_MAX_QUEUED']
+    def enqueue(session):
+        conn = session.connection()
+        if jobs.queued_count(conn) >= max_queued:
+            return None
+        return jobs.enqueue(conn, report, params, fmt)
+
+    try:
+        job_id = writer.run(enqueue)
+    except WriterBusy:
+        job_id = None
+    if job_id is None:
+        return jsonify({"error": "too many reports waiting, try again later"}), 503
+    return jsonify({"id": job_id, "status": "queued", "url": f"/jobs/{job_id}"}), 202, {"Location": f"/jobs/{job_id}"}
+
+# http://127.0.0.1:5000/jobs/1
+@bp.route("/jobs/<int:id>")
+def viewjob(id):
+    row = jobs.get(db.session.connection(), id)
+    if row is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(jobs.status_payload(row))
+
+# http://127.0.0.1:5000/jobs/1/result   supports Range, curl -C - resumes a download
+@bp.route("/jobs/<int:id>/result")
+def viewjobresult(id):
+    row = jobs.get(db.session.connection(), id)
+    if row is None:
+        return jsonify({"error": "job not found"}), 404
+    if row.status != "done":
+        return jsonify({"error": f"job is {row.status}", "status": row.status}), 409
+    path = jobs.result_path(jobs.directory(current_app), id, row.format)
+    try:
+        return send_file(path, mimetype=jobs.FORMATS[row.format], as_attachment=True,
+                         download_name=f"{row.report}-{id}.{row.format}", conditional=True)
+    except FileNotFoundError:
+        return jsonify({"error": "the result was pruned, queue the report again"}), 410
+
+
+# http://127.0.0.1:5000/cache/stats
+@bp.route("/cache/stats")
+def cachestats():
+    return jsonify(response_cache.stats())
+
+# http://127.0.0.1:5000/writer/stats   queue depth and wait times of the writer, see writer.py
+@bp.route("/writer/stats")
+def writerstats():
+    return jsonify(writer.stats())
+
+# http://127.0.0.1:5000/metrics   prometheus scrape target, see metrics.py
+@bp.route("/metrics")
+def viewmetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def create_app(mode=None, **overrides):
+    config = get_config(mode)
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(overrides)
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+
+    # sqltap is dev/profile only, in prod nothing wraps the wsgi app
+    if app.config['SQLTAP'] == 'always':
+        import sqltap.wsgi
+        app.wsgi_app = sqltap.wsgi.SQLTapMiddleware(app.wsgi_app)
+    elif app.config['SQLTAP'] == 'sampled':
+        from profiling import SampledSQLTapMiddleware
+        app.wsgi_app = SampledSQLTapMiddleware(app.wsgi_app,
+                                               sample_rate=app.config['SQLTAP_SAMPLE_RATE'],
+                                               header=app.config['SQLTAP_HEADER'])
+
+    db.init_app(app)
+    response_cache.configure(app.config)
+    collab_graph.configure(app.config)
+    org_history.configure(app.config)
+    app.json = FastJSONProvider(app)
+    compressor.init_app(app)
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+        metrics.init_app(app, db.engine)
+        writer.init_app(app, db.engine)
+        if metrics.enabled:
+            if writer.engine is not db.engine:
+                metrics.instrument(writer.engine)
+            metrics.collector(writer.metric_lines)
+        if app.config['AUTO_MIGRATE']:
+            migrations.upgrade(db.engine)
+
+    CORS(app) # Enable CORS for all routes
+    app.register_blueprint(bp)
+    app.cli.add_command(migrations.upgrade_command)
+    app.cli.add_command(migrations.version_command)
+    app.cli.add_command(explain.explain_command)
+    app.cli.add_command(closure.rebuild_command)
+    app.cli.add_command(activity.rebuild_command)
+    app.cli.add_command(search.reindex_command)
+    app.cli.add_command(changes.prune_command)
+    app.cli.add_command(jobs.worker_command)
+    app.cli.add_command(jobs.prune_command)
+    app.cli.add_command(history.snapshot_command)
+
+    if app.config['WARM_UP']:
+        with app.app_context():
+            warm_up(app)
+    return app
+
+def warm_up(app):
+    """Opens the pool's connections, runs every prebuilt statement once and loads the org index, before the first request."""
+    with db.engine.connect() as conn:
+        if migrations.current_version(conn) != migrations.HEAD:
+            # a fresh or outdated db on its way to db-upgrade, the statements would fail
+            app.logger.info("schema isn't at head, skipping the warm up")
+            return
+    # all checked out at once so the pool really opens that many (and runs the pragmas on each)
+    conns = [db.engine.connect() for _ in range(app.config['WARM_UP_CONNECTIONS'])]
+    for conn in conns:
+        conn.close()
+    versions = [versions_statement(view.etag_tables) for view in app.view_functions.values() if hasattr(view, "etag_tables")]
+    count = queries.warm_up(db.session, versions)
+    db.session.rollback()
+    org_index.get()
+    if collab_graph.available:
+        with collab_graph.lock:
+            collab_graph.current(db.session.connection())
+        db.session.rollback()
+    app.logger.info("warmed up %d statements and %d connections", count, len(conns))
+
+# no module level app, importing main (asgi.py, bench.py, seed.py) must not build and warm up one of its own.
+# flask --app main finds create_app by itself
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app = create_app()
+    app.run(debug=app.config['DEBUG'])
\ No newline at end of file
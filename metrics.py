@@ -0,0 +1,330 @@
+import re
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from time import perf_counter
+from flask import g, request
+from sqlalchemy import event
+from serialize import FastJSONProvider
+
+# always-on request and sql instrumentation, rendered for prometheus at /metrics
+#
+# every request gets a small _Request in a context variable (so it follows flask's threads and the asgi
+# event loop's tasks alike). the cursor events add each statement's time and rows to it, the json provider
+# adds the time spent serializing, and when the request ends it is folded into the per route totals under
+# one lock acquisition. per route:
+#   latency, statements and rows returned as histograms, seconds in the database and in json serialization
+# across routes:
+#   the statements (normalized, literals and IN lists collapsed) that took the most total time
+# n+1 detection: a route that runs the same normalized statement METRICS_N_PLUS_ONE or more times in one
+# request is running it once per row of some earlier result, so its statement count grows with the result.
+# those routes and statements are exported (and logged once) as app_route_n_plus_one_statements.
+#
+# everything lives in process memory and is bounded (routes come from the url map, statements are capped at
+# METRICS_STATEMENTS), each worker process reports its own numbers like any prometheus client would.
+# statements run outside a request (cli commands, the change stream's polls) aren't counted.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+_current = ContextVar("metrics_request", default=None)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += n
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class _Route:
+    __slots__ = ("statuses", "latency", "statements", "rows", "db_seconds", "serialize_seconds", "n_plus_one")
+
+    def __init__(self):
+        self.statuses = {}
+        self.latency = _Histogram(LATENCY_BUCKETS)
+        self.statements = _Histogram(STATEMENT_BUCKETS)
+        self.rows = _Histogram(ROW_BUCKETS)
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.n_plus_one = {} # normalized statement -> most runs seen in one request
+
+
+class _Request:
+    __slots__ = ("started", "statements", "rows", "db_seconds", "serialize_seconds", "by_statement", "executing")
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.by_statement = {} # normalized statement -> [runs, seconds, slowest run]
+        self.executing = None
+
+
+class _CountingCursor:
+    """Wraps a dbapi cursor that returns rows, so the rows and the time spent fetching them are counted too
+    (sqlite does most of a query's work while the rows are fetched, not in execute)."""
+    __slots__ = ("_cursor", "_request", "_entry", "_run")
+
+    def __init__(self, cursor, request_, entry, run):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_request", request_)
+        object.__setattr__(self, "_entry", entry)
+        object.__setattr__(self, "_run", run) # seconds of this one run so far
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def _fetched(self, started, rows):
+        elapsed = perf_counter() - started
+        self._request.db_seconds += elapsed
+        self._request.rows += rows
+        self._entry[1] += elapsed
+        object.__setattr__(self, "_run", self._run + elapsed)
+        if self._run > self._entry[2]:
+            self._entry[2] = self._run
+
+    def fetchone(self):
+        started = perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        started = perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),             # string literals
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),          # numbers
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"), # IN (?, ?, ...) of any length
+    (re.compile(r"\s+"), " "),
+]
+
+@lru_cache(maxsize=2048)
+def normalize(statement):
+    """The statement with literals and IN lists collapsed, so the same query with different values is one entry."""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class TimedJSONProvider(FastJSONProvider):
+    """The app's json provider, plus the time spent encoding is added to the current request."""
+
+    def dumpb(self, obj):
+        current = _current.get()
+        if current is None:
+            return super().dumpb(obj)
+        started = perf_counter()
+        try:
+            return super().dumpb(obj)
+        finally:
+            current.serialize_seconds += perf_counter() - started
+
+
+class Metrics:
+
+    def __init__(self):
+        self.enabled = False
+        self.max_statements = 500
+        self.top_statements = 25
+        self.n_plus_one = 10
+        self.logger = None
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._statements = {} # normalized statement -> [runs, seconds, slowest]
+        self._collectors = [] # functions yielding more lines for render, like the writer's
+
+    def configure(self, config):
+        self.enabled = config.get('METRICS', True)
+        self.max_statements = config.get('METRICS_STATEMENTS', 500)
+        self.top_statements = config.get('METRICS_TOP_STATEMENTS', 25)
+        self.n_plus_one = config.get('METRICS_N_PLUS_ONE', 10)
+
+    def init_app(self, app, engine):
+        """Hooks the app's request lifecycle and the engine's cursor events, call it inside an app context."""
+        self.configure(app.config)
+        if not self.enabled:
+            return
+        self.logger = app.logger
+        app.json = TimedJSONProvider(app)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        self.instrument(engine)
+
+    def instrument(self, engine):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    # used directly by asgi.py for the routes it answers itself
+    def begin(self):
+        current = _Request()
+        _current.set(current)
+        return current
+
+    def end(self, route, status, current):
+        _current.set(None)
+        latency = perf_counter() - current.started
+        flagged = []
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = _Route()
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency.observe(latency)
+            stats.statements.observe(current.statements)
+            stats.rows.observe(current.rows)
+            stats.db_seconds += current.db_seconds
+            stats.serialize_seconds += current.serialize_seconds
+            for statement, (runs, seconds, slowest) in current.by_statement.items():
+                self._add_statement(statement, runs, seconds, slowest)
+                if runs >= self.n_plus_one:
+                    if statement not in stats.n_plus_one:
+                        flagged.append((statement, runs))
+                    stats.n_plus_one[statement] = max(runs, stats.n_plus_one.get(statement, 0))
+        for statement, runs in flagged:
+            self.logger.warning("possible n+1 in %s: %d runs of %s", route, runs, statement)
+
+    def _add_statement(self, statement, runs, seconds, slowest):
+        entry = self._statements.get(statement)
+        if entry is None:
+            if len(self._statements) >= self.max_statements:
+                # make room by forgetting the statement with the least total time
+                del self._statements[min(self._statements, key=lambda s: self._statements[s][1])]
+            entry = self._statements[statement] = [0, 0.0, 0.0]
+        entry[0] += runs
+        entry[1] += seconds
+        entry[2] = max(entry[2], slowest)
+
+    def _before_request(self):
+        g.metrics_request = self.begin()
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        current = g.pop("metrics_request", None)
+        if current is not None:
+            route = request.url_rule.rule if request.url_rule else "<unmatched>"
+            self.end(route, g.pop("metrics_status", 500), current)
+
+    def collector(self, fn):
+        """Adds the lines fn() yields to every render."""
+        if fn not in self._collectors:
+            self._collectors.append(fn)
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+            self._statements.clear()
+
+    def render(self):
+        """The metrics in the prometheus text format."""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            top = sorted(self._statements.items(), key=lambda item: item[1][1], reverse=True)[:self.top_statements]
+            lines = [
+                "# HELP app_requests_total Requests by route and status.",
+                "# TYPE app_requests_total counter",
+            ]
+            for route, stats in routes:
+                for status, n in sorted(stats.statuses.items()):
+                    lines.append(f'app_requests_total{{route="{_escape(route)}",status="{status}"}} {n}')
+            for name, kind, help_text, attr in (
+                ("app_request_duration_seconds", "histogram", "Request latency.", "latency"),
+                ("app_request_statements", "histogram", "SQL statements per request.", "statements"),
+                ("app_request_rows", "histogram", "Rows fetched from the database per request.", "rows"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for route, stats in routes:
+                    lines += getattr(stats, attr).lines(name, f'route="{_escape(route)}"')
+            for name, help_text, attr in (
+                ("app_request_db_seconds_total", "Time spent executing statements and fetching rows.", "db_seconds"),
+                ("app_request_serialize_seconds_total", "Time spent serializing json.", "serialize_seconds"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for route, stats in routes:
+                    lines.append(f'{name}{{route="{_escape(route)}"}} {getattr(stats, attr)}')
+            lines += [
+                "# HELP app_route_n_plus_one_statements Most runs of one statement in a single request, for statements run at least METRICS_N_PLUS_ONE times.",
+                "# TYPE app_route_n_plus_one_statements gauge",
+            ]
+            for route, stats in routes:
+                for statement, runs in sorted(stats.n_plus_one.items()):
+                    lines.append(f'app_route_n_plus_one_statements{{route="{_escape(route)}",statement="{_escape(statement)}"}} {runs}')
+            lines += [
+                "# HELP app_sql_statement_seconds_total Total time of the statements that took the most time overall.",
+                "# TYPE app_sql_statement_seconds_total counter",
+            ]
+            lines += [f'app_sql_statement_seconds_total{{statement="{_escape(s)}"}} {entry[1]}' for s, entry in top]
+            lines += ["# HELP app_sql_statement_calls_total Runs of the same statements.", "# TYPE app_sql_statement_calls_total counter"]
+            lines += [f'app_sql_statement_calls_total{{statement="{_escape(s)}"}} {entry[0]}' for s, entry in top]
+            lines += ["# HELP app_sql_statement_max_seconds Slowest single run of the same statements.", "# TYPE app_sql_statement_max_seconds gauge"]
+            lines += [f'app_sql_statement_max_seconds{{statement="{_escape(s)}"}} {entry[2]}' for s, entry in top]
+        for collect in self._collectors:
+            lines += collect()
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    current = _current.get()
+    if current is not None:
+        current.executing = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    current = _current.get()
+    if current is None or current.executing is None:
+        return
+    elapsed = perf_counter() - current.executing
+    current.executing = None
+    current.statements += 1
+    current.db_seconds += elapsed
+    key = normalize(statement)
+    entry = current.by_statement.get(key)
+    if entry is None:
+        entry = current.by_statement[key] = [0, 0.0, 0.0]
+    entry[0] += 1
+    entry[1] += elapsed
+    entry[2] = max(entry[2], elapsed)
+    if context is not None and cursor.description is not None:
+        context.cursor = _CountingCursor(cursor, current, entry, elapsed)
+
+metrics = Metrics()
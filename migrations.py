@@ -0,0 +1,258 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from models import db
+import closure
+import activity
+import search
+import changes
+import history
+
+# tiny migration runner, the schema version lives in sqlite's PRAGMA user_version
+# each migration is (version, description, steps), a step is either a sql string or a function taking the connection
+# every pending migration runs in one transaction and bumps user_version, so a failure leaves the db untouched
+# models.py must always describe the schema the last migration produces
+
+MIGRATIONS = [
+    (1, "baseline schema", [
+        """CREATE TABLE IF NOT EXISTS account (
+            id INTEGER NOT NULL,
+            username VARCHAR(30) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (username)
+        )""",
+        """CREATE TABLE IF NOT EXISTS author (
+            id INTEGER NOT NULL,
+            name VARCHAR(30) NOT NULL,
+            account_id INTEGER NOT NULL,
+            age INTEGER NOT NULL,
+            height FLOAT NOT NULL,
+            boss_id INTEGER,
+            PRIMARY KEY (id),
+            UNIQUE (account_id),
+            FOREIGN KEY(account_id) REFERENCES account (id),
+            FOREIGN KEY(boss_id) REFERENCES author (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS post (
+            id INTEGER NOT NULL,
+            headline VARCHAR(200) NOT NULL,
+            content VARCHAR(1000) NOT NULL,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(author_id) REFERENCES author (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS task (
+            id INTEGER NOT NULL,
+            headline VARCHAR(200) NOT NULL,
+            content VARCHAR(1000) NOT NULL,
+            date DATETIME,
+            creation_date DATETIME,
+            state VARCHAR(11) NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS task_owners (
+            author_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            PRIMARY KEY (author_id, task_id),
+            FOREIGN KEY(author_id) REFERENCES author (id),
+            FOREIGN KEY(task_id) REFERENCES task (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS comment (
+            id INTEGER NOT NULL,
+            content VARCHAR(1000) NOT NULL,
+            task_id INTEGER,
+            post_id INTEGER,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(task_id) REFERENCES task (id),
+            FOREIGN KEY(post_id) REFERENCES post (id),
+            FOREIGN KEY(author_id) REFERENCES author (id)
+        )""",
+    ]),
+    (2, "indexes for the columns every route filters on", [
+        "CREATE INDEX IF NOT EXISTS ix_author_name ON author (name, boss_id)",
+        "CREATE INDEX IF NOT EXISTS ix_author_boss_id ON author (boss_id, name)",
+        "CREATE INDEX IF NOT EXISTS ix_task_headline ON task (headline)",
+        "CREATE INDEX IF NOT EXISTS ix_task_owners_task_id ON task_owners (task_id, author_id)",
+        "CREATE INDEX IF NOT EXISTS ix_comment_task_id ON comment (task_id)",
+        "CREATE INDEX IF NOT EXISTS ix_comment_post_id ON comment (post_id)",
+        "CREATE INDEX IF NOT EXISTS ix_comment_author_id ON comment (author_id)",
+        "CREATE INDEX IF NOT EXISTS ix_post_author_id ON post (author_id)",
+        # give the planner real statistics for the new indexes
+        "ANALYZE",
+    ]),
+    (3, "per table change versions for etags", [
+        """CREATE TABLE IF NOT EXISTS table_version (
+            name VARCHAR(30) NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (name)
+        )""",
+        """INSERT OR IGNORE INTO table_version (name, version) VALUES
+            ('account', 0), ('author', 0), ('post', 0), ('task', 0), ('task_owners', 0), ('comment', 0),
+            ('_generation', abs(random()) % 1000000000)""",
+    ]),
+    (4, "task version column for optimistic concurrency", [
+        "ALTER TABLE task ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (5, "author_closure table for the org chart", [
+        """CREATE TABLE IF NOT EXISTS author_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id),
+            FOREIGN KEY(ancestor_id) REFERENCES author (id),
+            FOREIGN KEY(descendant_id) REFERENCES author (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_author_closure_ancestor ON author_closure (ancestor_id, depth, descendant_id)",
+        "CREATE INDEX IF NOT EXISTS ix_author_closure_descendant ON author_closure (descendant_id, depth, ancestor_id)",
+        closure.rebuild,
+        "ANALYZE author_closure",
+    ]),
+    (6, "comment creation date and author_activity rollups", [
+        "ALTER TABLE comment ADD COLUMN creation_date DATETIME",
+        # comments never had a date, the best guess is the day of the task they are on (post comments stay undated)
+        "UPDATE comment SET creation_date = (SELECT task.creation_date FROM task WHERE task.id = comment.task_id) WHERE task_id IS NOT NULL",
+        """CREATE TABLE IF NOT EXISTS author_activity (
+            author_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            comments INTEGER NOT NULL DEFAULT 0,
+            tasks_created INTEGER NOT NULL DEFAULT 0,
+            tasks_new INTEGER NOT NULL DEFAULT 0,
+            tasks_inprogress INTEGER NOT NULL DEFAULT 0,
+            tasks_finished INTEGER NOT NULL DEFAULT 0,
+            tasks_delayed INTEGER NOT NULL DEFAULT 0,
+            tasks_canceled INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (author_id, day),
+            FOREIGN KEY(author_id) REFERENCES author (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_author_activity_day ON author_activity (day, author_id)",
+        activity.rebuild,
+        "ANALYZE author_activity",
+    ]),
+    (7, "search_index full text search table and its triggers", [
+        *search.SCHEMA,
+        search.reindex,
+    ]),
+    (8, "change_log feed of task, comment and task_owners writes", [
+        """CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            table_name VARCHAR(30) NOT NULL,
+            op VARCHAR(6) NOT NULL,
+            data TEXT NOT NULL,
+            created DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_change_log_created ON change_log (created)",
+        *changes.TRIGGERS.values(),
+    ]),
+    (9, "job table for background reports", [
+        """CREATE TABLE IF NOT EXISTS job (
+            id INTEGER NOT NULL,
+            report VARCHAR(30) NOT NULL,
+            params TEXT NOT NULL,
+            format VARCHAR(6) NOT NULL,
+            status VARCHAR(8) DEFAULT 'queued' NOT NULL,
+            row_count INTEGER,
+            size INTEGER,
+            error TEXT,
+            created DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            started DATETIME,
+            finished DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_job_status ON job (status, id)",
+    ]),
+    (10, "task priority and the urgency index", [
+        "ALTER TABLE task ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS ix_task_urgency ON task (state, priority, date)",
+        # the change feed's task rows carry the priority too
+        changes.drop_triggers,
+        changes.create_triggers,
+        "ANALYZE task",
+    ]),
+    (11, "reporting_line history of the org chart and its snapshots", [
+        """CREATE TABLE IF NOT EXISTS reporting_line (
+            id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            boss_id INTEGER,
+            valid_from DATETIME NOT NULL,
+            valid_to DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_reporting_line_valid_from ON reporting_line (valid_from, author_id, boss_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reporting_line_valid_to ON reporting_line (valid_to, author_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reporting_line_author ON reporting_line (author_id, valid_to)",
+        """CREATE TABLE IF NOT EXISTS org_snapshot (
+            id INTEGER NOT NULL,
+            taken DATETIME NOT NULL,
+            authors INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_org_snapshot_taken ON org_snapshot (taken)",
+        *history.TRIGGERS.values(),
+        # nothing was recorded before, today's org chart stands in for all of the past
+        history.backfill,
+        "ANALYZE reporting_line",
+    ]),
+    (12, "iso dates in the change feed", [
+        changes.drop_triggers,
+        changes.create_triggers,
+        changes.iso_dates,
+    ]),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def upgrade(engine, target=HEAD):
+    """Applies every migration above the current version up to target, returns the list that ran."""
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+        for number, description, steps in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(text(step))
+            applied.append((number, description))
+            version = number
+        # pragmas can't take bound parameters
+        conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+    return applied
+
+def reset(engine):
+    """Drops every table, index and trigger and goes back to version 0."""
+    with engine.begin() as conn:
+        objects = conn.execute(text(
+            "SELECT type, name FROM sqlite_master "
+            "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' "
+            # a virtual table drops its own shadow tables (search_index_data, ...), so it has to go first
+            "ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC"
+        )).all()
+        for kind, name in objects:
+            conn.execute(text(f'DROP {kind.upper()} IF EXISTS "{name}"'))
+        conn.execute(text("PRAGMA user_version = 0"))
+
+
+@click.command("db-upgrade")
+@click.option("--target", type=int, default=HEAD, show_default=True, help="schema version to stop at")
+@with_appcontext
+def upgrade_command(target):
+    """Brings the database schema up to date."""
+    applied = upgrade(db.engine, target)
+    for number, description in applied:
+        click.echo(f"applied {number:04d} {description}")
+    with db.engine.connect() as conn:
+        click.echo(f"schema at version {current_version(conn)} (head {HEAD})")
+
+@click.command("db-version")
+@with_appcontext
+def version_command():
+    """Prints the schema version of the database."""
+    with db.engine.connect() as conn:
+        click.echo(f"schema at version {current_version(conn)} (head {HEAD})")
@@ -0,0 +1,257 @@
+from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, timezone
+import enum
+from flask import g, has_app_context
+from sqlalchemy import event, inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from orgtree import OrgTreeIndex
+
+db = SQLAlchemy()
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Runs PRAGMA name=value for every pragma on each new sqlite connection of the engine."""
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+class TaskState(enum.Enum):
+    NEW = "new"
+    IN_PROGRESS = "inprogress"
+    FINISHED = "finished"
+    DELAYED = "delayed"
+    CANCELED = "canceled"
+
+# task.priority, 0 (the default) up to 4, higher is more urgent
+TASK_PRIORITIES = range(5)
+
+# Association table for the Many-to-Many relationship
+task_owners = db.Table('task_owners',
+    db.Column('author_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
+    db.Column('task_id', db.Integer, db.ForeignKey('task.id'), primary_key=True),
+    # the primary key only helps lookups by author_id, this one is for "who owns this task"
+    db.Index('ix_task_owners_task_id', 'task_id', 'author_id')
+)
+
+#all usernames are unique
+class Account(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(30), nullable=False, unique=True)
+    author = db.relationship("Author", back_populates="account") #creates an account field in author
+
+#author names are not unique
+class Author(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(30), nullable=False)
+    account = db.relationship("Account", back_populates='author', lazy=True) # allows me to get the Username Author.username.username, creates a author field in account
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False, unique=True) #this is the actual constraint, all users have a unique account
+    age = db.Column(db.Integer,nullable=False)
+    height = db.Column(db.Float,nullable=False)
+
+    # Self-referential relationship
+    boss_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=True) # when you create a subordinate it is associated to the boss and populates the subordinates list
+    subordinates = db.relationship('Author', backref=db.backref('boss', remote_side=[id])) #this is magically a list because of how sql alchemy works
+
+    # relationship to Task table, secondary the asociation table for many to many relationship, backref is a reverse relationship, 
+    tasks = db.relationship('Task', secondary=task_owners, backref=db.backref('owners', lazy='dynamic'), lazy=True)
+    posts = db.relationship('Post', backref='author', lazy=True)
+
+    @property
+    def peers(self):
+        """Returns a list of other Authors who share the same boss."""
+        if self.boss:
+            return [x for x in self.boss.subordinates if x.id != self.id]
+        return []
+
+    # (name, boss_id) covers the name lookups and the CTE anchors, (boss_id, name) covers walking down the tree
+    __table_args__ = (
+        db.Index('ix_author_name', 'name', 'boss_id'),
+        db.Index('ix_author_boss_id', 'boss_id', 'name'),
+    )
+    
+class Post(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    headline = db.Column(db.String(200), nullable=False)
+    content = db.Column(db.String(1000), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False, index=True)
+
+class Task(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    headline = db.Column(db.String(200), nullable=False, index=True)
+    content = db.Column(db.String(1000), nullable=False)
+    date    = db.Column(db.DateTime,default=None,nullable=True)
+    creation_date = db.Column(db.DateTime,default=lambda: datetime.now(timezone.utc))
+    state = db.Column(db.Enum(TaskState), default=TaskState.NEW, nullable=False)
+    # bumped by every update, the orm checks it on flush and the batch update only writes rows whose version still matches
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    __mapper_args__ = {"version_id_col": version}
+    __table_args__ = (
+        # /view/tasks/urgent reads one (state, priority) range of it at a time, already in date order
+        db.Index('ix_task_urgency', 'state', 'priority', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<Task {self.id}>'
+    
+class Comment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.String(1000), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=True, index=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=True, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False, index=True)
+    creation_date = db.Column(db.DateTime,default=lambda: datetime.now(timezone.utc))
+
+    # Relationships for easier data traversal
+    #relationships create dynamic sql queries under the hood which is convenient.
+    author = db.relationship('Author', backref=db.backref('comments', lazy=True))
+    task = db.relationship('Task', backref=db.backref('comments', lazy=True)) # comment.task and task.comment, these are both the actual objects
+    post = db.relationship('Post', backref=db.backref('comments', lazy=True))
+
+# one row per table, bumped in the same transaction as every orm write to that table (see etag.py)
+# the _generation row is random per database so versions from a dropped and re-seeded db never match
+table_version = db.Table('table_version',
+    db.Column('name', db.String(30), primary_key=True),
+    db.Column('version', db.Integer, nullable=False, default=0)
+)
+
+# every (ancestor, descendant) pair of the org chart with the number of levels between them, including (a, a, 0)
+# kept in step with author by closure.py, so subtree/ancestor questions are one indexed lookup instead of a recursive walk
+author_closure = db.Table('author_closure',
+    db.Column('ancestor_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
+    db.Column('descendant_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
+    db.Column('depth', db.Integer, nullable=False),
+    # "everyone under x down to n levels" and "everyone above y, nearest first"
+    db.Index('ix_author_closure_ancestor', 'ancestor_id', 'depth', 'descendant_id'),
+    db.Index('ix_author_closure_descendant', 'descendant_id', 'depth', 'ancestor_id')
+)
+
+# per author and day activity counts, kept in step with task, task_owners and comment by activity.py
+# the heatmap and the impact leaderboard read these instead of grouping the raw tables on every request
+author_activity = db.Table('author_activity',
+    db.Column('author_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
+    db.Column('day', db.Date, primary_key=True),
+    db.Column('comments', db.Integer, nullable=False, default=0),
+    db.Column('tasks_created', db.Integer, nullable=False, default=0),
+    db.Column('tasks_new', db.Integer, nullable=False, default=0),
+    db.Column('tasks_inprogress', db.Integer, nullable=False, default=0),
+    db.Column('tasks_finished', db.Integer, nullable=False, default=0),
+    db.Column('tasks_delayed', db.Integer, nullable=False, default=0),
+    db.Column('tasks_canceled', db.Integer, nullable=False, default=0),
+    # leaderboards over a date range
+    db.Index('ix_author_activity_day', 'day', 'author_id')
+)
+
+# append only log of task, comment and task_owners writes behind /changes, filled by sqlite triggers (see changes.py)
+# AUTOINCREMENT so a seq is never handed out twice, even after the newest rows were deleted
+change_log = db.Table('change_log',
+    db.Column('seq', db.Integer, primary_key=True),
+    db.Column('table_name', db.String(30), nullable=False),
+    db.Column('op', db.String(6), nullable=False),
+    db.Column('data', db.Text, nullable=False),
+    db.Column('created', db.DateTime, nullable=False, server_default=db.func.current_timestamp()),
+    # pruning by age
+    db.Index('ix_change_log_created', 'created'),
+    sqlite_autoincrement=True
+)
+
+# who reported to whom when, one row per stretch of time an author had one boss (valid_to NULL is the current one)
+# filled by sqlite triggers on author and never rewritten, only the end of the open line is set (see history.py)
+# no foreign keys, the history of an author outlives the author
+reporting_line = db.Table('reporting_line',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('author_id', db.Integer, nullable=False),
+    db.Column('boss_id', db.Integer),
+    db.Column('valid_from', db.DateTime, nullable=False),
+    db.Column('valid_to', db.DateTime),
+    # the lines that started or ended in a time range, the "as of" replay reads both
+    db.Index('ix_reporting_line_valid_from', 'valid_from', 'author_id', 'boss_id'),
+    db.Index('ix_reporting_line_valid_to', 'valid_to', 'author_id'),
+    # an author's open line, for the triggers
+    db.Index('ix_reporting_line_author', 'author_id', 'valid_to')
+)
+
+# the whole org chart at one moment, data is a json list of [author_id, boss_id], see history.py
+org_snapshot = db.Table('org_snapshot',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('taken', db.DateTime, nullable=False),
+    db.Column('authors', db.Integer, nullable=False),
+    db.Column('data', db.Text, nullable=False),
+    db.Index('ix_org_snapshot_taken', 'taken')
+)
+
+# background report jobs, see jobs.py
+job = db.Table('job',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('report', db.String(30), nullable=False),
+    db.Column('params', db.Text, nullable=False),
+    db.Column('format', db.String(6), nullable=False),
+    db.Column('status', db.String(8), nullable=False, server_default="queued"),
+    db.Column('row_count', db.Integer),
+    db.Column('size', db.Integer),
+    db.Column('error', db.Text),
+    db.Column('created', db.DateTime, nullable=False, server_default=db.func.current_timestamp()),
+    db.Column('started', db.DateTime),
+    db.Column('finished', db.DateTime),
+    # claiming the oldest queued job and pruning the finished ones
+    db.Index('ix_job_status', 'status', 'id')
+)
+
+# the search_index full text table isn't declared here, it's an FTS5 virtual table (migration 7)
+# kept in step with task, post and comment by sqlite triggers, see search.py
+
+# in memory copy of the org chart so hierarchy routes don't walk author.boss one query at a time
+# built from one SELECT id, name, boss_id and thrown away whenever a commit touches the tree
+def _load_org_rows():
+    return db.session.query(Author.id, Author.name, Author.boss_id).all()
+
+# the commit events below only fire for this process's writes, another worker's shows up as a new
+# author version. a route behind @conditional("...", "author") already read it (etag.py), reuse that
+_org_version_statement = select(table_version.c.name, table_version.c.version).\
+    where(table_version.c.name.in_(["author", "_generation"]))
+
+def _load_org_version():
+    versions = g.get('table_versions') if has_app_context() else None
+    if versions is not None and "author" in versions:
+        return versions["author"], versions["_generation"]
+    versions = dict(db.session.execute(_org_version_statement).all())
+    return versions.get("author"), versions.get("_generation")
+
+org_index = OrgTreeIndex(_load_org_rows, _load_org_version)
+
+@event.listens_for(Session, "after_flush")
+def _org_index_after_flush(session, flush_context):
+    if session.info.get("org_changed"):
+        return
+    for obj in session.new:
+        if isinstance(obj, Author):
+            session.info["org_changed"] = True
+            return
+    for obj in session.deleted:
+        if isinstance(obj, Author):
+            session.info["org_changed"] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Author):
+            state = inspect(obj)
+            if state.attrs.boss_id.history.has_changes() or state.attrs.name.history.has_changes():
+                session.info["org_changed"] = True
+                return
+
+# only invalidate once the change is actually visible to other connections
+@event.listens_for(Session, "after_commit")
+def _org_index_after_commit(session):
+    if session.info.pop("org_changed", False):
+        org_index.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def _org_index_after_rollback(session):
+    session.info.pop("org_changed", None)
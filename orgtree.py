@@ -0,0 +1,129 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+
+class OrgTree:
+    """Read-only in-memory index of the Author.boss_id tree.
+
+    Built from plain (id, name, boss_id) rows so it never touches the ORM.
+    Every node gets a dense index, internally everything is a list indexed by it.
+    """
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.ids = [row[0] for row in rows]
+        self.names = [row[1] for row in rows]
+        self.index_of = {author_id: i for i, author_id in enumerate(self.ids)}
+
+        # names are not unique, keep every id that has the name (in id order)
+        self.by_name = {}
+        for i, name in enumerate(self.names):
+            self.by_name.setdefault(name, []).append(i)
+
+        n = len(self.ids)
+        self.parent = [-1] * n
+        self.children = [[] for _ in range(n)]
+        for i, row in enumerate(rows):
+            boss = self.index_of.get(row[2])
+            if boss is not None:
+                self.parent[i] = boss
+                self.children[boss].append(i)  # rows are in id order so children are too
+
+        # euler tour: tin/tout bracket a node's subtree, order[tin] is the node
+        # iterative dfs because a deep org would blow the recursion limit
+        self.depth = [0] * n
+        self.tin = [-1] * n
+        self.tout = [-1] * n
+        self.order = []
+        roots = [i for i in range(n) if self.parent[i] == -1]
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    self.tout[node] = len(self.order) - 1
+                    continue
+                self.tin[node] = len(self.order)
+                self.order.append(node)
+                stack.append((node, True))
+                for child in reversed(self.children[node]):
+                    self.depth[child] = self.depth[node] + 1
+                    stack.append((child, False))
+        # anything not visited sits on a boss_id cycle, leave it out of the tree
+        for i in range(n):
+            if self.tin[i] == -1:
+                self.parent[i] = -1
+
+        # nodes grouped by depth and sorted by tin, a subtree is a contiguous slice of each level
+        max_depth = max(self.depth, default=0)
+        self.levels = [[] for _ in range(max_depth + 1)]
+        self.level_tins = [[] for _ in range(max_depth + 1)]
+        for node in self.order:
+            self.levels[self.depth[node]].append(node)
+            self.level_tins[self.depth[node]].append(self.tin[node])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, name):
+        """Returns the node index of the first author (lowest id) with this name, or None."""
+        nodes = self.by_name.get(name)
+        return nodes[0] if nodes else None
+
+    def node(self, author_id):
+        return self.index_of.get(author_id)
+
+    def subordinates(self, node, start_level, end_level):
+        """Yields (node, distance) for the subtree of node between the two levels, level by level.
+
+        Within a level the nodes come out in the same order a BFS would visit them.
+        """
+        if self.tin[node] == -1:
+            return
+        base = self.depth[node]
+        lo, hi = self.tin[node], self.tout[node]
+        for distance in range(max(start_level, 1), end_level + 1):
+            d = base + distance
+            if d >= len(self.levels):
+                break
+            tins = self.level_tins[d]
+            for j in range(bisect_left(tins, lo), bisect_right(tins, hi)):
+                yield self.levels[d][j], distance
+
+    def ancestors(self, node):
+        """Returns the boss chain of node, closest boss first."""
+        ret = []
+        node = self.parent[node]
+        while node != -1:
+            ret.append(node)
+            node = self.parent[node]
+        return ret
+
+
+class OrgTreeIndex:
+    """Holds the current OrgTree and rebuilds it lazily after it is invalidated.
+
+    With load_version it also rebuilds whenever that returns something else than it did
+    before the current tree was loaded, for changes invalidate() never hears about.
+    """
+
+    def __init__(self, load_rows, load_version=None):
+        self._load_rows = load_rows
+        self._load_version = load_version
+        self._current = None # (version, tree), swapped as one so readers never see a mismatched pair
+        self._lock = threading.Lock()
+
+    def get(self):
+        # read before the rows, a change committed in between only costs one more rebuild
+        version = self._load_version() if self._load_version is not None else None
+        current = self._current
+        if current is not None and current[0] == version:
+            return current[1]
+        with self._lock:
+            if self._current is None or self._current[0] != version:
+                self._current = (version, OrgTree(self._load_rows()))
+            return self._current[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._current = None
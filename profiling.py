@@ -0,0 +1,56 @@
+import random
+import threading
+from sqltap.wsgi import SQLTapMiddleware
+
+
+class SampledSQLTapMiddleware(SQLTapMiddleware):
+    """ sqltap that only captures the queries of some requests.
+
+    A request is profiled when it carries the trigger header (X-SQLTap: 1 by default)
+    or when it wins the sample_rate coin flip. Every other request goes straight to the app.
+    The sqltap session is only started while at least one profiled request is running,
+    so the (expensive) stack capture is not paid by normal traffic.
+    Reports are still at /__sqltap__.
+    """
+
+    def __init__(self, app, sample_rate=0.0, header='X-SQLTap', path='/__sqltap__'):
+        super().__init__(app, path=path)
+        self.sample_rate = sample_rate
+        self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self._local = threading.local()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        # tag each query with the request that ran it, queries from unprofiled threads are dropped
+        self.profiler.user_context_fn = lambda *args: getattr(self._local, 'path', None)
+        self.profiler.collect_fn = self._collect
+
+    def _collect(self, qstats):
+        if qstats.user_context is not None:
+            self.collector.put(qstats)
+
+    def _sampled(self, environ):
+        if environ.get(self.environ_key) not in (None, '', '0'):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == self.path or path == self.path + '/':
+            return self.render(environ, start_response)
+        if not self._sampled(environ):
+            return self.app(environ, start_response)
+
+        with self._active_lock:
+            if self._active == 0:
+                self.start()
+            self._active += 1
+        self._local.path = path
+        try:
+            # consume the body here so every query of the request lands inside the window
+            return list(self.app(environ, start_response))
+        finally:
+            self._local.path = None
+            with self._active_lock:
+                self._active -= 1
+                if self._active == 0:
+                    self.stop()
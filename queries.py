@@ -0,0 +1,412 @@
+import base64
+import inspect
+from datetime import datetime
+from functools import wraps
+from sqlalchemy import select, update, case, literal, tuple_, or_, and_, bindparam, func, union_all
+from sqlalchemy.orm import aliased
+from models import Account, Author, Comment, Post, Task, TaskState, TASK_PRIORITIES, task_owners, author_closure
+
+# core statements shared by the flask routes (db.session.execute) and the asgi routes (await conn.execute)
+# plus the functions that turn their rows into the json payloads, so both serving modes answer identically
+#
+# the read statements are built once: everything that changes from one request to the next is a bind
+# parameter passed to execute, only the shape (which fields, with or without a viewer) picks a different
+# statement. sqlalchemy memoizes a statement's cache key on the object and keeps the compiled sql in the
+# engine's compiled cache, so a repeat execution neither rebuilds nor recompiles anything.
+# warm_up() runs every one of them once at startup, before the first request has to.
+
+_prebuilt = []
+
+def prebuilt(variants=((),), **warm_params):
+    """Caches the statement a function builds per distinct arguments and registers it for warm_up().
+
+    variants are the argument tuples warm_up builds it with. warm_params are the values warm_up binds
+    where NULL won't do (LIMIT), every other request parameter is NULL so the warm up run matches nothing.
+    """
+    def decorator(build):
+        signature = inspect.signature(build)
+        statements = {}
+
+        @wraps(build)
+        def cached(*args, **kwargs):
+            # keyed on every argument with the defaults filled in, so f() and f(default) are the same object
+            # (a statement with aliases compiles to a new cache entry for every object built)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            stmt = statements.get(bound.args)
+            if stmt is None:
+                stmt = statements[bound.args] = build(*bound.args)
+            return stmt
+
+        _prebuilt.extend((cached, args, warm_params) for args in variants)
+        return cached
+    return decorator
+
+def warm_up(executor, extra=()):
+    """Runs every prebuilt statement variant and the extra statements once, returns how many.
+
+    executor is what the routes execute them with, a Session for flask and a Connection for asgi.py,
+    the orm compiles some statements differently so each has its own compiled cache entries.
+    """
+    for build, args, warm_params in _prebuilt:
+        stmt = build(*args)
+        # exactly the names the routes pass, the compiled cache key includes them
+        params = {bind.key: None for bind in stmt.compile().binds.values() if bind.required}
+        params.update(warm_params)
+        executor.execute(stmt, params).all()
+    for stmt in extra:
+        executor.execute(stmt).all()
+    return len(_prebuilt) + len(extra)
+
+TASKS_PAGE_LIMIT = 100
+TASKS_PAGE_MAX_LIMIT = 1000
+# what ?fields= can pick from, owners and comments cost a statement each and are skipped when left out
+TASKS_PAGE_FIELDS = ("id", "headline", "state", "date", "owners", "comments")
+
+# the columns behind each field of /view/tasks/account, only the ones asked for are selected
+ACCOUNT_TASK_COLUMNS = {
+    "headline": Task.headline,
+    "content": Task.content,
+    "date": Task.date,
+    "state": Task.state,
+    "author": Author.name,
+    "account": Account.username,
+}
+ACCOUNT_TASK_FIELDS = tuple(ACCOUNT_TASK_COLUMNS)
+
+
+@prebuilt(variants=((False,), (True,)), limit=0)
+def tasks_page(viewer=False):
+    # :after, :limit and :viewer, see tasks_page_params
+    stmt = select(Task.id, Task.headline, Task.state, Task.date).\
+        where(Task.id > bindparam("after")).\
+        order_by(Task.id).\
+        limit(bindparam("limit"))
+    if viewer:
+        stmt = stmt.where(visible_to())
+    return stmt
+
+def tasks_page_params(after, limit, viewer=None):
+    # fetch one extra row so we know if there is another page without a count(*)
+    params = {"after": after, "limit": limit + 1}
+    if viewer is not None:
+        params["viewer"] = viewer
+    return params
+
+# exactly the ids on the page, a range would also pull in the tasks a viewer filtered out in between.
+# :ids expands to one variable per task when it runs, the statement itself is still built once
+@prebuilt(ids=[])
+def page_owners():
+    return select(task_owners.c.task_id, Author.id, Author.name).\
+        join(Author, Author.id == task_owners.c.author_id).\
+        where(task_owners.c.task_id.in_(bindparam("ids", expanding=True))).\
+        order_by(task_owners.c.task_id, Author.id)
+
+@prebuilt(ids=[])
+def page_comments():
+    return select(Comment.task_id, Comment.id, Comment.content, Author.name).\
+        join(Author, Author.id == Comment.author_id).\
+        where(Comment.task_id.in_(bindparam("ids", expanding=True))).\
+        order_by(Comment.task_id, Comment.id)
+
+def page_ids(page):
+    return {"ids": [task.id for task in page]}
+
+def tasks_page_payload(tasks, owner_rows, comment_rows, limit, fields=TASKS_PAGE_FIELDS):
+    has_more = len(tasks) > limit
+    tasks = tasks[:limit]
+    if not tasks:
+        return {"tasks": [], "next_after": None}
+
+    owners = {task.id: [] for task in tasks}
+    for task_id, author_id, author_name in owner_rows:
+        if task_id in owners:
+            owners[task_id].append({"id": author_id, "name": author_name})
+
+    comments = {task.id: [] for task in tasks}
+    for task_id, comment_id, content, author_name in comment_rows:
+        if task_id in comments:
+            # the id lets a client match up the comment changes from /changes
+            comments[task_id].append({"id": comment_id, "content": content, "author": author_name})
+
+    items = [{
+        "id": task.id,
+        "headline": task.headline,
+        "state": task.state,
+        "date": task.date,
+        "owners": owners[task.id],
+        "comments": comments[task.id]
+    } for task in tasks]
+    if fields != TASKS_PAGE_FIELDS:
+        items = [{name: item[name] for name in fields} for item in items]
+    return {"tasks": items, "next_after": tasks[-1].id if has_more else None}
+
+@prebuilt()
+def account_tasks(fields=ACCOUNT_TASK_FIELDS):
+    # one statement: everyone under the :username account's author down to :end_level straight from author_closure
+    # (keyed by author.id, names are not unique), joined to their tasks
+    root = select(Author.id).join(Account).where(Account.username == bindparam("username")).scalar_subquery()
+
+    # the outer joins keep a task-less row for the account owner (depth 0), so "no such user" and "no tasks" can be told apart
+    return select(
+        Task.id,
+        *[ACCOUNT_TASK_COLUMNS[name].label(name) for name in fields]
+    ).select_from(author_closure).\
+        join(Author, Author.id == author_closure.c.descendant_id).\
+        join(Account, Account.id == Author.account_id).\
+        outerjoin(task_owners, task_owners.c.author_id == author_closure.c.descendant_id).\
+        outerjoin(Task, Task.id == task_owners.c.task_id).\
+        where(author_closure.c.ancestor_id == root, author_closure.c.depth <= bindparam("end_level")).\
+        where(or_(
+            author_closure.c.depth == 0,
+            and_(author_closure.c.depth >= bindparam("start_level"), Task.id.isnot(None))
+        ))
+
+def account_tasks_params(username, start_level, end_level):
+    return {"username": username, "start_level": start_level, "end_level": end_level}
+
+def viewer_id():
+    # the author of the :viewer account
+    return select(Author.id).join(Account).where(Account.username == bindparam("viewer")).scalar_subquery()
+
+def visible_to():
+    """Only the tasks owned by the account's author or anyone under them, no recursion.
+
+    The subtree is one lookup in author_closure that sqlite materializes once, every task is then checked
+    against it through its owners.
+    """
+    subtree = select(author_closure.c.descendant_id).where(author_closure.c.ancestor_id == viewer_id())
+    return select(1).\
+        where(task_owners.c.task_id == Task.id, task_owners.c.author_id.in_(subtree)).\
+        exists()
+
+def account_task(row, fields=ACCOUNT_TASK_FIELDS):
+    # the row is (task id, *fields)
+    return dict(zip(fields, row[1:]))
+
+
+# the flask only routes, main.py
+
+@prebuilt()
+def subordinates_by_name():
+    # everyone under every author named :name down to :end_level, one indexed lookup in author_closure
+    return select(Author.id, Author.name, author_closure.c.depth.label('level')).\
+        join(author_closure, author_closure.c.descendant_id == Author.id).\
+        where(
+            author_closure.c.ancestor_id.in_(select(Author.id).where(Author.name == bindparam("name"))),
+            author_closure.c.depth <= bindparam("end_level")
+        ).order_by(author_closure.c.ancestor_id, author_closure.c.depth, Author.id)
+
+def _first_named(name):
+    # like the org index, the author with the lowest id wins when names repeat
+    return select(func.min(Author.id)).where(Author.name == bindparam(name)).scalar_subquery()
+
+@prebuilt()
+def subordinate_levels():
+    # how many people sit at each level under the first author named :name
+    return select(author_closure.c.depth, func.count()).\
+        where(author_closure.c.ancestor_id == _first_named("name")).\
+        group_by(author_closure.c.depth)
+
+@prebuilt()
+def closest_shared_lead():
+    # the deepest common ancestor of the first authors named :name1 and :name2 is the one nearest to the first,
+    # a single join of author_closure with itself
+    above1 = author_closure.alias("above1")
+    above2 = author_closure.alias("above2")
+    return select(Account.username).\
+        select_from(above1).\
+        join(above2, above2.c.ancestor_id == above1.c.ancestor_id).\
+        join(Author, Author.id == above1.c.ancestor_id).\
+        join(Account, Account.id == Author.account_id).\
+        where(above1.c.descendant_id == _first_named("name1"), above2.c.descendant_id == _first_named("name2")).\
+        order_by(above1.c.depth).limit(1)
+
+@prebuilt()
+def names_found():
+    # how many of :name1 and :name2 belong to an author
+    return select(func.count(Author.name.distinct())).where(Author.name.in_([bindparam("name1"), bindparam("name2")]))
+
+@prebuilt()
+def ancestors_by_name():
+    # every ancestor of every author named :name, nearest first, each author itself comes first at depth 0
+    return select(Author.id, Author.name).\
+        join(author_closure, author_closure.c.ancestor_id == Author.id).\
+        where(author_closure.c.descendant_id.in_(select(Author.id).where(Author.name == bindparam("name")))).\
+        order_by(author_closure.c.depth, author_closure.c.descendant_id)
+
+POST_COLUMNS = {"id": Post.id, "headline": Post.headline, "content": Post.content, "author_id": Author.id}
+POST_FIELDS = tuple(POST_COLUMNS)
+
+@prebuilt()
+def author_posts(fields=POST_FIELDS):
+    # (author id, post id, *fields) for every author named :name, the outer join keeps the authors without posts
+    return select(Author.id, Post.id, *[POST_COLUMNS[f] for f in fields]).\
+        outerjoin(Post, Post.author_id == Author.id).\
+        where(Author.name == bindparam("name"))
+
+@prebuilt(variants=((False,), (True,)))
+def author(by_name=False):
+    """One author (by :name or :id) with its boss's name and how many people report to it."""
+    boss = aliased(Author)
+    report = aliased(Author)
+    reports = select(func.count()).select_from(report).where(report.boss_id == Author.id).scalar_subquery()
+    return select(Author.id, Author.name, Author.account_id, Author.age, Author.height, Author.boss_id,
+                  boss.name.label("boss_name"), reports.label("subordinates_count")).\
+        join(Account, Account.id == Author.account_id).\
+        outerjoin(boss, boss.id == Author.boss_id).\
+        where(Author.name == bindparam("name") if by_name else Author.id == bindparam("id")).\
+        limit(1)
+
+AUTHOR_TASK_COLUMNS = {"id": Task.id, "headline": Task.headline, "content": Task.content, "state": Task.state, "date": Task.date}
+AUTHOR_TASK_FIELDS = ("headline", "content", "state", "date") # without ?fields, id is opt in
+
+@prebuilt()
+def author_tasks(fields=AUTHOR_TASK_FIELDS):
+    # (*fields, task id) of the tasks :id is one of the owners of, straight off task_owners without going through author
+    return select(*[AUTHOR_TASK_COLUMNS[f] for f in fields], Task.id).\
+        join(task_owners, task_owners.c.task_id == Task.id).\
+        where(task_owners.c.author_id == bindparam("id"))
+
+@prebuilt()
+def author_comments():
+    # the headlines come from outer joins instead of lazy loading comment.task and comment.post one by one
+    return select(Comment.content, Comment.task_id, Comment.post_id, Task.headline.label("on_task"), Post.headline.label("on_post")).\
+        outerjoin(Task, Task.id == Comment.task_id).\
+        outerjoin(Post, Post.id == Comment.post_id).\
+        where(Comment.author_id == bindparam("id"))
+
+# /view/tasks/urgent: the open tasks, highest priority first, then the soonest due date, undated ones last
+URGENT_STATES = (TaskState.NEW, TaskState.IN_PROGRESS, TaskState.DELAYED)
+URGENT_LIMIT = 20
+URGENT_MAX_LIMIT = 500
+URGENT_FIELDS = ("id", "headline", "state", "priority", "date")
+# a viewer with at most this many people under them (themselves included) owns too few tasks for the
+# company wide ranges to turn them up quickly, their open tasks are sorted instead
+URGENT_SMALL_SUBTREE = 100
+# before every real due date, where the dated tasks of a priority start
+_EARLIEST = datetime.min
+
+@prebuilt(variants=[(dated, viewer) for dated in (True, False) for viewer in (False, True)], limit=0)
+def urgent_tasks(dated=True, viewer=False):
+    # per open state one range of ix_task_urgency, (state, :priority) in (date, id) order from just after the cursor,
+    # cut at :limit. sqlite reads at most :limit index entries per state and only sorts those few rows to merge them.
+    # the undated tasks of a priority are a range of their own (dated=False), a NULL date never compares greater
+    # :priority, :after_date (dated only), :after_id, :limit and :viewer
+    parts = []
+    for state in URGENT_STATES:
+        part = select(Task.id, Task.headline, Task.state, Task.priority, Task.date).\
+            where(Task.state == state, Task.priority == bindparam("priority"))
+        if dated:
+            part = part.where(tuple_(Task.date, Task.id) > tuple_(bindparam("after_date", type_=Task.date.type), bindparam("after_id")))
+        else:
+            part = part.where(Task.date.is_(None), Task.id > bindparam("after_id"))
+        if viewer:
+            # probed per index entry: the entry's owners, then one author_closure key lookup each (the subtree isn't materialized)
+            part = part.where(
+                select(1).select_from(task_owners).
+                join(author_closure, and_(author_closure.c.descendant_id == task_owners.c.author_id, author_closure.c.ancestor_id == viewer_id())).
+                where(task_owners.c.task_id == Task.id).
+                exists()
+            )
+        parts.append(select(part.order_by(Task.date, Task.id).limit(bindparam("limit")).subquery()))
+    merged = union_all(*parts).subquery()
+    return select(merged).order_by(merged.c.date, merged.c.id).limit(bindparam("limit"))
+
+@prebuilt(limit=0)
+def urgent_tasks_owned():
+    # the small subtree version of urgent_tasks, every open task the :viewer's subtree owns, past the cursor, in order
+    # :priority, :after_date (None after an undated task), :after_id, :limit and :viewer
+    subtree = select(author_closure.c.descendant_id).where(author_closure.c.ancestor_id == viewer_id())
+    owned = select(task_owners.c.task_id).where(task_owners.c.author_id.in_(subtree))
+    after_date = bindparam("after_date", type_=Task.date.type)
+    priority = bindparam("priority")
+    past = or_(
+        Task.priority < priority,
+        and_(Task.priority == priority, or_(
+            and_(after_date.is_not(None), or_(Task.date.is_(None), tuple_(Task.date, Task.id) > tuple_(after_date, bindparam("after_id")))),
+            and_(Task.date.is_(None), Task.id > bindparam("after_id")),
+        )),
+    )
+    return select(Task.id, Task.headline, Task.state, Task.priority, Task.date).\
+        where(Task.id.in_(owned), Task.state.in_(URGENT_STATES), past).\
+        order_by(Task.priority.desc(), Task.date.is_(None), Task.date, Task.id).\
+        limit(bindparam("limit"))
+
+@prebuilt(limit=0)
+def subtree_size():
+    # how many people :viewer's subtree holds, counting no further than :limit
+    capped = select(author_closure.c.descendant_id).where(author_closure.c.ancestor_id == viewer_id()).limit(bindparam("limit")).subquery()
+    return select(func.count()).select_from(capped)
+
+def urgent_rows(executor, limit, after=None, viewer=None):
+    """Up to limit + 1 urgent tasks after the cursor (priority, date or None for the undated, id), from the top without one.
+
+    Walks the priorities down, each one's dated tasks then its undated ones, one statement per range until the
+    page is full: usually one, at most two per priority. A small viewer subtree takes urgent_tasks_owned instead.
+    """
+    priority, after_date, after_id = after or (TASK_PRIORITIES[-1], _EARLIEST, 0)
+    if viewer is not None and executor.execute(subtree_size(), {"viewer": viewer, "limit": URGENT_SMALL_SUBTREE + 1}).scalar() <= URGENT_SMALL_SUBTREE:
+        params = {"priority": priority, "after_date": after_date, "after_id": after_id, "limit": limit + 1, "viewer": viewer}
+        return executor.execute(urgent_tasks_owned(), params).all()
+    rows = []
+    while priority >= TASK_PRIORITIES[0] and len(rows) <= limit:
+        params = {"priority": priority, "after_id": after_id, "limit": limit + 1 - len(rows)}
+        if viewer is not None:
+            params["viewer"] = viewer
+        if after_date is not None:
+            params["after_date"] = after_date
+            rows += executor.execute(urgent_tasks(True, viewer is not None), params).all()
+            after_date, after_id = None, 0
+        else:
+            rows += executor.execute(urgent_tasks(False, viewer is not None), params).all()
+            priority, after_date, after_id = priority - 1, _EARLIEST, 0
+    return rows
+
+def encode_urgent_cursor(row):
+    date = row.date.isoformat() if row.date is not None else ""
+    return base64.urlsafe_b64encode(f"{row.priority},{date},{row.id}".encode()).decode()
+
+def decode_urgent_cursor(cursor):
+    """(priority, date or None, id) of an encode_urgent_cursor cursor, ValueError for anything else."""
+    try:
+        priority, date, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+        priority, task_id = int(priority), int(task_id)
+    except (ValueError, UnicodeError):
+        raise ValueError("not a cursor")
+    if priority not in TASK_PRIORITIES:
+        raise ValueError("not a cursor")
+    return priority, datetime.fromisoformat(date) if date else None, task_id
+
+def urgent_payload(rows, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "tasks": [dict(zip(URGENT_FIELDS, row)) for row in rows],
+        "next": encode_urgent_cursor(rows[-1]) if has_more else None,
+    }
+
+def update_tasks(items):
+    # one UPDATE for many {id, version, state, priority, content} items, a row is only written if its version still matches
+    # RETURNING hands back the rows that were, everything else was either changed concurrently or doesn't exist
+    task = Task.__table__
+    values = {"version": task.c.version + 1}
+    states = {item["id"]: literal(item["state"], task.c.state.type) for item in items if item["state"] is not None}
+    if states:
+        values["state"] = case(states, value=task.c.id, else_=task.c.state)
+    priorities = {item["id"]: item["priority"] for item in items if item["priority"] is not None}
+    if priorities:
+        values["priority"] = case(priorities, value=task.c.id, else_=task.c.priority)
+    contents = {item["id"]: item["content"] for item in items if item["content"] is not None}
+    if contents:
+        values["content"] = case(contents, value=task.c.id, else_=task.c.content)
+    return update(task).\
+        where(tuple_(task.c.id, task.c.version).in_([(item["id"], item["version"]) for item in items])).\
+        values(values).\
+        returning(task.c.id, task.c.version)
+
+def json_list_chunks(items, dumps):
+    yield "["
+    for i, item in enumerate(items):
+        yield ("," if i else "") + dumps(item)
+    yield "]"
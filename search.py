@@ -0,0 +1,164 @@
+import base64
+import re
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from models import db
+
+# full text search over tasks, posts and comments with sqlite's FTS5
+#
+# search_index is one FTS5 table holding every document, its rowid encodes where the document came from
+# (source id * 4 + kind) so the triggers can find a document again with a rowid lookup instead of a scan.
+# the triggers keep it in step with every write, orm or core (seed.py, the batch task update) alike.
+# comments have no headline, theirs is NULL.
+
+KINDS = {"task": 1, "post": 2, "comment": 3}
+KIND_NAMES = {code: name for name, code in KINDS.items()}
+
+# bm25 weight of the headline and content columns, a hit in a headline counts for more
+WEIGHTS = (10.0, 1.0)
+HIGHLIGHT = ("<mark>", "</mark>")
+SNIPPET_TOKENS = 12
+
+def _triggers(table, headline):
+    code = KINDS[table]
+    new_headline = f"new.{headline}" if headline else "NULL"
+    return {
+        f"{table}_search_insert": f"""CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO search_index (rowid, headline, content) VALUES (new.id * 4 + {code}, {new_headline}, new.content);
+        END""",
+        f"{table}_search_delete": f"""CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM search_index WHERE rowid = old.id * 4 + {code};
+        END""",
+        f"{table}_search_update": f"""CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {headline + ", " if headline else ""}content ON {table} BEGIN
+            UPDATE search_index SET headline = {new_headline}, content = new.content WHERE rowid = old.id * 4 + {code};
+        END""",
+    }
+
+TRIGGERS = {**_triggers("task", "headline"), **_triggers("post", "headline"), **_triggers("comment", None)}
+
+# run by migration 7
+SCHEMA = [
+    # prefix indexes make "stat*" style queries a lookup instead of a scan of the term list
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        headline, content,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )""",
+    *TRIGGERS.values(),
+]
+
+def drop_triggers(conn):
+    """For bulk loads, one reindex() at the end is a lot cheaper than a trigger firing per row. Put them back with create_triggers()."""
+    for name in TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+def create_triggers(conn):
+    for sql in TRIGGERS.values():
+        conn.execute(text(sql))
+
+def reindex(conn):
+    """Rebuilds search_index from task, post and comment, returns the number of documents."""
+    conn.execute(text("DELETE FROM search_index"))
+    total = 0
+    for sql in (
+        f"INSERT INTO search_index (rowid, headline, content) SELECT id * 4 + {KINDS['task']}, headline, content FROM task",
+        f"INSERT INTO search_index (rowid, headline, content) SELECT id * 4 + {KINDS['post']}, headline, content FROM post",
+        f"INSERT INTO search_index (rowid, headline, content) SELECT id * 4 + {KINDS['comment']}, NULL, content FROM comment",
+    ):
+        total += conn.execute(text(sql)).rowcount
+    # merge the b-trees the inserts left behind into one
+    conn.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    return total
+
+
+_TERM = re.compile(r'[^\s"]+\*?')
+
+def fts_query(q):
+    """Turns what the user typed into an FTS5 query, every word has to match and a trailing * makes it a prefix.
+
+    The words are quoted, so FTS5 syntax (AND, NEAR, column filters, stray quotes) can't break the query.
+    Returns None when there is nothing to search for.
+    """
+    terms = []
+    for term in _TERM.findall(q or ""):
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if term:
+            terms.append(f'"{term}"*' if prefix else f'"{term}"')
+    return " ".join(terms) or None
+
+def encode_cursor(score, rowid):
+    return base64.urlsafe_b64encode(f"{score!r}:{rowid}".encode()).decode()
+
+def decode_cursor(cursor):
+    score, rowid = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+    return float(score), int(rowid)
+
+def search(conn, q, kinds=None, limit=20, after=None):
+    """One page of hits for the FTS5 query q, best first, plus the cursor of the next page (None on the last).
+
+    Ranking and paging only need the rowid and the bm25 score, the highlighted headline and the snippet
+    are worked out afterwards for just the rows on the page.
+    """
+    params = {"q": q, "limit": limit + 1, "wh": WEIGHTS[0], "wc": WEIGHTS[1]}
+    where = ["search_index MATCH :q"]
+    if kinds:
+        where.append(f"rowid % 4 IN ({', '.join(str(KINDS[kind]) for kind in kinds)})")
+    if after is not None:
+        # keyset pagination on (score, rowid), bm25 scores are negative and lower is better
+        where.append("(score > :after_score OR (score = :after_score AND rowid > :after_rowid))")
+        params["after_score"], params["after_rowid"] = after
+    hits = conn.execute(text(
+        f"SELECT rowid, bm25(search_index, :wh, :wc) AS score FROM search_index "
+        f"WHERE {' AND '.join(where)} ORDER BY score, rowid LIMIT :limit"
+    ), params).all()
+
+    next_cursor = None
+    if len(hits) > limit:
+        rowid, score = hits[limit - 1]
+        next_cursor = encode_cursor(score, rowid)
+    hits = hits[:limit]
+    if not hits:
+        return [], None
+
+    rowids = ", ".join(str(rowid) for rowid, _ in hits)
+    marks = {"open": HIGHLIGHT[0], "close": HIGHLIGHT[1], "tokens": SNIPPET_TOKENS}
+    texts = {row.rowid: row for row in conn.execute(text(
+        f"SELECT rowid, highlight(search_index, 0, :open, :close) AS headline, "
+        f"snippet(search_index, 1, :open, :close, '…', :tokens) AS snippet "
+        f"FROM search_index WHERE search_index MATCH :q AND rowid IN ({rowids})"
+    ), {"q": q, **marks})}
+
+    # link every comment to the task or post it is on
+    comment_ids = [rowid // 4 for rowid, _ in hits if rowid % 4 == KINDS["comment"]]
+    parents = {}
+    if comment_ids:
+        parents = {row.id: row for row in conn.execute(text(
+            f"SELECT id, task_id, post_id FROM comment WHERE id IN ({', '.join(map(str, comment_ids))})"
+        ))}
+
+    results = []
+    for rowid, score in hits:
+        kind, ref_id = KIND_NAMES[rowid % 4], rowid // 4
+        result = {
+            "type": kind,
+            "id": ref_id,
+            "headline": texts[rowid].headline,
+            "snippet": texts[rowid].snippet,
+            "score": round(-score, 4),
+        }
+        if kind == "comment" and ref_id in parents:
+            result["task_id"] = parents[ref_id].task_id
+            result["post_id"] = parents[ref_id].post_id
+        results.append(result)
+    return results, next_cursor
+
+
+@click.command("search-reindex")
+@with_appcontext
+def reindex_command():
+    """Rebuilds the full text search index."""
+    with db.engine.begin() as conn:
+        documents = reindex(conn)
+    click.echo(f"search_index rebuilt, {documents} documents")
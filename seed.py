@@ -1,15 +1,34 @@
 from faker import Faker
-from main import app, db, Account, Author, Task, Post, Comment, TaskState
+from flask import current_app
+from main import create_app, db, Account, Author, Task, Post, Comment, TaskState
+from models import task_owners, reporting_line, org_index, TASK_PRIORITIES
+from cache import response_cache
+from graph import collab_graph
+from history import org_history
+from sqlalchemy import text
+from collections import deque
+import migrations
+import closure
+import activity
+import search
+import changes
+import history
+import argparse
+import math
 import random
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
 
 fake = Faker()
 
-def seed_data():
+# most tasks are low priority, few are urgent
+PRIORITY_WEIGHTS = (50, 25, 15, 7, 3)
+
+def seed_data(app):
     with app.app_context():
         print("Dropping existing tables...")
-        db.drop_all()
-        db.create_all()
+        migrations.reset(db.engine)
+        migrations.upgrade(db.engine)
         print("Tables created.")
 
         authors = []
@@ -53,11 +72,12 @@ def seed_data():
             content = fake.paragraph(nb_sentences=3)
             date = fake.future_datetime(end_date="+30d", tzinfo=timezone.utc)
             state = random.choice(list(TaskState))
+            priority = random.choices(TASK_PRIORITIES, weights=PRIORITY_WEIGHTS)[0]
             
             # Assign 1 to 3 random owners
             owners = random.sample(authors, k=random.randint(1, 3))
             
-            task = Task(headline=headline, content=content, date=date, state=state, owners=owners)
+            task = Task(headline=headline, content=content, date=date, state=state, priority=priority, owners=owners)
             tasks.append(task)
         
         db.session.add_all(tasks)
@@ -99,5 +119,236 @@ def seed_data():
         print("Comments committed.")
         print("Database seeding completed successfully!")
 
+# bulk mode for benchmark sized datasets
+# python seed.py --bulk --authors 50000 --tasks 200000 --posts 50000 --comments 1000000 --depth 8 --fanout 6 --skew 0.8 --seed 42
+# everything goes through core executemany in batches inside one transaction, text comes from a pool built once,
+# and every random choice comes from one seeded Random so the same arguments always produce the same database
+
+BULK_DEFAULTS = {
+    "authors": 10000,
+    "tasks": 20000,
+    "posts": 10000,
+    "comments": 100000,
+    "depth": 6,        # levels below the root
+    "fanout": 5,       # average direct reports per manager
+    "skew": 0.5,       # 0 means every manager has exactly fanout reports, higher means a few managers have a lot
+    "reorgs": 2000,    # past boss changes in the reporting history
+    "seed": 42,
+    "batch_size": 10000,
+    "pool_size": 2000,
+}
+
+BASE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+def _text_pools(seed, pool_size):
+    fake = Faker()
+    fake.seed_instance(seed)
+    return {
+        "first_names": [fake.first_name() for _ in range(pool_size)],
+        "last_names": [fake.last_name() for _ in range(pool_size)],
+        "headlines": [fake.sentence(nb_words=6) for _ in range(pool_size)],
+        "paragraphs": [fake.paragraph(nb_sentences=3) for _ in range(pool_size)],
+        "sentences": [fake.sentence(nb_words=10) for _ in range(pool_size)],
+    }
+
+def _org_bosses(rng, authors, depth, fanout, skew):
+    """Returns boss index (or None) for every author, filled breadth first so bosses always come first."""
+    bosses = [None]
+    depths = [0]
+    queue = deque([0])
+    managers = [0] if depth > 0 else []
+    mu = math.log(fanout) - skew * skew / 2 # lognormal with mean fanout
+    while len(bosses) < authors:
+        if not queue:
+            if not managers:
+                break
+            # the depth limit capped the tree, give the existing managers more reports
+            queue.extend(rng.sample(managers, len(managers)))
+        boss = queue.popleft()
+        reports = fanout if skew == 0 else max(1, round(rng.lognormvariate(mu, skew)))
+        for _ in range(min(reports, authors - len(bosses))):
+            i = len(bosses)
+            bosses.append(boss)
+            depths.append(depths[boss] + 1)
+            if depths[i] < depth:
+                queue.append(i)
+                managers.append(i)
+    # depth 0 means a flat list of people with no bosses
+    bosses.extend([None] * (authors - len(bosses)))
+    return bosses
+
+def _batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def seed_bulk(engine, **options):
+    opts = dict(BULK_DEFAULTS, **options)
+    rng = random.Random(opts["seed"])
+    pools = _text_pools(opts["seed"], opts["pool_size"])
+    n_authors, n_tasks, n_posts = opts["authors"], opts["tasks"], opts["posts"]
+    batch_size = opts["batch_size"]
+    states = list(TaskState)
+    # its own generator so adding priorities didn't change the rest of a seed's data
+    priority_rng = random.Random(opts["seed"] + 1)
+    history_rng = random.Random(opts["seed"] + 2)
+    comment_date_rng = random.Random(opts["seed"] + 3)
+
+    migrations.reset(engine)
+    migrations.upgrade(engine)
+
+    def insert(conn, table, rows, label):
+        started = time.perf_counter()
+        total = 0
+        for batch in _batched(rows, batch_size):
+            conn.execute(table.insert(), batch)
+            total += len(batch)
+        print(f"  {label}: {total} rows in {time.perf_counter() - started:.1f}s")
+
+    def accounts():
+        for i in range(n_authors):
+            yield {"id": i + 1, "username": "blockbuster" if i == 0 else f"user{i}"}
+
+    def authors(bosses):
+        first, last = pools["first_names"], pools["last_names"]
+        for i, boss in enumerate(bosses):
+            yield {
+                "id": i + 1,
+                "name": "Jonny Jones" if i == 0 else f"{rng.choice(first)} {rng.choice(last)}",
+                "account_id": i + 1,
+                "age": rng.randint(20, 65),
+                "height": round(rng.uniform(1.5, 2.0), 2),
+                "boss_id": None if boss is None else boss + 1,
+            }
+
+    task_created = []
+
+    def tasks():
+        for i in range(n_tasks):
+            created = BASE_DATE + timedelta(minutes=rng.randrange(365 * 24 * 60))
+            task_created.append(created)
+            yield {
+                "id": i + 1,
+                "headline": rng.choice(pools["headlines"]),
+                "content": rng.choice(pools["paragraphs"]),
+                "date": created + timedelta(days=rng.randint(1, 30)),
+                "creation_date": created,
+                "state": rng.choice(states),
+                "priority": priority_rng.choices(TASK_PRIORITIES, weights=PRIORITY_WEIGHTS)[0],
+            }
+
+    def owners():
+        # 1 to 3 owners per task
+        for i in range(n_tasks):
+            for author in rng.sample(range(n_authors), k=min(n_authors, rng.randint(1, 3))):
+                yield {"task_id": i + 1, "author_id": author + 1}
+
+    def posts():
+        for i in range(n_posts):
+            yield {
+                "id": i + 1,
+                "headline": rng.choice(pools["headlines"]),
+                "content": rng.choice(pools["paragraphs"]),
+                "author_id": rng.randint(1, n_authors),
+            }
+
+    def reporting_lines(bosses):
+        # everyone joins one after the other over the two years up to the end of BASE_DATE's year, a past boss is always
+        # someone who joined earlier (like the current ones), so the org is a tree at every moment
+        start, end = BASE_DATE - timedelta(days=365), BASE_DATE + timedelta(days=365)
+        span = int((end - start).total_seconds())
+        joined = sorted(start + timedelta(seconds=history_rng.randrange(span)) for _ in range(n_authors))
+        moves = [[] for _ in range(n_authors)]
+        for _ in range(opts["reorgs"] if n_authors > 2 else 0):
+            i = history_rng.randrange(2, n_authors)
+            if bosses[i] is None:
+                continue
+            moves[i].append(joined[i] + timedelta(seconds=history_rng.randrange(int((end - joined[i]).total_seconds()) or 1)))
+        for i, boss in enumerate(bosses):
+            times = [joined[i], *sorted(moves[i])]
+            # walking back from today's boss, each earlier line has some other boss
+            line_bosses = [None if boss is None else boss + 1]
+            for _ in times[1:]:
+                # any of the i - 1 earlier joiners but the boss of the line after
+                other = history_rng.randrange(i - 1)
+                line_bosses.append(other + (2 if other + 1 >= line_bosses[-1] else 1))
+            line_bosses.reverse()
+            for j, valid_from in enumerate(times):
+                yield {
+                    "author_id": i + 1,
+                    "boss_id": line_bosses[j],
+                    "valid_from": valid_from,
+                    "valid_to": times[j + 1] if j + 1 < len(times) else None,
+                }
+
+    def comments():
+        for i in range(opts["comments"]):
+            # half on tasks, half on posts
+            on_task = n_posts == 0 or (n_tasks and rng.random() < 0.5)
+            row = {
+                "id": i + 1,
+                "content": rng.choice(pools["sentences"]),
+                "task_id": rng.randint(1, n_tasks) if on_task else None,
+                "post_id": None if on_task else rng.randint(1, n_posts),
+                "author_id": rng.randint(1, n_authors),
+            }
+            # task comments come within a month of their task, post comments anywhere in the year
+            if on_task:
+                row["creation_date"] = task_created[row["task_id"] - 1] + timedelta(minutes=comment_date_rng.randrange(30 * 24 * 60))
+            else:
+                row["creation_date"] = BASE_DATE + timedelta(minutes=comment_date_rng.randrange(365 * 24 * 60))
+            yield row
+
+    if n_authors < 1:
+        raise ValueError("need at least one author")
+    if opts["comments"] and not (n_tasks or n_posts):
+        raise ValueError("comments need at least one task or post")
+
+    started = time.perf_counter()
+    bosses = _org_bosses(rng, n_authors, opts["depth"], opts["fanout"], opts["skew"])
+    with engine.begin() as conn:
+        search.drop_triggers(conn)
+        changes.drop_triggers(conn)
+        # the authors' lines come from reporting_lines(), with their past
+        history.drop_triggers(conn)
+        insert(conn, Account.__table__, accounts(), "accounts")
+        insert(conn, Author.__table__, authors(bosses), "authors")
+        insert(conn, reporting_line, reporting_lines(bosses), "reporting lines")
+        insert(conn, Task.__table__, tasks(), "tasks")
+        insert(conn, task_owners, owners(), "task owners")
+        insert(conn, Post.__table__, posts(), "posts")
+        insert(conn, Comment.__table__, comments(), "comments")
+        print(f"  author closure: {closure.rebuild(conn)} rows")
+        print(f"  author activity: {activity.rebuild(conn)} rows")
+        print(f"  search index: {search.reindex(conn)} documents")
+        print(f"  org snapshots: {history.rebuild_snapshots(conn, current_app.config['ORG_SNAPSHOT_CHANGES'])}")
+        search.create_triggers(conn)
+        changes.create_triggers(conn)
+        history.create_triggers(conn)
+        conn.execute(text("ANALYZE"))
+    # core inserts skip the orm events that normally keep the org index and the response cache fresh
+    org_index.invalidate()
+    response_cache.clear()
+    collab_graph.invalidate()
+    org_history.invalidate()
+    print(f"bulk seed finished in {time.perf_counter() - started:.1f}s")
+
+
 if __name__ == "__main__":
-    seed_data()
+    parser = argparse.ArgumentParser(description="seed the database, the small hand-sized dataset unless --bulk is given")
+    parser.add_argument("--bulk", action="store_true", help="generate a large, reproducible benchmark dataset")
+    for name, default in BULK_DEFAULTS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = vars(parser.parse_args())
+
+    app = create_app()
+    if args.pop("bulk"):
+        with app.app_context():
+            seed_bulk(db.engine, **args)
+    else:
+        seed_data(app)
@@ -0,0 +1,139 @@
+import enum
+import gzip
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+# json encoding, sparse fieldsets and response compression
+#
+# orjson encodes the payloads (including datetimes and enums) in c when it's installed, the standard
+# library does it otherwise with the same output: datetimes as ISO 8601, enums as their value.
+# ?fields=headline,state on the list routes trims every item to those fields, the routes hand the list
+# to their query so columns nobody asked for aren't read at all.
+# json and text bodies of at least COMPRESS_MIN_SIZE bytes are sent brotli (when the brotli module is
+# installed) or gzip compressed, whichever the client's Accept-Encoding prefers. streamed bodies aren't.
+#
+#   pip install orjson brotli   both optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ("application/json", "text/")
+
+
+def _default(obj):
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumpb(obj):
+    """obj as compact utf-8 json bytes."""
+    if orjson is not None:
+        # non str keys for the {level: count} style dicts
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's json provider on dumpb, keys stay in the order the routes build them."""
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            kwargs.setdefault("default", _default)
+            return json.dumps(obj, **kwargs)
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        return dumpb(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumpb(obj) + b"\n", mimetype=self.mimetype)
+
+
+def parse_fields(value, available, default=None):
+    """The fields asked for with ?fields=a,b, in the order of available. default (or all of available) without ?fields."""
+    if not value:
+        return tuple(default or available)
+    asked = set(value.split(","))
+    unknown = asked.difference(available)
+    if unknown:
+        raise ValueError(f"unknown fields {', '.join(sorted(unknown))}")
+    return tuple(name for name in available if name in asked)
+
+def fields_arg(available, default=None):
+    return parse_fields(request.args.get('fields'), available, default)
+
+def fields_error(available):
+    return {"error": f"fields must be a comma separated list of {', '.join(available)}"}
+
+
+def negotiate(accept_encoding):
+    """br, gzip or None for an Accept-Encoding header value, q=0 rules an encoding out."""
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip()] = q
+    wildcard = offered.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in (("br",) if brotli is not None else ()) + ("gzip",):
+        q = offered.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def compress(body, encoding, config):
+    if encoding == "br":
+        return brotli.compress(body, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+def compressible(mimetype, size, config):
+    return config['COMPRESS'] and size >= config['COMPRESS_MIN_SIZE'] and mimetype.startswith(COMPRESSIBLE)
+
+
+class Compressor:
+
+    def init_app(self, app):
+        self.config = app.config
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        if response.status_code != 200 or response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+        body = response.get_data()
+        if not compressible(response.mimetype, len(body), self.config):
+            return response
+        # the answer depends on Accept-Encoding even when this client gets it uncompressed
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+        response.set_data(compress(body, encoding, self.config))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compressor = Compressor()
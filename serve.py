@@ -0,0 +1,31 @@
+import os
+os.environ.setdefault("APP_MODE", "prod")
+
+import argparse
+import uvicorn
+from config import get_config
+
+# production launcher for the async serving mode (asgi.py)
+# python serve.py                                  # WEB_CONCURRENCY worker processes on 127.0.0.1:8000
+# WEB_CONCURRENCY=4 ASYNC_POOL_SIZE=20 python serve.py --host 0.0.0.0 --port 8000
+#
+# each worker is its own process with its own event loop, async connection pool and flask thread pool,
+# see the ASYNC_* and WSGI_THREADS settings in config.py for what one worker holds
+
+def main():
+    config = get_config()
+    parser = argparse.ArgumentParser(description="serve the app with uvicorn worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=config.WEB_CONCURRENCY, help="worker processes (WEB_CONCURRENCY)")
+    parser.add_argument("--backlog", type=int, default=2048, help="pending connections the socket queues")
+    args = parser.parse_args()
+
+    # workers re-import asgi:app, so the app is built once per process. they read the worker count
+    # from the environment (CACHE_WORKERS in config.py)
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+    uvicorn.run("asgi:app", host=args.host, port=args.port, workers=args.workers,
+                backlog=args.backlog, lifespan="on", access_log=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import contextvars
+import queue
+import threading
+from time import perf_counter
+from flask import has_request_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from models import apply_sqlite_pragmas
+
+# one writer per process, requests only read
+#
+# sqlite runs one write transaction at a time, every other connection that wants to write waits on the lock
+# (up to the busy timeout) and then fails with "database is locked". so the routes don't write through their
+# pooled connections, they hand a function to the writer thread, which owns the only writing connection:
+#
+#   result = writer.run(lambda session: ...)   blocks until the write is committed, returns what the function returned
+#
+# the writer takes whatever is waiting (up to WRITER_BATCH writes) and runs it as one transaction, each write in
+# its own savepoint so a write that raises is undone alone and its caller gets the exception, then commits once,
+# one fsync for the whole group. nobody hears back before that commit. a write can raise Rollback(value) to undo
+# itself and still hand value back.
+# the queue holds WRITER_QUEUE_SIZE writes, a request that can't get in within WRITER_QUEUE_TIMEOUT seconds gets
+# WriterBusy (the routes answer 503) instead of piling up threads.
+#
+# the connections requests read through are switched to PRAGMA query_only, a write that skips the writer fails
+# right away instead of taking the lock. cli commands, migrations and seed.py write directly, they don't serve
+# anyone. with several worker processes each has its own writer, they still take turns on the lock.
+# queue depth, time spent waiting and group sizes are at /writer/stats and /metrics.
+
+
+class Rollback(Exception):
+    """Raised by a write to undo it, the caller gets value instead of an error."""
+
+    def __init__(self, value=None):
+        super().__init__()
+        self.value = value
+
+class WriterBusy(Exception):
+    pass
+
+
+class _Write:
+    __slots__ = ("fn", "context", "queued", "done", "result", "error")
+
+    def __init__(self, fn):
+        self.fn = fn
+        # the write runs in the caller's context, so metrics counts its statements for the caller's request
+        self.context = contextvars.copy_context()
+        self.queued = perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def read_only_requests(engine):
+    """Checks connections out with PRAGMA query_only on inside a request and off everywhere else."""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "checkout")
+    def _query_only(dbapi_connection, connection_record, connection_proxy):
+        read_only = has_request_context()
+        if connection_record.info.get("query_only", False) != read_only:
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA query_only={int(read_only)}")
+            cursor.close()
+            connection_record.info["query_only"] = read_only
+
+def _writer_engine(engine, pragmas):
+    url = engine.url
+    if url.get_backend_name() != "sqlite":
+        return engine
+    if url.database in (None, "", ":memory:"):
+        # an in memory database only exists on its own connection
+        return engine
+    writer_engine = create_engine(url, pool_size=1, max_overflow=0, echo=engine.echo)
+    apply_sqlite_pragmas(writer_engine, pragmas)
+
+    # sqlalchemy issues BEGIN and the savepoints itself, with pysqlite's own transaction handling the first
+    # RELEASE would commit. IMMEDIATE takes the write lock up front instead of halfway through the group
+    @event.listens_for(writer_engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(writer_engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return writer_engine
+
+
+class Writer:
+
+    def __init__(self):
+        self.app = None
+        self.engine = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app, engine):
+        """Sets up the writer's connection and makes the request connections of engine read only, call it inside an app context."""
+        config = app.config
+        self.app = app
+        self.batch = config['WRITER_BATCH']
+        self.timeout = config['WRITER_QUEUE_TIMEOUT']
+        self._queue = queue.Queue(config['WRITER_QUEUE_SIZE'])
+        self.engine = _writer_engine(engine, config['SQLITE_PRAGMAS'])
+        read_only_requests(engine)
+
+    def reset(self):
+        with self._lock:
+            self.writes = 0
+            self.failed = 0
+            self.rejected = 0
+            self.groups = 0
+            self.failed_commits = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.commit_seconds = 0.0
+            self.largest_group = 0
+
+    def run(self, fn):
+        """Runs fn(session) in the writer's next group commit and returns its result once committed."""
+        write = _Write(fn)
+        self._start()
+        try:
+            self._queue.put(write, timeout=self.timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise WriterBusy(f"{self._queue.maxsize} writes waiting")
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _start(self):
+        # started by the first write, so cli commands and forked server workers don't carry an idle thread
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="writer", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        with self.app.app_context():
+            while True:
+                writes = [self._queue.get()]
+                while len(writes) < self.batch:
+                    try:
+                        writes.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._commit(writes)
+
+    def _commit(self, writes):
+        started = perf_counter()
+        error = None
+        with Session(self.engine, expire_on_commit=False) as session:
+            for write in writes:
+                try:
+                    with session.begin_nested():
+                        write.result = write.context.run(write.fn, session)
+                except Rollback as e:
+                    write.result = e.value
+                except Exception as e:
+                    write.error = e
+            committing = perf_counter()
+            try:
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                error = e
+        finished = perf_counter()
+        with self._lock:
+            self.groups += 1
+            self.writes += len(writes)
+            self.largest_group = max(self.largest_group, len(writes))
+            self.commit_seconds += finished - committing
+            for write in writes:
+                waited = started - write.queued
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                if error is not None or write.error is not None:
+                    self.failed += 1
+            if error is not None:
+                self.failed_commits += 1
+        for write in writes:
+            if error is not None:
+                write.error = error
+            write.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "queue_size": self._queue.maxsize if self._queue is not None else 0,
+                "writes": self.writes,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "groups": self.groups,
+                "failed_commits": self.failed_commits,
+                "average_group": self.writes / self.groups if self.groups else 0,
+                "largest_group": self.largest_group,
+                "wait_seconds": self.wait_seconds,
+                "average_wait_seconds": self.wait_seconds / self.writes if self.writes else 0,
+                "max_wait_seconds": self.max_wait_seconds,
+                "commit_seconds": self.commit_seconds,
+            }
+
+    def metric_lines(self):
+        stats = self.stats()
+        for name, kind, help_text, key in (
+            ("app_writer_queue_depth", "gauge", "Writes waiting for the writer.", "queued"),
+            ("app_writer_writes_total", "counter", "Writes run by the writer.", "writes"),
+            ("app_writer_failed_total", "counter", "Writes that raised or whose commit failed.", "failed"),
+            ("app_writer_rejected_total", "counter", "Writes turned away because the queue was full.", "rejected"),
+            ("app_writer_commits_total", "counter", "Group commits.", "groups"),
+            ("app_writer_wait_seconds_total", "counter", "Time writes spent queued before their group started.", "wait_seconds"),
+            ("app_writer_max_wait_seconds", "gauge", "Longest any write waited in the queue.", "max_wait_seconds"),
+            ("app_writer_commit_seconds_total", "counter", "Time spent committing groups.", "commit_seconds"),
+        ):
+            yield f"# HELP {name} {help_text}"
+            yield f"# TYPE {name} {kind}"
+            yield f"{name} {stats[key]}"
+
+
+writer = Writer()